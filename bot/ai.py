@@ -1,202 +1,269 @@
 import os
-import openai
+import time
 import asyncio
+import logging
+import httpx
+from typing import Literal, Optional
+from pydantic import BaseModel, Field
 from openai import AsyncOpenAI
-from .db import get_user_workouts
-import re
+from .db import get_recent_exercises
+from .prompts import workout_messages, count_message_tokens
 import random
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-openai.api_key = OPENAI_API_KEY
+# Таймауты, ретраи (SDK сам делает экспоненциальный backoff на 429/5xx/обрывах) и пул соединений к OpenAI
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+# Сколько запросов к OpenAI выполняется одновременно на процесс, остальные ждут в очереди
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "8"))
+# Модели для ответов со структурированным выводом (json_schema): gpt-3.5-turbo его не поддерживает
+OPENAI_CHAT_MODEL = os.getenv("OPENAI_CHAT_MODEL", "gpt-4o-mini")
+OPENAI_VISION_MODEL = os.getenv("OPENAI_VISION_MODEL", "gpt-4o")
+# Стримить генерацию тренировки (on_partial получает текст по мере генерации)
+WORKOUT_STREAMING = os.getenv("WORKOUT_STREAMING", "1") == "1"
 
-async def ask_gpt(prompt, user_message):
+_client = None
+_semaphore = None
+# Метрики
+_stats = {
+    "requests": 0, "errors": 0, "waiting": 0, "max_waiting": 0,
+    # Генерация тренировок: входные токены, из них взятые из кэша префикса OpenAI, и время до первого токена
+    "workout_requests": 0, "workout_prompt_tokens": 0, "workout_cached_tokens": 0,
+    "workout_ttft_ms_total": 0.0, "workout_ttft_samples": 0,
+}
+
+
+def get_client():
+    """Общий AsyncOpenAI на процесс: один пул соединений вместо нового клиента на каждый запрос."""
+    global _client
+    if _client is None:
+        _client = AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+            max_retries=OPENAI_MAX_RETRIES,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+                ),
+            ),
+        )
+    return _client
+
+
+class openai_slot:
+    """async with openai_slot(): ... — ограничивает число одновременных запросов к OpenAI."""
+
+    async def __aenter__(self):
+        global _semaphore
+        if _semaphore is None:
+            _semaphore = asyncio.Semaphore(OPENAI_CONCURRENCY)
+        _stats["waiting"] += 1
+        _stats["max_waiting"] = max(_stats["max_waiting"], _stats["waiting"])
+        try:
+            await _semaphore.acquire()
+        finally:
+            _stats["waiting"] -= 1
+        _stats["requests"] += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            _stats["errors"] += 1
+        _semaphore.release()
+
+
+def _record_workout_usage(usage, ttft=None):
+    _stats["workout_requests"] += 1
+    if usage is not None:
+        _stats["workout_prompt_tokens"] += usage.prompt_tokens or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        _stats["workout_cached_tokens"] += (getattr(details, "cached_tokens", 0) or 0) if details else 0
+    if ttft is not None:
+        _stats["workout_ttft_ms_total"] += ttft * 1000
+        _stats["workout_ttft_samples"] += 1
+
+
+def ai_stats():
+    stats = dict(_stats)
+    requests = stats["workout_requests"]
+    stats["avg_workout_prompt_tokens"] = round(stats["workout_prompt_tokens"] / requests) if requests else 0
+    stats["workout_cached_share"] = (
+        round(stats["workout_cached_tokens"] / stats["workout_prompt_tokens"], 3) if stats["workout_prompt_tokens"] else 0.0
+    )
+    samples = stats["workout_ttft_samples"]
+    stats["avg_workout_ttft_ms"] = round(stats["workout_ttft_ms_total"] / samples) if samples else 0
+    return stats
+
+
+async def close_ai():
+    global _client
+    if _client is not None:
+        logging.info(f"OpenAI client stats: {ai_stats()}")
+        await _client.close()
+    _client = None
+
+
+# --- Структурированные ответы ---
+# Схемы уходят в OpenAI как response_format (strict json_schema), поэтому все поля обязательные,
+# а «нет значения» — это null. Хендлеры получают уже провалидированные модели.
+
+class MealInfo(BaseModel):
+    description: str = Field(description="Что съедено, кратко")
+    calories: Optional[float] = Field(description="Калорийность, ккал")
+    proteins: Optional[float] = Field(description="Белки, г")
+    fats: Optional[float] = Field(description="Жиры, г")
+    carbs: Optional[float] = Field(description="Углеводы, г")
+
+
+class WorkoutInfo(BaseModel):
+    description: str = Field(description="Что за тренировка, кратко")
+    workout_type: str = Field(description="Тип тренировки, например custom, бег, силовая")
+    calories_burned: Optional[int] = Field(description="Сожжено калорий, ккал")
+
+
+class AssistantReply(BaseModel):
+    type: Literal["meal", "workout", "answer"] = Field(
+        description="meal — пользователь сообщил о приёме пищи, workout — о тренировке, answer — всё остальное"
+    )
+    reply: str = Field(description="Ответ пользователю: совет или комментарий, без JSON")
+    meal: Optional[MealInfo] = Field(description="Заполняется только для type = meal")
+    workout: Optional[WorkoutInfo] = Field(description="Заполняется только для type = workout")
+
+
+class FoodPhotoAnalysis(MealInfo):
+    pass
+
+
+class AIRefusal(Exception):
+    """Модель отказалась отвечать по схеме (message.refusal)."""
+
+
+async def parse_structured(model, messages, response_format, max_tokens, temperature=None):
+    kwargs = {"temperature": temperature} if temperature is not None else {}
+    async with openai_slot():
+        completion = await get_client().beta.chat.completions.parse(
+            model=model,
+            messages=messages,
+            response_format=response_format,
+            max_tokens=max_tokens,
+            **kwargs
+        )
+    message = completion.choices[0].message
+    if message.parsed is None:
+        raise AIRefusal(message.refusal or "Пустой ответ модели")
+    return message.parsed
+
+
+async def ask_gpt(prompt, user_message, model=OPENAI_CHAT_MODEL):
+    """Ответ ассистента на свободное сообщение: AssistantReply с типом и данными приёма пищи / тренировки."""
     messages = [
         {"role": "system", "content": (
-            "Ты фитнес-бот. Если пользователь сообщает о приёме пищи или тренировке, верни JSON с типом и деталями (пример: {\"type\": \"meal\", \"description\": \"...\", \"calories\": 350, \"proteins\": ..., \"fats\": ..., \"carbs\": ...} или {\"type\": \"workout\", ...}). Обязательно указывай БЖУ (белки, жиры, углеводы) в граммах. "
-            "Если это просто вопрос — дай совет. Если ничего не нужно сохранять — просто ответь. "
+            "Ты фитнес-бот. Если пользователь сообщает о приёме пищи, верни type = meal и заполни meal, "
+            "обязательно с БЖУ (белки, жиры, углеводы) в граммах. Если сообщает о тренировке — type = workout и заполни workout. "
+            "Если это просто вопрос — type = answer и дай совет в reply. "
             "Отвечай всегда только на русском языке."
         )},
         {"role": "user", "content": user_message}
     ]
-    loop = asyncio.get_running_loop()
-    response = await loop.run_in_executor(
-        None,
-        lambda: openai.chat.completions.create(
-            model="gpt-3.5-turbo",
+    return await parse_structured(model, messages, AssistantReply, max_tokens=300, temperature=0.4)
+
+async def complete_workout(messages, on_partial=None):
+    """Запрос тренировки у gpt-4o. С on_partial ответ стримится и on_partial(text) вызывается на каждом чанке."""
+    client = get_client()
+    if on_partial is None or not WORKOUT_STREAMING:
+        async with openai_slot():
+            response = await client.chat.completions.create(
+                model="gpt-4o",
+                messages=messages,
+                temperature=0.4,
+                max_tokens=1200
+            )
+        _record_workout_usage(response.usage)
+        return response.choices[0].message.content
+    parts = []
+    usage = None
+    ttft = None
+    # Слот держим до конца стрима — соединение занято всё это время
+    async with openai_slot():
+        started = time.monotonic()
+        stream = await client.chat.completions.create(
+            model="gpt-4o",
             messages=messages,
             temperature=0.4,
-            max_tokens=500
+            max_tokens=1200,
+            stream=True,
+            stream_options={"include_usage": True}
         )
-    )
-    return response.choices[0].message.content
+        async for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if ttft is None:
+                    ttft = time.monotonic() - started
+                parts.append(delta)
+                try:
+                    await on_partial("".join(parts))
+                except Exception as e:
+                    # Ошибка показа прогресса не должна обрывать генерацию
+                    print(f"Ошибка в on_partial: {e}")
+    _record_workout_usage(usage, ttft)
+    return "".join(parts)
+
+# Группы мышц, между которыми чередуются тренировки
+MUSCLE_GROUPS = [
+    "ноги",
+    "грудь и руки",
+    "спина и плечи",
+    "пресс и корпус"
+]
 
-async def generate_workout_via_ai(user):
+async def generate_workout_via_ai(user, on_partial=None):
     n = random.randint(5, 8)
-    # Список групп мышц для разнообразия
-    muscle_groups = [
-        "ноги",
-        "грудь и руки",
-        "спина и плечи",
-        "пресс и корпус"
-    ]
-    chosen_group = random.choice(muscle_groups)
-    # Получаем последние 2-3 тренировки пользователя
-    workouts = await get_user_workouts(user["id"], limit=3)
-    last_exercises = []
-    def extract_exercise_names(details):
-        lines = details.split('\n')
-        exercises = []
-        for line in lines:
-            match = re.match(r'\d+\.\s*([^\n]+)', line)
-            if match:
-                exercises.append(match.group(1).strip())
-        return exercises
-    for w in workouts:
-        details = (w.get("details") or "").strip()
-        if details:
-            exercises = extract_exercise_names(details)
-            last_exercises.extend(exercises)
-    history_str = ", ".join(last_exercises)
-    unique_exercises = list({ex for ex in last_exercises if ex})
-    used_exercises_str = ", ".join(unique_exercises)
-    if history_str:
-        history_prompt = f"Последние тренировки: {history_str}."
-    else:
-        history_prompt = ""
-    if used_exercises_str:
-        used_prompt = f"Уже использованные упражнения: {used_exercises_str}."
-    else:
-        used_prompt = ""
+    chosen_group = random.choice(MUSCLE_GROUPS)
+    # Упражнения последних тренировок пользователя (уже разобраны при сохранении)
+    last_exercises = await get_recent_exercises(user["id"])
+    messages = workout_messages(user, chosen_group, n, last_exercises)
+    logging.debug(f"Запрос тренировки: {messages[-1]['content']}")
+    return await complete_workout(messages, on_partial=on_partial)
 
-    prompt = (
-        f"Ты - профессиональный фитнесс-тренер. Сегодня у пользователя день тренировки: {chosen_group}. "
-        f"Составь тренировку только для этой группы мышц, не добавляй упражнения на другие группы. "
-        f"Учитывай цель, уровень, ограничения, частоту тренировок, рост, вес, возраст, пол и место занятий.\n"
-        f"Цель: {user.get('goal', 'не указано')}. "
-        f"Уровень: {user.get('level', 'не указано')}. "
-        f"Ограничения: {user.get('health_issues', 'нет')}. "
-        f"Место занятий: {user.get('location', 'не указано')}. "
-        f"Частота тренировок: {user.get('workouts_per_week', 'не указано')} раз в неделю. "
-        f"Рост: {user.get('height', 'не указано')} см. Вес: {user.get('weight', 'не указано')} кг. Возраст: {user.get('age', 'не указано')}. Пол: {user.get('gender', 'не указано')}. "
-        f"{history_prompt}\n"
-        f"{used_prompt}\n"
-        f"Не используй ни одно упражнение из списка последних тренировок, даже базовые: {used_exercises_str}. Составь тренировку только из новых упражнений. Сделай тренировку максимально разнообразной внутри выбранной группы мышц.\n"
-        f"Сгенерируй ровно {n} упражнений (последнее — кардио или заминка).\n"
-        f"Для каждого упражнения обязательно указывай вес (даже если это собственный вес — пиши явно). После плана тренировки выдай отдельным абзацем совет по питанию на сегодня с обязательным указанием БЖУ (белки, жиры, углеводы).\n"
-        f"Форматируй ответ строго так:\n"
-        f"План тренировки на сегодня: {chosen_group}\n\n"
-        f"Для каждого упражнения используй такой формат:\n"
-        f"[Номер]. [Название упражнения]\n[кол-во подходов × повторений — вес]\n*Комментарий по технике или совет*\n\n"
-        f"Последнее упражнение всегда кардио или заминка, указывай его в том же формате.\n"
-        f"Совет по питанию: ... (Б: ... г, Ж: ... г, У: ... г)\n\nНе добавляй лишних пояснений вне структуры плана."
+async def regenerate_workout_via_ai(user, rejected_exercises, on_partial=None):
+    """Новая тренировка взамен отклонённой: вместо полных текстов прошлых вариантов — только их упражнения."""
+    n = random.randint(5, 8)
+    chosen_group = random.choice(MUSCLE_GROUPS)
+    last_exercises = await get_recent_exercises(user["id"])
+    messages = workout_messages(user, chosen_group, n, last_exercises, rejected_exercises)
+    logging.info(
+        f"Замена тренировки: отклонено упражнений {len(rejected_exercises)}, "
+        f"промпт ~{count_message_tokens(messages)} токенов"
     )
+    return await complete_workout(messages, on_partial=on_partial)
 
-    # Временное логирование для отладки
-    print("USER DATA:", user)
-    print("CHOSEN MUSCLE GROUP:", chosen_group)
-    print("PROMPT FOR GPT:\n", prompt)
-
-    client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-    response = await client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": "Ты фитнес-бот. Отвечай всегда только на русском языке."},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0.4,
-        max_tokens=1200
-    )
-    return response.choices[0].message.content
+async def generate_segment_workout(profile, chosen_group):
+    """Тренировка для пула: промпт только из грубых полей сегмента, без истории конкретного пользователя."""
+    return await complete_workout(workout_messages(profile, chosen_group, random.randint(5, 8)))
 
-async def generate_workout_via_ai_with_history(user, history):
-    n = random.randint(5, 8)
-    # Список групп мышц для разнообразия
-    muscle_groups = [
-        "ноги",
-        "грудь и руки",
-        "спина и плечи",
-        "пресс и корпус"
-    ]
-    chosen_group = random.choice(muscle_groups)
-    # Извлекаем историю упражнений из последних тренировок для промпта
-    workouts = await get_user_workouts(user["id"], limit=3)
-    last_exercises = []
-    def extract_exercise_names(details):
-        lines = details.split('\n')
-        exercises = []
-        for line in lines:
-            match = re.match(r'\d+\.\s*([^\n]+)', line)
-            if match:
-                exercises.append(match.group(1).strip())
-        return exercises
-    for w in workouts:
-        details = (w.get("details") or "").strip()
-        if details:
-            exercises = extract_exercise_names(details)
-            last_exercises.extend(exercises)
-    history_str = ", ".join(last_exercises)
-    unique_exercises = list({ex for ex in last_exercises if ex})
-    used_exercises_str = ", ".join(unique_exercises)
-    if history_str:
-        history_prompt = f"Последние тренировки: {history_str}."
-    else:
-        history_prompt = ""
-    if used_exercises_str:
-        used_prompt = f"Уже использованные упражнения: {used_exercises_str}."
-    else:
-        used_prompt = ""
-
-    system_prompt = (
-        f"Ты - профессиональный фитнесс-тренер. Сегодня у пользователя день тренировки: {chosen_group}. "
-        f"Составь тренировку только для этой группы мышц, не добавляй упражнения на другие группы. "
-        f"Учитывай цель, уровень, ограничения, частоту тренировок, рост, вес, возраст, пол и место занятий.\n"
-        f"Цель: {user.get('goal', 'не указано')}. "
-        f"Уровень: {user.get('level', 'не указано')}. "
-        f"Ограничения: {user.get('health_issues', 'нет')}. "
-        f"Место занятий: {user.get('location', 'не указано')}. "
-        f"Частота тренировок: {user.get('workouts_per_week', 'не указано')} раз в неделю. "
-        f"Рост: {user.get('height', 'не указано')} см. Вес: {user.get('weight', 'не указано')} кг. Возраст: {user.get('age', 'не указано')}. Пол: {user.get('gender', 'не указано')}. "
-        f"{history_prompt}\n"
-        f"{used_prompt}\n"
-        f"Не используй ни одно упражнение из списка последних тренировок, даже базовые: {used_exercises_str}. Составь тренировку только из новых упражнений. Сделай тренировку максимально разнообразной внутри выбранной группы мышц.\n"
-        f"Сгенерируй ровно {n} упражнений (последнее — кардио или заминка).\n"
-        f"Для каждого упражнения обязательно указывай вес (даже если это собственный вес — пиши явно). После плана тренировки выдай отдельным абзацем совет по питанию на сегодня с обязательным указанием БЖУ (белки, жиры, углеводы).\n"
-        f"Форматируй ответ строго так:\n"
-        f"План тренировки на сегодня: {chosen_group}\n\n"
-        f"Для каждого упражнения используй такой формат:\n"
-        f"[Номер]. [Название упражнения]\n[кол-во подходов × повторений — вес]\n*Комментарий по технике или совет*\n\n"
-        f"Последнее упражнение всегда кардио или заминка, указывай его в том же формате.\n"
-        f"Совет по питанию: ... (Б: ... г, Ж: ... г, У: ... г)\n\nНе добавляй лишних пояснений вне структуры плана."
-    )
-    messages = [{"role": "system", "content": system_prompt}] + history
-    print("PROMPT HISTORY FOR GPT:", messages)
-    print("CHOSEN MUSCLE GROUP:", chosen_group)
-    client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-    response = await client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        temperature=0.4,
-        max_tokens=1200
-    )
-    return response.choices[0].message.content
+async def analyze_food_photo_via_ai(image_url, detail="auto"):
+    """FoodPhotoAnalysis для фото блюда.
 
-async def analyze_food_photo_via_ai(file_url):
+    image_url — ссылка или data:image/jpeg;base64,..., detail — low / high / auto (влияет на число токенов картинки).
+    """
     prompt = (
-        "Определи, что изображено на фото, и оцени калорийность блюда. Верни JSON вида: {\"description\": \"...\", \"calories\": ..., \"proteins\": ..., \"fats\": ..., \"carbs\": ...}. Обязательно укажи БЖУ (белки, жиры, углеводы) в граммах. Отвечай всегда только на русском языке."
-    )
-    loop = asyncio.get_running_loop()
-    response = await loop.run_in_executor(
-        None,
-        lambda: openai.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": prompt},
-                {"role": "user", "content": [
-                    {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {"url": file_url}}
-                ]}
-            ],
-            max_tokens=500
-        )
+        "Определи, что изображено на фото, и оцени калорийность блюда. Обязательно укажи БЖУ (белки, жиры, углеводы) в граммах. Отвечай всегда только на русском языке."
     )
-    return response.choices[0].message.content 
\ No newline at end of file
+    return await parse_structured(
+        OPENAI_VISION_MODEL,
+        [
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": [
+                {"type": "image_url", "image_url": {"url": image_url, "detail": detail}}
+            ]}
+        ],
+        FoodPhotoAnalysis,
+        max_tokens=200
+    ) 
\ No newline at end of file
@@ -2,10 +2,13 @@ from aiogram import Router, types, F
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-import asyncio
-import os
-import httpx
-from .db import get_user_by_telegram_id
+from aiogram.filters import Command
+from datetime import datetime
+from .db import get_user_by_telegram_id, get_broadcast_job, update_broadcast_job, list_broadcast_jobs
+from .broadcast_jobs import (
+    start_broadcast_job, spawn_broadcast_job, format_job, job_keyboard
+)
+from .update_queue import answer_callback
 import logging
 broadcast_router = Router()
 
@@ -27,28 +30,10 @@ async def is_admin(telegram_id):
     user = await get_user_by_telegram_id(telegram_id)
     return user and user.get("role") == "admin"
 
-# Получение пользователей по аудитории
-async def get_users_by_audience(audience):
-    url = f"{os.getenv('SUPABASE_URL')}/rest/v1/users"
-    headers = {
-        "apikey": os.getenv('SUPABASE_KEY'),
-        "Authorization": f"Bearer {os.getenv('SUPABASE_KEY')}",
-    }
-    params = {}
-    if audience == "paid":
-        params = {"is_paid": "eq.true"}
-    elif audience == "free":
-        params = {"is_paid": "eq.false"}
-    elif audience == "test_admins":
-        params = {"role": "eq.admin"}
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(url, headers=headers, params=params)
-        return resp.json()
-
 # Старт рассылки
 @broadcast_router.message(F.text == "Пуш-рассылка")
-async def push_start(message: types.Message, state: FSMContext):
-    if not await is_admin(message.from_user.id):
+async def push_start(message: types.Message, state: FSMContext, is_admin=False):
+    if not is_admin:
         await message.answer("Нет доступа.")
         return
     await message.answer("Введите текст пуш-уведомления:")
@@ -85,17 +70,17 @@ async def push_audience(callback_query: types.CallbackQuery, state: FSMContext):
     note = "\n\n<b>Внимание: рассылка будет отправлена только администраторам!</b>" if audience == "test_admins" else ""
     await callback_query.message.answer(f"Текст: {text}\nКому: {audience_str}{note}\n\nПодтвердить рассылку?", reply_markup=kb, parse_mode="HTML")
     await state.set_state(BroadcastStates.waiting_for_confirm)
-    await callback_query.answer()
+    await answer_callback(callback_query)
 
 @broadcast_router.callback_query(lambda c: c.data == "broadcast_cancel")
 async def push_cancel(callback_query: types.CallbackQuery, state: FSMContext):
     await state.clear()
     await callback_query.message.answer("Рассылка отменена.")
-    await callback_query.answer()
+    await answer_callback(callback_query)
 
 @broadcast_router.callback_query(lambda c: c.data == "broadcast_confirm")
 async def push_confirm(callback_query: types.CallbackQuery, state: FSMContext):
-    await callback_query.answer()
+    await answer_callback(callback_query)
     data = await state.get_data()
     if data.get("is_busy"):
         await callback_query.message.answer("Рассылка уже выполняется, подождите...")
@@ -103,30 +88,45 @@ async def push_confirm(callback_query: types.CallbackQuery, state: FSMContext):
     await state.update_data(is_busy=True)
     text = data.get("push_text", "")
     audience = data.get("push_audience", "all")
-    await callback_query.message.answer("Рассылка начата... (вы получите отчёт по завершении)")
     await state.clear()
-    # Запуск асинхронной рассылки
-    asyncio.create_task(broadcast_worker(callback_query.bot, callback_query.from_user.id, text, audience))
+    # Рассылка сохраняется в broadcast_jobs и переживает рестарт бота
+    job = await start_broadcast_job(callback_query.bot, callback_query.from_user.id, text, audience)
+    spawn_broadcast_job(callback_query.bot, job)
 
-async def broadcast_worker(bot, admin_id, text, audience):
+# Список последних рассылок
+@broadcast_router.message(Command("broadcasts"))
+async def broadcasts_list(message: types.Message, is_admin=False):
+    if not is_admin:
+        await message.answer("Нет доступа.")
+        return
+    jobs = await list_broadcast_jobs()
+    if not jobs:
+        await message.answer("Рассылок пока не было.")
+        return
+    for job in jobs:
+        await message.answer(format_job(job), reply_markup=job_keyboard(job))
+
+# Управление рассылкой: пауза / продолжение / отмена / обновление прогресса
+@broadcast_router.callback_query(F.data.startswith("bjob:"))
+async def broadcast_job_action(callback_query: types.CallbackQuery, is_admin=False):
+    if not is_admin:
+        await answer_callback(callback_query, "Нет доступа.")
+        return
+    _, action, job_id = callback_query.data.split(":")
+    job = await get_broadcast_job(int(job_id))
+    if not job:
+        await answer_callback(callback_query, "Рассылка не найдена.")
+        return
+    if action == "pause" and job["status"] == "running":
+        job = await update_broadcast_job(job["id"], status="paused")
+    elif action == "resume" and job["status"] in ("paused", "failed"):
+        job = await update_broadcast_job(job["id"], status="running", heartbeat_at=datetime.utcnow().isoformat())
+        spawn_broadcast_job(callback_query.bot, job)
+    elif action == "cancel" and job["status"] in ("running", "paused", "failed"):
+        job = await update_broadcast_job(job["id"], status="cancelled")
     try:
-        users = await get_users_by_audience(audience if audience != "all" else None)
-        count = 0
-        errors = 0
-        total = len(users)
-        for idx, user in enumerate(users, 1):
-            try:
-                await bot.send_message(user["telegram_id"], text)
-                count += 1
-            except Exception as e:
-                errors += 1
-                logging.warning(f"Ошибка отправки пользователю {user.get('telegram_id')} ({user.get('username')}): {e}")
-            if idx % 100 == 0:
-                await bot.send_message(admin_id, f"Рассылка: отправлено {idx} из {total}")
-            await asyncio.sleep(0.03)  # ~33 сообщения/сек
-        if audience == "test_admins":
-            await bot.send_message(admin_id, f"Тестовая рассылка завершена. Успешно: {count}, ошибок: {errors}")
-        else:
-            await bot.send_message(admin_id, f"Рассылка завершена. Успешно: {count}, ошибок: {errors}")
-    except Exception as e:
-        await bot.send_message(admin_id, f"Ошибка при рассылке: {e}") 
\ No newline at end of file
+        await callback_query.message.edit_text(format_job(job), reply_markup=job_keyboard(job))
+    except Exception:
+        # Текст не изменился — Telegram отвечает ошибкой, это не страшно
+        pass
+    await answer_callback(callback_query)
@@ -0,0 +1,185 @@
+import os
+import time
+import asyncio
+import logging
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from .db import mark_users_unreachable
+
+# Глобальный лимит Telegram — около 30 сообщений в секунду на бота
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "30"))
+BROADCAST_BURST = int(os.getenv("BROADCAST_BURST", "5"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+
+# Получатели, которым больше не стоит писать (помечаются blocked_at и пропускаются в следующих рассылках)
+UNREACHABLE_STATUSES = ("blocked", "deactivated", "chat_not_found")
+
+
+def classify_error(exc):
+    if isinstance(exc, TelegramRetryAfter):
+        return "retry_after"
+    text = str(exc).lower()
+    if isinstance(exc, TelegramForbiddenError):
+        if "deactivated" in text:
+            return "deactivated"
+        return "blocked"
+    if isinstance(exc, TelegramBadRequest) and "chat not found" in text:
+        return "chat_not_found"
+    return "error"
+
+
+class TokenBucket:
+    """Общий для всех отправителей лимит сообщений в секунду. pause() останавливает выдачу токенов всем."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+        self._updated = self._paused_until
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + max(0.0, now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BroadcastStats:
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self.sent = 0
+        self.failed = 0
+        self.unreachable = {status: 0 for status in UNREACHABLE_STATUSES}
+        self.retries = 0
+
+    @property
+    def processed(self):
+        return self.sent + self.failed + sum(self.unreachable.values())
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def throughput(self):
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def record(self, status):
+        if status == "sent":
+            self.sent += 1
+        elif status in self.unreachable:
+            self.unreachable[status] += 1
+        else:
+            self.failed += 1
+
+    def as_dict(self):
+        return {
+            "processed": self.processed,
+            "sent": self.sent,
+            "failed": self.failed,
+            "unreachable": dict(self.unreachable),
+            "retries": self.retries,
+            "elapsed_sec": round(self.elapsed, 1),
+            "throughput_per_sec": round(self.throughput, 2),
+        }
+
+
+class BroadcastEngine:
+    """Рассылка пулом отправителей под общим token bucket.
+
+    TelegramRetryAfter ставит на паузу весь bucket и повторяет отправку,
+    заблокировавшие бота / удалённые / ненайденные чаты помечаются в БД.
+    """
+
+    def __init__(self, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY, burst=BROADCAST_BURST,
+                 max_retries=BROADCAST_MAX_RETRIES):
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+
+    async def _deliver(self, send, telegram_id, stats):
+        attempt = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                await send(telegram_id)
+                return "sent"
+            except Exception as e:
+                status = classify_error(e)
+                if status == "retry_after" and attempt < self.max_retries:
+                    attempt += 1
+                    stats.retries += 1
+                    logging.warning(f"Flood control при рассылке, пауза {e.retry_after} сек")
+                    self.bucket.pause(e.retry_after)
+                    continue
+                if status not in UNREACHABLE_STATUSES:
+                    logging.warning(f"Ошибка отправки пользователю {telegram_id}: {e}")
+                return status
+
+    async def run(self, recipients, send, on_result=None, on_progress=None, progress_every=1000):
+        """recipients — async-итератор telegram_id, send(telegram_id) — корутина отправки.
+
+        on_result(telegram_id, status) вызывается после каждого получателя,
+        on_progress(stats) — каждые progress_every получателей.
+        """
+        stats = BroadcastStats()
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        unreachable = []
+
+        async def flush_unreachable():
+            if unreachable:
+                batch = unreachable[:]
+                unreachable.clear()
+                try:
+                    await mark_users_unreachable(batch)
+                except Exception as e:
+                    logging.warning(f"Не удалось пометить недоступных пользователей: {e}")
+
+        async def produce():
+            async for telegram_id in recipients:
+                await queue.put(telegram_id)
+            for _ in range(self.concurrency):
+                await queue.put(None)
+
+        async def work():
+            while True:
+                telegram_id = await queue.get()
+                if telegram_id is None:
+                    return
+                status = await self._deliver(send, telegram_id, stats)
+                stats.record(status)
+                if status in UNREACHABLE_STATUSES:
+                    unreachable.append(telegram_id)
+                    if len(unreachable) >= 100:
+                        await flush_unreachable()
+                if on_result is not None:
+                    await on_result(telegram_id, status)
+                if on_progress is not None and stats.processed % progress_every == 0:
+                    await on_progress(stats)
+
+        tasks = [asyncio.create_task(produce())] + [asyncio.create_task(work()) for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await flush_unreachable()
+            stats.finished_at = time.monotonic()
+        logging.info(f"Рассылка завершена: {stats.as_dict()}")
+        return stats
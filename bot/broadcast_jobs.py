@@ -0,0 +1,192 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from .db import (
+    count_users, iter_user_pages, create_broadcast_job, get_broadcast_job, update_broadcast_job,
+    claim_stale_broadcast_jobs, save_broadcast_results, get_processed_recipients
+)
+from .broadcast_engine import BroadcastEngine, UNREACHABLE_STATUSES
+
+# Сколько получателей обрабатывается между сохранениями курсора
+BROADCAST_JOB_PAGE_SIZE = int(os.getenv("BROADCAST_JOB_PAGE_SIZE", "200"))
+# Через сколько секунд без heartbeat задачу подхватывает другой воркер / процесс после рестарта
+BROADCAST_JOB_LEASE = int(os.getenv("BROADCAST_JOB_LEASE", "120"))
+# Не чаще, чем раз в столько секунд, обновляем сообщение с прогрессом у админа
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "10"))
+
+# Аудитория рассылки -> выборка пользователей в db.iter_users
+AUDIENCE_SEGMENTS = {
+    "all": "all",
+    "paid": "paid",
+    "free": "free",
+    "test_admins": "admins",
+}
+
+STATUS_TITLES = {
+    "running": "идёт",
+    "paused": "на паузе",
+    "cancelled": "отменена",
+    "done": "завершена",
+    "failed": "остановлена из-за ошибки",
+}
+
+# Один движок на процесс — общий лимит Telegram для всех рассылок
+engine = BroadcastEngine()
+_tasks = {}  # job_id -> asyncio.Task
+
+
+def _counter_key(status):
+    if status == "sent":
+        return "sent"
+    return "unreachable" if status in UNREACHABLE_STATUSES else "failed"
+
+
+def format_job(job):
+    total = job.get("total")
+    processed = (job.get("sent") or 0) + (job.get("failed") or 0) + (job.get("unreachable") or 0)
+    progress = f"{processed} из {total}" if total is not None else str(processed)
+    text = job.get("text") or ""
+    preview = text if len(text) <= 100 else text[:100] + "…"
+    return (
+        f"Рассылка #{job['id']} — {STATUS_TITLES.get(job['status'], job['status'])}\n"
+        f"Аудитория: {job.get('audience')}\n"
+        f"Обработано: {progress}\n"
+        f"Успешно: {job.get('sent') or 0}, ошибок: {job.get('failed') or 0}, недоступны: {job.get('unreachable') or 0}\n\n"
+        f"Текст: {preview}"
+    )
+
+
+def job_keyboard(job):
+    job_id = job["id"]
+    status = job["status"]
+    buttons = []
+    if status == "running":
+        buttons.append(InlineKeyboardButton(text="Пауза", callback_data=f"bjob:pause:{job_id}"))
+    if status in ("paused", "failed"):
+        buttons.append(InlineKeyboardButton(text="Продолжить", callback_data=f"bjob:resume:{job_id}"))
+    if status in ("running", "paused", "failed"):
+        buttons.append(InlineKeyboardButton(text="Отменить", callback_data=f"bjob:cancel:{job_id}"))
+    buttons.append(InlineKeyboardButton(text="Обновить", callback_data=f"bjob:refresh:{job_id}"))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons])
+
+
+async def show_progress(bot, job):
+    chat_id = job.get("progress_chat_id")
+    message_id = job.get("progress_message_id")
+    if not chat_id or not message_id:
+        return
+    try:
+        await bot.edit_message_text(
+            format_job(job), chat_id=chat_id, message_id=message_id, reply_markup=job_keyboard(job)
+        )
+    except Exception as e:
+        # "message is not modified" и удалённые сообщения — не повод останавливать рассылку
+        logging.debug(f"Не удалось обновить прогресс рассылки #{job['id']}: {e}")
+
+
+async def start_broadcast_job(bot, admin_id, text, audience):
+    total = await count_users(AUDIENCE_SEGMENTS.get(audience, "all"))
+    job = await create_broadcast_job(text, audience, created_by=admin_id, total=total)
+    msg = await bot.send_message(admin_id, format_job(job), reply_markup=job_keyboard(job))
+    return await update_broadcast_job(job["id"], progress_chat_id=admin_id, progress_message_id=msg.message_id)
+
+
+def spawn_broadcast_job(bot, job):
+    task = _tasks.get(job["id"])
+    if task is not None and not task.done():
+        return task
+    task = asyncio.create_task(run_broadcast_job(bot, job))
+    _tasks[job["id"]] = task
+    return task
+
+
+async def run_broadcast_job(bot, job):
+    job_id = job["id"]
+    text = job["text"]
+    counters = {key: job.get(key) or 0 for key in ("sent", "failed", "unreachable")}
+    last_progress = 0.0
+
+    async def send(telegram_id):
+        await bot.send_message(telegram_id, text)
+
+    try:
+        pages = iter_user_pages(
+            AUDIENCE_SEGMENTS.get(job["audience"], "all"),
+            columns=("id", "telegram_id"),
+            page_size=BROADCAST_JOB_PAGE_SIZE,
+            after_id=job.get("cursor_id"),
+        )
+        async for page in pages:
+            # Пауза и отмена проверяются по БД между страницами, так что их видят все процессы
+            current = await get_broadcast_job(job_id)
+            if not current or current["status"] != "running":
+                logging.info(f"Рассылка #{job_id} остановлена: {current and current['status']}")
+                return
+            telegram_ids = [user["telegram_id"] for user in page]
+            # Получатели, отмеченные до падения посреди страницы, повторно не получат сообщение,
+            # но попадут в счётчики: те сохраняются только на границе страниц
+            processed = await get_processed_recipients(job_id, telegram_ids)
+            for status in processed.values():
+                counters[_counter_key(status)] += 1
+            results = {}
+
+            async def on_result(telegram_id, status):
+                results[telegram_id] = status
+                if len(results) >= 50:
+                    batch = dict(results)
+                    results.clear()
+                    await save_broadcast_results(job_id, batch)
+                counters[_counter_key(status)] += 1
+
+            async def recipients():
+                for telegram_id in telegram_ids:
+                    if telegram_id not in processed:
+                        yield telegram_id
+
+            await engine.run(recipients(), send, on_result=on_result)
+            await save_broadcast_results(job_id, results)
+            job = await update_broadcast_job(
+                job_id, cursor_id=str(page[-1]["id"]), heartbeat_at=datetime.utcnow().isoformat(), **counters
+            )
+            if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                await show_progress(bot, job)
+        current = await get_broadcast_job(job_id)
+        if current and current["status"] != "running":
+            return
+        job = await update_broadcast_job(job_id, status="done", finished_at=datetime.utcnow().isoformat())
+        await show_progress(bot, job)
+        if job.get("created_by"):
+            title = "Тестовая рассылка завершена" if job["audience"] == "test_admins" else "Рассылка завершена"
+            await bot.send_message(
+                job["created_by"],
+                f"{title} (#{job_id}). Успешно: {job['sent']}, ошибок: {job['failed']}, недоступны: {job['unreachable']}."
+            )
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logging.error(f"Ошибка в рассылке #{job_id}: {e}")
+        try:
+            job = await update_broadcast_job(job_id, status="failed", **counters)
+            await show_progress(bot, job)
+            if job.get("created_by"):
+                await bot.send_message(job["created_by"], f"Ошибка при рассылке #{job_id}: {e}. Её можно продолжить кнопкой «Продолжить».")
+        except Exception as e2:
+            logging.error(f"Не удалось сохранить ошибку рассылки #{job_id}: {e2}")
+    finally:
+        _tasks.pop(job_id, None)
+
+
+async def resume_broadcast_jobs(bot):
+    """Подхватывает running-рассылки, которые никто не ведёт (после рестарта или падения процесса)."""
+    try:
+        jobs = await claim_stale_broadcast_jobs(BROADCAST_JOB_LEASE)
+    except Exception as e:
+        logging.warning(f"Не удалось проверить незавершённые рассылки: {e}")
+        return
+    for job in jobs:
+        logging.info(f"Продолжаю рассылку #{job['id']} с курсора {job.get('cursor_id')}")
+        spawn_broadcast_job(bot, job)
@@ -1,6 +1,11 @@
 import os
+import time
+import asyncio
+import logging
 import httpx
+from collections import OrderedDict
 from dotenv import load_dotenv
+from .exercises import exercise_keys
 from datetime import datetime, timedelta
 
 load_dotenv()
@@ -15,12 +20,267 @@ HEADERS = {
     "Prefer": "return=representation"
 }
 
-async def get_user_by_telegram_id(telegram_id: int):
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{SUPABASE_API}/users",
+# Настройки пула соединений к Supabase (PostgREST)
+SUPABASE_HTTP2 = os.getenv("SUPABASE_HTTP2", "1") == "1"
+SUPABASE_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", "10"))
+SUPABASE_CONNECT_TIMEOUT = float(os.getenv("SUPABASE_CONNECT_TIMEOUT", "5"))
+SUPABASE_MAX_CONNECTIONS = int(os.getenv("SUPABASE_MAX_CONNECTIONS", "20"))
+SUPABASE_MAX_KEEPALIVE = int(os.getenv("SUPABASE_MAX_KEEPALIVE", "10"))
+SUPABASE_KEEPALIVE_EXPIRY = float(os.getenv("SUPABASE_KEEPALIVE_EXPIRY", "30"))
+
+# Кэш строк users в памяти процесса
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+
+# Как часто сбрасывать накопленные last_active_at (0 — писать сразу, как раньше)
+LAST_ACTIVE_FLUSH_INTERVAL = float(os.getenv("LAST_ACTIVE_FLUSH_INTERVAL", "60"))
+
+# Бэкенд доступа к данным: postgrest (Supabase REST, по умолчанию) или asyncpg (прямое подключение к Postgres)
+DB_BACKEND = os.getenv("DB_BACKEND", "postgrest")
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+# Размер страницы при постраничном обходе пользователей (рассылки, напоминания, автосписания)
+USERS_PAGE_SIZE = int(os.getenv("USERS_PAGE_SIZE", "1000"))
+
+# Выборки пользователей, которые умеют обходить оба бэкенда:
+#   all — все; paid / free — по is_paid; admins — role = admin;
+#   inactive — платные без активности с since; renewal — paid_until <= target_date и есть payment_method_id.
+# Все выборки, кроме renewal, пропускают недоступных для сообщений (blocked_at is not null).
+USER_SEGMENTS = ("all", "paid", "free", "admins", "inactive", "renewal")
+
+# Сколько последних тренировок учитывать, чтобы не повторять упражнения
+EXERCISE_HISTORY_WORKOUTS = int(os.getenv("EXERCISE_HISTORY_WORKOUTS", "10"))
+
+# Сколько выгрузок истории (telegram file_id отправленных файлов) помнить
+HISTORY_EXPORT_CACHE_SIZE = int(os.getenv("HISTORY_EXPORT_CACHE_SIZE", "2000"))
+
+# Размер страницы при выгрузке истории тренировок и питания
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "500"))
+# Колонки, которые попадают в выгрузку истории
+HISTORY_COLUMNS = {
+    "workouts": ("id", "date", "workout_type", "details", "calories_burned"),
+    "meals": ("id", "date", "description", "calories", "proteins", "fats", "carbs"),
+}
+
+RETURN_REPRESENTATION = {"Prefer": "return=representation"}
+
+
+class Repository:
+    """Интерфейс хранилища. Строки возвращаются словарями в том же виде, что отдаёт PostgREST."""
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def pool_stats(self):
+        return {}
+
+    async def get_user(self, telegram_id):
+        raise NotImplementedError
+
+    async def insert_user(self, row):
+        raise NotImplementedError
+
+    async def update_user(self, telegram_id, fields, returning=True):
+        raise NotImplementedError
+
+    async def touch_last_active(self, updates):
+        raise NotImplementedError
+
+    async def get_users_page(self, segment, after_id, limit, columns, **params):
+        """Страница пользователей выборки segment с id > after_id, отсортированная по id."""
+        raise NotImplementedError
+
+    async def count_users(self, segment, **params):
+        raise NotImplementedError
+
+    async def mark_unreachable(self, telegram_ids):
+        raise NotImplementedError
+
+    async def insert_broadcast_job(self, row):
+        raise NotImplementedError
+
+    async def get_broadcast_job(self, job_id):
+        raise NotImplementedError
+
+    async def update_broadcast_job(self, job_id, fields):
+        raise NotImplementedError
+
+    async def list_broadcast_jobs(self, limit):
+        raise NotImplementedError
+
+    async def claim_broadcast_jobs(self, stale_before, now):
+        """Забирает running-задачи без свежего heartbeat_at, проставляя heartbeat_at = now."""
+        raise NotImplementedError
+
+    async def insert_broadcast_recipients(self, rows):
+        raise NotImplementedError
+
+    async def get_processed_recipients(self, job_id, telegram_ids):
+        raise NotImplementedError
+
+    async def deactivate_expired(self, today):
+        raise NotImplementedError
+
+    async def insert_pool_workout(self, row):
+        raise NotImplementedError
+
+    async def get_pool_candidates(self, segment_key, fresh_after, exclude_exercises, limit):
+        """Свободные тренировки сегмента новее fresh_after, без упражнений из exclude_exercises."""
+        raise NotImplementedError
+
+    async def claim_pool_workout(self, pool_id, telegram_id, now):
+        """Помечает тренировку выданной; None, если её уже забрал другой запрос."""
+        raise NotImplementedError
+
+    async def get_pool_available(self, fresh_after):
+        """(segment_key, muscle_group, created_at) всех свободных свежих тренировок."""
+        raise NotImplementedError
+
+    async def delete_pool_workouts(self, created_before):
+        """Удаляет тренировки пула, созданные раньше created_before (и свободные, и выданные)."""
+        raise NotImplementedError
+
+    async def get_food_photo(self, file_unique_id):
+        raise NotImplementedError
+
+    async def find_similar_food_photo(self, dhash, max_distance):
+        raise NotImplementedError
+
+    async def save_food_photo(self, row):
+        raise NotImplementedError
+
+    async def insert_workout(self, row):
+        raise NotImplementedError
+
+    async def has_workout_type(self, user_id, workout_type):
+        raise NotImplementedError
+
+    async def get_workouts(self, user_id, limit):
+        raise NotImplementedError
+
+    async def get_workout_exercises(self, user_id, limit):
+        """Колонка exercises последних limit тренировок пользователя, от новых к старым."""
+        raise NotImplementedError
+
+    async def insert_meal(self, row):
+        raise NotImplementedError
+
+    async def get_meals(self, user_id, limit):
+        raise NotImplementedError
+
+    async def get_fsm(self, key):
+        """{"state", "data"} записи FSM или None."""
+        raise NotImplementedError
+
+    async def save_fsm(self, key, fields):
+        """Upsert записи FSM: в fields только изменённые колонки (state и/или data) и updated_by / updated_at."""
+        raise NotImplementedError
+
+    async def listen(self, channel, callback, on_reconnect=None):
+        """Подписка на NOTIFY channel: callback(payload). False, если бэкенд уведомления не поддерживает."""
+        raise NotImplementedError
+
+    async def get_history_version(self, user_id):
+        """Версия истории пользователя: число строк и max(id) в workouts и meals. Меняется при любой записи."""
+        raise NotImplementedError
+
+    async def get_history_page(self, table, user_id, date_from, date_to, after, limit):
+        """Страница workouts или meals пользователя за период (границы включительно, None — без границы),
+        отсортированная по (date, id); after — (date, id) последней строки предыдущей страницы."""
+        raise NotImplementedError
+
+
+class SupabaseRepository(Repository):
+    """Работает через PostgREST и владеет долгоживущим httpx-клиентом с пулом соединений."""
+
+    def __init__(self, api_url, headers, http2=True, timeout=10.0, connect_timeout=5.0,
+                 max_connections=20, max_keepalive=10, keepalive_expiry=30.0):
+        self.api_url = api_url
+        self.headers = headers
+        self.http2 = http2
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._client = None
+        # Метрики
+        self.requests_total = 0
+        self.errors_total = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.total_time = 0.0
+
+    @property
+    def client(self):
+        # Клиент создаётся лениво, чтобы вызовы из планировщика/вебхуков работали и без явного start()
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.api_url,
+                headers=self.headers,
+                http2=self.http2,
+                timeout=self.timeout,
+                limits=self.limits,
+            )
+        return self._client
+
+    async def start(self):
+        return self.client
+
+    async def close(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+    async def request(self, method, path, *, timeout=None, **kwargs):
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        self.requests_total += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        started = time.perf_counter()
+        try:
+            return await self.client.request(method, path, **kwargs)
+        except httpx.HTTPError:
+            self.errors_total += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            self.total_time += time.perf_counter() - started
+
+    def pool_stats(self):
+        connections = []
+        # httpx не отдаёт состояние пула публично — берём его из httpcore, если получится
+        pool = getattr(getattr(self._client, "_transport", None), "_pool", None)
+        if pool is not None:
+            connections = list(getattr(pool, "connections", []))
+        idle = 0
+        for conn in connections:
+            try:
+                if conn.is_idle():
+                    idle += 1
+            except Exception:
+                pass
+        return {
+            "connections": len(connections),
+            "idle_connections": idle,
+            "max_connections": self.limits.max_connections,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "requests_total": self.requests_total,
+            "errors_total": self.errors_total,
+            "avg_latency_ms": round(self.total_time / self.requests_total * 1000, 2) if self.requests_total else 0.0,
+        }
+
+    async def get_user(self, telegram_id):
+        resp = await self.request(
+            "GET",
+            "/users",
             params={"telegram_id": f"eq.{telegram_id}"},
-            headers=HEADERS
         )
         data = resp.json()
         print(f"DEBUG get_user_by_telegram_id: data={{}} type={{}}".format(data, type(data)))
@@ -32,15 +292,618 @@ async def get_user_by_telegram_id(telegram_id: int):
             return data
         return None
 
+    async def insert_user(self, row):
+        resp = await self.request(
+            "POST",
+            "/users",
+            headers=RETURN_REPRESENTATION,
+            json=[row],
+        )
+        data = resp.json()
+        return data[0] if data else None
+
+    async def update_user(self, telegram_id, fields, returning=True):
+        resp = await self.request(
+            "PATCH",
+            "/users",
+            params={"telegram_id": f"eq.{telegram_id}"},
+            headers=RETURN_REPRESENTATION if returning else None,
+            json=fields
+        )
+        if not returning:
+            return None
+        data = resp.json()
+        if data and isinstance(data, list) and len(data) > 0:
+            return data[0]
+        return None
+
+    async def touch_last_active(self, updates):
+        resp = await self.request("POST", "/rpc/touch_last_active", json={"updates": updates})
+        resp.raise_for_status()
+
+    @staticmethod
+    def _segment_params(segment, since=None, target_date=None):
+        reachable = {"blocked_at": "is.null"}
+        if segment == "all":
+            return reachable
+        if segment == "paid":
+            return {"is_paid": "eq.true", **reachable}
+        if segment == "free":
+            return {"is_paid": "eq.false", **reachable}
+        if segment == "admins":
+            return {"role": "eq.admin", **reachable}
+        if segment == "inactive":
+            return {"last_active_at": f"lt.{since}", "is_paid": "eq.true", **reachable}
+        if segment == "renewal":
+            return {"paid_until": f"lte.{target_date}", "payment_method_id": "not.is.null"}
+        raise ValueError(f"Неизвестная выборка пользователей: {segment}")
+
+    async def get_users_page(self, segment, after_id, limit, columns, **params):
+        query = self._segment_params(segment, **params)
+        query.update({"select": ",".join(columns), "order": "id.asc", "limit": str(limit)})
+        if after_id is not None:
+            query["id"] = f"gt.{after_id}"
+        resp = await self.request("GET", "/users", params=query)
+        resp.raise_for_status()
+        return resp.json()
+
+    async def count_users(self, segment, **params):
+        query = self._segment_params(segment, **params)
+        query.update({"select": "id", "limit": "1"})
+        resp = await self.request("GET", "/users", params=query, headers={"Prefer": "count=exact"})
+        resp.raise_for_status()
+        # Content-Range: 0-0/1234
+        total = resp.headers.get("content-range", "").rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+
+    async def mark_unreachable(self, telegram_ids):
+        ids = ",".join(str(int(t)) for t in telegram_ids)
+        resp = await self.request(
+            "PATCH",
+            "/users",
+            params={"telegram_id": f"in.({ids})"},
+            json={"blocked_at": datetime.utcnow().isoformat()},
+        )
+        resp.raise_for_status()
+
+    async def insert_broadcast_job(self, row):
+        resp = await self.request("POST", "/broadcast_jobs", headers=RETURN_REPRESENTATION, json=[row])
+        resp.raise_for_status()
+        data = resp.json()
+        return data[0] if data else None
+
+    async def get_broadcast_job(self, job_id):
+        resp = await self.request("GET", "/broadcast_jobs", params={"id": f"eq.{job_id}"})
+        resp.raise_for_status()
+        data = resp.json()
+        return data[0] if data else None
+
+    async def update_broadcast_job(self, job_id, fields):
+        resp = await self.request(
+            "PATCH",
+            "/broadcast_jobs",
+            params={"id": f"eq.{job_id}"},
+            headers=RETURN_REPRESENTATION,
+            json=fields,
+        )
+        resp.raise_for_status()
+        data = resp.json()
+        return data[0] if data else None
+
+    async def list_broadcast_jobs(self, limit):
+        resp = await self.request("GET", "/broadcast_jobs", params={"order": "id.desc", "limit": str(limit)})
+        resp.raise_for_status()
+        return resp.json()
+
+    async def claim_broadcast_jobs(self, stale_before, now):
+        resp = await self.request(
+            "PATCH",
+            "/broadcast_jobs",
+            params={"status": "eq.running", "or": f'(heartbeat_at.is.null,heartbeat_at.lt."{stale_before}")'},
+            headers=RETURN_REPRESENTATION,
+            json={"heartbeat_at": now},
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    async def insert_broadcast_recipients(self, rows):
+        resp = await self.request(
+            "POST",
+            "/broadcast_recipients",
+            headers={"Prefer": "resolution=ignore-duplicates"},
+            json=rows,
+        )
+        resp.raise_for_status()
+
+    async def get_processed_recipients(self, job_id, telegram_ids):
+        ids = ",".join(str(int(t)) for t in telegram_ids)
+        resp = await self.request(
+            "GET",
+            "/broadcast_recipients",
+            params={"job_id": f"eq.{job_id}", "telegram_id": f"in.({ids})", "select": "telegram_id,status"},
+        )
+        resp.raise_for_status()
+        return {row["telegram_id"]: row["status"] for row in resp.json()}
+
+    async def deactivate_expired(self, today):
+        # Один PATCH по фильтру, обратно получаем только telegram_id затронутых строк
+        resp = await self.request(
+            "PATCH",
+            "/users",
+            params={"paid_until": f"lt.{today}", "is_paid": "eq.true", "select": "telegram_id"},
+            headers=RETURN_REPRESENTATION,
+            json={"is_paid": False},
+            timeout=60,
+        )
+        resp.raise_for_status()
+        return [row["telegram_id"] for row in resp.json()]
+
+    async def insert_pool_workout(self, row):
+        resp = await self.request("POST", "/workout_pool", json=[row], headers={"Prefer": "return=minimal"})
+        resp.raise_for_status()
+
+    async def get_pool_candidates(self, segment_key, fresh_after, exclude_exercises, limit):
+        params = {
+            "segment_key": f"eq.{segment_key}",
+            "used_at": "is.null",
+            "created_at": f"gt.{fresh_after}",
+            "order": "created_at.asc",
+            "limit": str(limit),
+        }
+        if exclude_exercises:
+            items = ",".join('"' + e.replace("\\", "\\\\").replace('"', '\\"') + '"' for e in exclude_exercises)
+            params["exercises"] = f"not.ov.{{{items}}}"
+        resp = await self.request("GET", "/workout_pool", params=params)
+        resp.raise_for_status()
+        return resp.json()
+
+    async def claim_pool_workout(self, pool_id, telegram_id, now):
+        resp = await self.request(
+            "PATCH",
+            "/workout_pool",
+            params={"id": f"eq.{pool_id}", "used_at": "is.null"},
+            headers=RETURN_REPRESENTATION,
+            json={"used_at": now, "used_by": telegram_id},
+        )
+        resp.raise_for_status()
+        data = resp.json()
+        return data[0] if data else None
+
+    async def get_pool_available(self, fresh_after):
+        resp = await self.request(
+            "GET",
+            "/workout_pool",
+            params={"used_at": "is.null", "created_at": f"gt.{fresh_after}", "select": "segment_key,muscle_group,created_at"},
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    async def delete_pool_workouts(self, created_before):
+        resp = await self.request(
+            "DELETE",
+            "/workout_pool",
+            params={"created_at": f"lt.{created_before}", "select": "id"},
+            headers=RETURN_REPRESENTATION,
+        )
+        resp.raise_for_status()
+        return len(resp.json())
+
+    async def get_food_photo(self, file_unique_id):
+        resp = await self.request("GET", "/food_photo_cache", params={"file_unique_id": f"eq.{file_unique_id}"})
+        resp.raise_for_status()
+        data = resp.json()
+        return data[0] if data else None
+
+    async def find_similar_food_photo(self, dhash, max_distance):
+        resp = await self.request(
+            "POST", "/rpc/find_similar_food_photo", json={"target": dhash, "max_distance": max_distance}
+        )
+        resp.raise_for_status()
+        data = resp.json()
+        return data[0] if data else None
+
+    async def save_food_photo(self, row):
+        resp = await self.request(
+            "POST",
+            "/food_photo_cache",
+            headers={"Prefer": "resolution=ignore-duplicates,return=minimal"},
+            json=[row],
+        )
+        resp.raise_for_status()
+
+    async def insert_workout(self, row):
+        resp = await self.request(
+            "POST",
+            "/workouts",
+            headers=RETURN_REPRESENTATION,
+            json=[row]
+        )
+        print("add_workout status:", resp.status_code)
+        print("add_workout text:", resp.text)
+        data = resp.json()
+        return data[0] if data else None
+
+    async def has_workout_type(self, user_id, workout_type):
+        resp = await self.request(
+            "GET",
+            "/workouts",
+            params={"user_id": f"eq.{user_id}", "workout_type": f"eq.{workout_type}", "select": "id", "limit": "1"},
+        )
+        return bool(resp.json())
+
+    async def get_workouts(self, user_id, limit):
+        resp = await self.request(
+            "GET",
+            "/workouts",
+            params={
+                "user_id": f"eq.{user_id}",
+                "order": "date.desc",
+                "limit": str(limit)
+            },
+        )
+        return resp.json()
+
+    async def get_workout_exercises(self, user_id, limit):
+        resp = await self.request(
+            "GET",
+            "/workouts",
+            params={"user_id": f"eq.{user_id}", "select": "exercises", "order": "date.desc", "limit": str(limit)},
+        )
+        resp.raise_for_status()
+        return [row.get("exercises") or [] for row in resp.json()]
+
+    async def insert_meal(self, row):
+        resp = await self.request(
+            "POST",
+            "/meals",
+            headers=RETURN_REPRESENTATION,
+            json=[row]
+        )
+        return resp.status_code == 201
+
+    async def get_meals(self, user_id, limit):
+        resp = await self.request(
+            "GET",
+            "/meals",
+            params={
+                "user_id": f"eq.{user_id}",
+                "order": "date.desc",
+                "limit": str(limit)
+            },
+        )
+        return resp.json()
+
+    async def get_fsm(self, key):
+        resp = await self.request("GET", "/fsm_storage", params={"key": f"eq.{key}", "select": "state,data"})
+        resp.raise_for_status()
+        rows = resp.json()
+        return rows[0] if rows else None
+
+    async def save_fsm(self, key, fields):
+        resp = await self.request(
+            "POST",
+            "/fsm_storage",
+            params={"on_conflict": "key"},
+            headers={"Prefer": "resolution=merge-duplicates,return=minimal"},
+            json=[{"key": key, **fields}],
+        )
+        resp.raise_for_status()
+
+    async def listen(self, channel, callback, on_reconnect=None):
+        # Через PostgREST LISTEN недоступен
+        return False
+
+    async def get_history_version(self, user_id):
+        async def table_version(table):
+            resp = await self.request(
+                "GET",
+                f"/{table}",
+                params={"user_id": f"eq.{user_id}", "select": "id", "order": "id.desc", "limit": "1"},
+                headers={"Prefer": "count=exact"},
+            )
+            resp.raise_for_status()
+            rows = resp.json()
+            count = resp.headers.get("content-range", "").rpartition("/")[2]
+            return f"{count}:{rows[0]['id'] if rows else ''}"
+
+        workouts, meals = await asyncio.gather(table_version("workouts"), table_version("meals"))
+        return f"{workouts}|{meals}"
+
+    async def get_history_page(self, table, user_id, date_from, date_to, after, limit):
+        params = [
+            ("user_id", f"eq.{user_id}"),
+            ("select", ",".join(HISTORY_COLUMNS[table])),
+            ("order", "date.asc,id.asc"),
+            ("limit", str(limit)),
+        ]
+        if date_from is not None:
+            params.append(("date", f"gte.{date_from}"))
+        if date_to is not None:
+            params.append(("date", f"lte.{date_to}"))
+        if after is not None:
+            last_date, last_id = after
+            params.append(("or", f"(date.gt.{last_date},and(date.eq.{last_date},id.gt.{last_id}))"))
+        resp = await self.request("GET", f"/{table}", params=params)
+        resp.raise_for_status()
+        return resp.json()
+
+
+def create_repository():
+    if DB_BACKEND == "asyncpg":
+        from .db_pg import PostgresRepository
+        return PostgresRepository(DATABASE_URL)
+    return SupabaseRepository(
+        SUPABASE_API,
+        {k: v for k, v in HEADERS.items() if k != "Prefer"},
+        http2=SUPABASE_HTTP2,
+        timeout=SUPABASE_TIMEOUT,
+        connect_timeout=SUPABASE_CONNECT_TIMEOUT,
+        max_connections=SUPABASE_MAX_CONNECTIONS,
+        max_keepalive=SUPABASE_MAX_KEEPALIVE,
+        keepalive_expiry=SUPABASE_KEEPALIVE_EXPIRY,
+    )
+
+
+repo = create_repository()
+
+
+class UserCache:
+    """LRU-кэш строк users по telegram_id с TTL и склейкой параллельных запросов."""
+
+    def __init__(self, maxsize=10000, ttl=30.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # telegram_id -> (expires_at, row)
+        self._inflight = {}  # telegram_id -> asyncio.Task
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _key(telegram_id):
+        # telegram_id приходит и числом, и строкой (например, из metadata ЮKassa)
+        try:
+            return int(telegram_id)
+        except (TypeError, ValueError):
+            return telegram_id
+
+    def get(self, telegram_id):
+        telegram_id = self._key(telegram_id)
+        entry = self._data.get(telegram_id)
+        if entry is None:
+            return None
+        expires_at, row = entry
+        if expires_at < time.monotonic():
+            del self._data[telegram_id]
+            return None
+        self._data.move_to_end(telegram_id)
+        return row
+
+    def set(self, telegram_id, row):
+        if not row or self.maxsize <= 0 or self.ttl <= 0:
+            return
+        telegram_id = self._key(telegram_id)
+        self._data[telegram_id] = (time.monotonic() + self.ttl, dict(row))
+        self._data.move_to_end(telegram_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, telegram_id):
+        self.invalidations += 1
+        telegram_id = self._key(telegram_id)
+        self._data.pop(telegram_id, None)
+        # Запрос, начатый до изменения, не должен положить в кэш устаревшую строку
+        self._inflight.pop(telegram_id, None)
+
+    def clear(self):
+        self._data.clear()
+        self._inflight.clear()
+
+    async def get_or_load(self, telegram_id, loader):
+        row = self.get(telegram_id)
+        if row is not None:
+            self.hits += 1
+            return dict(row)
+        telegram_id = self._key(telegram_id)
+        task = self._inflight.get(telegram_id)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._load(telegram_id, loader))
+            self._inflight[telegram_id] = task
+        row = await asyncio.shield(task)
+        return dict(row) if row else row
+
+    async def _load(self, telegram_id, loader):
+        task = asyncio.current_task()
+        try:
+            row = await loader(telegram_id)
+            if self._inflight.get(telegram_id) is task:
+                self.set(telegram_id, row)
+            return row
+        finally:
+            if self._inflight.get(telegram_id) is task:
+                del self._inflight[telegram_id]
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "invalidations": self.invalidations,
+            # Сколько обращений к Supabase удалось не делать
+            "saved_requests": self.hits + self.coalesced,
+            "hit_rate": round((self.hits + self.coalesced) / lookups, 3) if lookups else 0.0,
+        }
+
+
+user_cache = UserCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+
+class HistoryExportCache:
+    """LRU telegram file_id уже отправленных выгрузок истории: (user_id, вид выгрузки) -> (версия истории, file_id).
+
+    Файл переотправляется по file_id, только если версия истории (get_history_version) не изменилась.
+    add_workout / add_meal сразу выбрасывают записи пользователя.
+    """
+
+    def __init__(self, maxsize=2000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, user_id, export_key, version):
+        key = (str(user_id), export_key)
+        entry = self._data.get(key)
+        if entry is None or version is None or entry[0] != version:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._data.move_to_end(key)
+        return entry[1]
+
+    def set(self, user_id, export_key, version, file_id):
+        if version is None or not file_id or self.maxsize <= 0:
+            return
+        key = (str(user_id), export_key)
+        self._data[key] = (version, file_id)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, user_id, export_key=None):
+        user_id = str(user_id)
+        keys = [key for key in self._data if key[0] == user_id and export_key in (None, key[1])]
+        for key in keys:
+            del self._data[key]
+        self.invalidations += len(keys)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+history_export_cache = HistoryExportCache(maxsize=HISTORY_EXPORT_CACHE_SIZE)
+
+
+class LastActiveBuffer:
+    """Копит last_active_at по telegram_id в памяти и пишет их пачкой раз в interval секунд."""
+
+    def __init__(self, interval=60.0):
+        self.interval = interval
+        self._pending = {}  # telegram_id -> iso timestamp
+        self._task = None
+        self._stopping = None
+        self.touches = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+
+    def touch(self, telegram_id, ts=None):
+        self._pending[int(telegram_id)] = ts or datetime.utcnow().isoformat()
+        self.touches += 1
+        self.start()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._stopping = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        # Остановка будит цикл через событие, а не cancel(): flush, начатый в цикле, всегда дописывается
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return 0
+        batch, self._pending = self._pending, {}
+        updates = [{"telegram_id": k, "last_active_at": v} for k, v in batch.items()]
+        try:
+            await repo.touch_last_active(updates)
+        except Exception as e:
+            logging.warning(f"Не удалось сохранить last_active_at для {len(batch)} пользователей: {e}")
+            self._requeue(batch)
+            return 0
+        except BaseException:
+            # Отмена посреди записи (выключение процесса) — пачка остаётся в буфере для следующего flush
+            self._requeue(batch)
+            raise
+        self.flushes += 1
+        self.flushed_rows += len(batch)
+        return len(batch)
+
+    def _requeue(self, batch):
+        # Возвращаем в буфер, не перетирая более свежие отметки
+        for k, v in batch.items():
+            self._pending.setdefault(k, v)
+
+    async def stop(self):
+        if self._task is not None:
+            self._stopping.set()
+            try:
+                await self._task
+            except Exception as e:
+                logging.warning(f"Фоновая запись last_active_at завершилась с ошибкой: {e}")
+            self._task = None
+        await self.flush()
+
+    def stats(self):
+        return {
+            "pending": len(self._pending),
+            "touches": self.touches,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+        }
+
+
+last_active_buffer = LastActiveBuffer(interval=LAST_ACTIVE_FLUSH_INTERVAL)
+
+async def init_db():
+    await repo.start()
+    if LAST_ACTIVE_FLUSH_INTERVAL > 0:
+        last_active_buffer.start()
+
+async def close_db():
+    # Дописываем накопленные last_active_at до закрытия клиента
+    await last_active_buffer.stop()
+    logging.info(f"Last active buffer stats: {last_active_buffer.stats()}")
+    logging.info(f"Supabase pool stats: {repo.pool_stats()}")
+    logging.info(f"User cache stats: {user_cache.stats()}")
+    await repo.close()
+
+def pool_stats():
+    return repo.pool_stats()
+
+def user_cache_stats():
+    return user_cache.stats()
+
+async def get_user_by_telegram_id(telegram_id: int):
+    return await user_cache.get_or_load(telegram_id, repo.get_user)
+
 async def create_user(telegram_id: int, username: str = None, first_name: str = None, last_name: str = None,
                      goal=None, level=None, health_issues=None, location=None, workouts_per_week=None,
                      height=None, weight=None, age=None, gender=None):
     user = await get_user_by_telegram_id(telegram_id)
     if user:
         return user
-    from datetime import datetime, timedelta
     paid_until = (datetime.utcnow() + timedelta(days=31)).isoformat()
-    payload = [{
+    payload = {
         "telegram_id": telegram_id,
         "username": username,
         "first_name": first_name,
@@ -56,30 +919,19 @@ async def create_user(telegram_id: int, username: str = None, first_name: str =
         "gender": gender,
         "is_paid": True,
         "paid_until": paid_until
-    }]
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            f"{SUPABASE_API}/users",
-            headers=HEADERS,
-            json=payload,
-        )
-        data = resp.json()
-        return data[0] if data else None
+    }
+    user = await repo.insert_user(payload)
+    user_cache.invalidate(telegram_id)
+    user_cache.set(telegram_id, user)
+    return user
 
 async def update_user_profile(telegram_id: int, **fields):
     if not fields:
         return None
-    async with httpx.AsyncClient() as client:
-        resp = await client.patch(
-            f"{SUPABASE_API}/users",
-            params={"telegram_id": f"eq.{telegram_id}"},
-            headers=HEADERS,
-            json=fields
-        )
-        data = resp.json()
-        if data and isinstance(data, list) and len(data) > 0:
-            return data[0]
-        return None
+    user = await repo.update_user(telegram_id, fields)
+    user_cache.invalidate(telegram_id)
+    user_cache.set(telegram_id, user)
+    return user
 
 async def add_workout(user_id: str, workout_type: str, details: str, date=None, calories_burned=None):
     from datetime import date as dt_date
@@ -90,44 +942,27 @@ async def add_workout(user_id: str, workout_type: str, details: str, date=None,
         "date": date,
         "workout_type": workout_type,
         "details": details,
+        # Упражнения разбираем один раз здесь, промпты читают готовый список
+        "exercises": exercise_keys(details),
     }
     if calories_burned is not None:
         data["calories_burned"] = calories_burned
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            f"{SUPABASE_API}/workouts",
-            headers=HEADERS,
-            json=[data]
-        )
-        print("add_workout status:", resp.status_code)
-        print("add_workout text:", resp.text)
-        data = resp.json()
-        return data[0] if data else None
+    result = await repo.insert_workout(data)
+    history_export_cache.invalidate(user_id)
+    return result
 
 async def has_free_trial(telegram_id: int):
     user = await get_user_by_telegram_id(telegram_id)
     if not user:
         return False
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{SUPABASE_API}/workouts",
-            params={"user_id": f"eq.{user['id']}", "workout_type": "eq.free_trial"},
-            headers=HEADERS
-        )
-        data = resp.json()
-        return bool(data)
+    return await repo.has_workout_type(user["id"], "free_trial")
 
 async def confirm_payment(telegram_id: int, days: int = 30):
     paid_until = (datetime.utcnow() + timedelta(days=days)).isoformat()
-    async with httpx.AsyncClient() as client:
-        resp = await client.patch(
-            f"{SUPABASE_API}/users",
-            params={"telegram_id": f"eq.{telegram_id}"},
-            headers=HEADERS,
-            json={"is_paid": True, "paid_until": paid_until}
-        )
-        data = resp.json()
-        return data[0] if data else None
+    user = await repo.update_user(telegram_id, {"is_paid": True, "paid_until": paid_until})
+    user_cache.invalidate(telegram_id)
+    user_cache.set(telegram_id, user)
+    return user
 
 async def add_meal(user_id: str, description: str, calories: int = None, date=None, photo_url=None, proteins=None, fats=None, carbs=None):
     from datetime import date as dt_date
@@ -148,118 +983,184 @@ async def add_meal(user_id: str, description: str, calories: int = None, date=No
         data["fats"] = fats
     if carbs is not None:
         data["carbs"] = carbs
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            f"{SUPABASE_API}/meals",
-            headers=HEADERS,
-            json=[data]
-        )
-        return resp.status_code == 201
+    result = await repo.insert_meal(data)
+    history_export_cache.invalidate(user_id)
+    return result
 
 async def update_last_active(telegram_id: int):
-    from datetime import datetime
     now = datetime.utcnow().isoformat()
-    async with httpx.AsyncClient() as client:
-        await client.patch(
-            f"{SUPABASE_API}/users",
-            params={"telegram_id": f"eq.{telegram_id}"},
-            headers=HEADERS,
-            json={"last_active_at": now}
-        )
+    if LAST_ACTIVE_FLUSH_INTERVAL > 0:
+        last_active_buffer.touch(telegram_id, now)
+        return
+    await repo.update_user(telegram_id, {"last_active_at": now, "blocked_at": None}, returning=False)
 
 async def get_user_workouts(user_id: str, limit: int = 10):
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{SUPABASE_API}/workouts",
-            params={
-                "user_id": f"eq.{user_id}",
-                "order": "date.desc",
-                "limit": str(limit)
-            },
-            headers=HEADERS
-        )
-        return resp.json()
+    return await repo.get_workouts(user_id, limit)
+
+async def get_recent_exercises(user_id: str, limit: int = EXERCISE_HISTORY_WORKOUTS):
+    """Уникальные упражнения последних limit тренировок, от новых к старым."""
+    recent = []
+    for exercises in await repo.get_workout_exercises(user_id, limit):
+        for name in exercises:
+            if name not in recent:
+                recent.append(name)
+    return recent
 
 async def get_user_meals(user_id: str, limit: int = 10):
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{SUPABASE_API}/meals",
-            params={
-                "user_id": f"eq.{user_id}",
-                "order": "date.desc",
-                "limit": str(limit)
-            },
-            headers=HEADERS
+    return await repo.get_meals(user_id, limit)
+
+async def get_history_version(user_id: str):
+    """Версия истории для кэша выгрузок или None, если узнать не удалось (тогда выгрузка строится заново)."""
+    try:
+        return await repo.get_history_version(user_id)
+    except Exception as e:
+        logging.warning(f"Не удалось получить версию истории {user_id}: {e}")
+        return None
+
+async def iter_history_pages(table, user_id, date_from=None, date_to=None, page_size=None):
+    """Постранично (keyset по date, id) отдаёт тренировки или приёмы пищи пользователя за период, от старых к новым."""
+    page_size = page_size or HISTORY_PAGE_SIZE
+    after = None
+    while True:
+        rows = await repo.get_history_page(table, user_id, date_from, date_to, after, page_size)
+        if not rows:
+            break
+        yield rows
+        after = (rows[-1]["date"], rows[-1]["id"])
+
+async def iter_user_pages(segment="all", columns=("id", "telegram_id"), page_size=None, after_id=None, **params):
+    """Постранично (keyset по id) отдаёт пользователей выборки, начиная после after_id."""
+    columns = tuple(columns)
+    if "id" not in columns:
+        columns = ("id",) + columns
+    page_size = page_size or USERS_PAGE_SIZE
+    while True:
+        rows = await repo.get_users_page(segment, after_id, page_size, columns, **params)
+        # Идём до пустой страницы: max-rows PostgREST может урезать страницу меньше page_size
+        if not rows:
+            break
+        yield rows
+        after_id = rows[-1]["id"]
+
+async def iter_users(segment="all", columns=("id", "telegram_id"), page_size=None, after_id=None, **params):
+    """Отдаёт пользователей выборки по одному, не загружая таблицу целиком."""
+    async for rows in iter_user_pages(segment, columns, page_size, after_id, **params):
+        for row in rows:
+            yield row
+
+async def count_users(segment="all", **params):
+    return await repo.count_users(segment, **params)
+
+async def mark_users_unreachable(telegram_ids):
+    """Помечает пользователей, которым не доставить сообщение, чтобы рассылки их пропускали."""
+    if telegram_ids:
+        await repo.mark_unreachable(list(telegram_ids))
+
+async def create_broadcast_job(text, audience, created_by=None, total=None):
+    now = datetime.utcnow().isoformat()
+    return await repo.insert_broadcast_job({
+        "text": text,
+        "audience": audience,
+        "status": "running",
+        "total": total,
+        "created_by": created_by,
+        "heartbeat_at": now,
+        "created_at": now,
+        "updated_at": now,
+    })
+
+async def get_broadcast_job(job_id):
+    return await repo.get_broadcast_job(job_id)
+
+async def update_broadcast_job(job_id, **fields):
+    fields["updated_at"] = datetime.utcnow().isoformat()
+    return await repo.update_broadcast_job(job_id, fields)
+
+async def list_broadcast_jobs(limit=5):
+    return await repo.list_broadcast_jobs(limit)
+
+async def claim_stale_broadcast_jobs(lease_seconds):
+    now = datetime.utcnow()
+    stale_before = (now - timedelta(seconds=lease_seconds)).isoformat()
+    return await repo.claim_broadcast_jobs(stale_before, now.isoformat())
+
+async def save_broadcast_results(job_id, results):
+    """results: {telegram_id: status}. Повторная запись того же получателя игнорируется."""
+    if results:
+        await repo.insert_broadcast_recipients(
+            [{"job_id": job_id, "telegram_id": t, "status": status} for t, status in results.items()]
         )
-        return resp.json()
+
+async def get_processed_recipients(job_id, telegram_ids):
+    """{telegram_id: status} для уже обработанных получателей из telegram_ids."""
+    if not telegram_ids:
+        return {}
+    return await repo.get_processed_recipients(job_id, telegram_ids)
+
+async def add_pool_workout(segment_key, muscle_group, workout_text, exercises):
+    await repo.insert_pool_workout({
+        "segment_key": segment_key,
+        "muscle_group": muscle_group,
+        "workout_text": workout_text,
+        "exercises": list(exercises),
+        "created_at": datetime.utcnow().isoformat(),
+    })
+
+async def take_pool_workout(segment_key, telegram_id, fresh_after, exclude_exercises=(), candidates=5):
+    """Забирает самую старую свежую тренировку сегмента без упражнений из exclude_exercises."""
+    rows = await repo.get_pool_candidates(segment_key, fresh_after, list(exclude_exercises), candidates)
+    now = datetime.utcnow().isoformat()
+    for row in rows:
+        # Кандидата мог забрать параллельный запрос — тогда пробуем следующего
+        claimed = await repo.claim_pool_workout(row["id"], telegram_id, now)
+        if claimed:
+            return claimed
+    return None
+
+async def get_pool_available(fresh_after):
+    return await repo.get_pool_available(fresh_after)
+
+async def delete_pool_workouts(created_before):
+    return await repo.delete_pool_workouts(created_before)
+
+async def get_cached_food_photo(file_unique_id):
+    return await repo.get_food_photo(file_unique_id)
+
+async def find_similar_food_photo(dhash, max_distance):
+    return await repo.find_similar_food_photo(dhash, max_distance)
+
+async def save_food_photo(file_unique_id, result, dhash=None):
+    await repo.save_food_photo({
+        "file_unique_id": file_unique_id,
+        "dhash": dhash,
+        "result": result,
+        "created_at": datetime.utcnow().isoformat(),
+    })
+
+def renewal_target_date(reminder_days: int = 3):
+    return (datetime.utcnow().date() + timedelta(days=reminder_days)).isoformat()
 
 async def get_users_for_renewal(reminder_days: int = 3):
-    url = f"{os.getenv('SUPABASE_URL')}/rest/v1/users"
-    headers = {
-        "apikey": os.getenv('SUPABASE_KEY'),
-        "Authorization": f"Bearer {os.getenv('SUPABASE_KEY')}",
-    }
-    today = datetime.utcnow().date()
-    target_date = (today + timedelta(days=reminder_days)).isoformat()
-    params = {
-        "paid_until": f"lte.{target_date}",
-        "payment_method_id": "not.is.null"
-    }
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(url, headers=headers, params=params)
-        return resp.json()
+    return [user async for user in iter_users("renewal", columns=("id", "telegram_id", "payment_method_id"), target_date=renewal_target_date(reminder_days))]
 
 async def update_subscription_until(telegram_id, new_until):
-    url = f"{os.getenv('SUPABASE_URL')}/rest/v1/users"
-    headers = {
-        "apikey": os.getenv('SUPABASE_KEY'),
-        "Authorization": f"Bearer {os.getenv('SUPABASE_KEY')}",
-        "Content-Type": "application/json"
-    }
-    data = {"paid_until": new_until.isoformat()}
-    params = {"telegram_id": f"eq.{telegram_id}"}
-    async with httpx.AsyncClient() as client:
-        await client.patch(url, headers=headers, params=params, json=data)
+    await repo.update_user(telegram_id, {"paid_until": new_until.isoformat()}, returning=False)
+    user_cache.invalidate(telegram_id)
 
 async def deactivate_expired_subscriptions():
+    """Снимает is_paid у всех с истекшей подпиской одним запросом и возвращает их telegram_id."""
     today = datetime.utcnow().date().isoformat()
-    async with httpx.AsyncClient() as client:
-        # Получаем всех пользователей с истекшей подпиской
-        resp = await client.get(
-            f"{SUPABASE_API}/users",
-            params={"paid_until": f"lt.{today}", "is_paid": "eq.true"},
-            headers=HEADERS
-        )
-        users = resp.json()
-        for user in users:
-            await client.patch(
-                f"{SUPABASE_API}/users",
-                params={"telegram_id": f"eq.{user['telegram_id']}"},
-                headers=HEADERS,
-                json={"is_paid": False}
-            )
+    telegram_ids = await repo.deactivate_expired(today)
+    for telegram_id in telegram_ids:
+        user_cache.invalidate(telegram_id)
+    logging.info(f"Деактивировано подписок: {len(telegram_ids)}")
+    return telegram_ids
 
 async def save_payment_method_id(telegram_id: int, payment_method_id: str):
-    url = f"{os.getenv('SUPABASE_URL')}/rest/v1/users"
-    headers = {
-        "apikey": os.getenv('SUPABASE_KEY'),
-        "Authorization": f"Bearer {os.getenv('SUPABASE_KEY')}",
-        "Content-Type": "application/json"
-    }
-    data = {"payment_method_id": payment_method_id}
-    params = {"telegram_id": f"eq.{telegram_id}"}
-    async with httpx.AsyncClient() as client:
-        await client.patch(url, headers=headers, params=params, json=data)
+    await repo.update_user(telegram_id, {"payment_method_id": payment_method_id}, returning=False)
+    user_cache.invalidate(telegram_id)
 
 async def remove_payment_method_id(telegram_id: int):
     """Удаляет payment_method_id у пользователя (отключение автосписания)."""
-    url = f"{os.getenv('SUPABASE_URL')}/rest/v1/users"
-    headers = {
-        "apikey": os.getenv('SUPABASE_KEY'),
-        "Authorization": f"Bearer {os.getenv('SUPABASE_KEY')}",
-        "Content-Type": "application/json"
-    }
-    data = {"payment_method_id": None}
-    params = {"telegram_id": f"eq.{telegram_id}"}
-    async with httpx.AsyncClient() as client:
-        await client.patch(url, headers=headers, params=params, json=data) 
\ No newline at end of file
+    await repo.update_user(telegram_id, {"payment_method_id": None}, returning=False)
+    user_cache.invalidate(telegram_id)
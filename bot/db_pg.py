@@ -0,0 +1,430 @@
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+from datetime import date as dt_date, datetime, timezone
+import asyncpg
+from .db import Repository, HISTORY_COLUMNS
+
+PG_POOL_MIN_SIZE = int(os.getenv("PG_POOL_MIN_SIZE", "2"))
+PG_POOL_MAX_SIZE = int(os.getenv("PG_POOL_MAX_SIZE", "10"))
+PG_COMMAND_TIMEOUT = float(os.getenv("PG_COMMAND_TIMEOUT", "10"))
+# За pgbouncer в transaction-режиме (пулер Supabase на 6543) подготовленные выражения не живут — ставьте 0
+PG_STATEMENT_CACHE_SIZE = int(os.getenv("PG_STATEMENT_CACHE_SIZE", "100"))
+
+_IDENT_RE = re.compile(r"^[a-z_][a-z0-9_]*$")
+
+
+def _columns(fields):
+    for name in fields:
+        if not _IDENT_RE.match(name):
+            raise ValueError(f"Недопустимое имя колонки: {name!r}")
+    return list(fields)
+
+
+def _as_date(value):
+    if isinstance(value, str):
+        return dt_date.fromisoformat(value[:10])
+    return value
+
+
+def _as_id(value):
+    # Курсор рассылки хранится в тексте (broadcast_jobs.cursor_id); числовой id asyncpg строкой не примет
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    return value
+
+
+def _as_datetime(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        # В проекте время хранится в UTC (datetime.utcnow)
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+class PostgresRepository(Repository):
+    """Прямой доступ к Postgres через пул asyncpg.
+
+    Запросы повторяют фильтры PostgREST. Строки собираются через to_jsonb, а записи
+    идут через jsonb_populate_record, поэтому типы приводятся так же, как в PostgREST,
+    и хендлеры получают те же словари. asyncpg сам готовит и кэширует выражения
+    на каждом соединении (statement_cache_size).
+    """
+
+    def __init__(self, dsn, min_size=PG_POOL_MIN_SIZE, max_size=PG_POOL_MAX_SIZE,
+                 command_timeout=PG_COMMAND_TIMEOUT, statement_cache_size=PG_STATEMENT_CACHE_SIZE):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.command_timeout = command_timeout
+        self.statement_cache_size = statement_cache_size
+        self._pool = None
+        self._pool_lock = asyncio.Lock()
+        # LISTEN/NOTIFY: отдельное соединение и подписки (channel, callback, on_reconnect)
+        self._listen_conn = None
+        self._listeners = []
+        self._listening = set()
+        self._closing = False
+        # Метрики
+        self.requests_total = 0
+        self.errors_total = 0
+        self.total_time = 0.0
+
+    async def start(self):
+        return await self._get_pool()
+
+    async def _get_pool(self):
+        if self._pool is None:
+            async with self._pool_lock:
+                if self._pool is None:
+                    self._pool = await asyncpg.create_pool(
+                        self.dsn,
+                        min_size=self.min_size,
+                        max_size=self.max_size,
+                        command_timeout=self.command_timeout,
+                        statement_cache_size=self.statement_cache_size,
+                    )
+        return self._pool
+
+    async def close(self):
+        self._closing = True
+        if self._listen_conn is not None:
+            await self._listen_conn.close()
+        self._listen_conn = None
+        if self._pool is not None:
+            await self._pool.close()
+        self._pool = None
+
+    def pool_stats(self):
+        pool = self._pool
+        return {
+            "connections": pool.get_size() if pool else 0,
+            "idle_connections": pool.get_idle_size() if pool else 0,
+            "max_connections": self.max_size,
+            "requests_total": self.requests_total,
+            "errors_total": self.errors_total,
+            "avg_latency_ms": round(self.total_time / self.requests_total * 1000, 2) if self.requests_total else 0.0,
+        }
+
+    async def _run(self, method, sql, *args):
+        pool = await self._get_pool()
+        self.requests_total += 1
+        started = time.perf_counter()
+        try:
+            return await getattr(pool, method)(sql, *args)
+        except Exception:
+            self.errors_total += 1
+            raise
+        finally:
+            self.total_time += time.perf_counter() - started
+
+    async def _fetch_rows(self, sql, *args):
+        rows = await self._run("fetch", sql, *args)
+        return [json.loads(r[0]) for r in rows]
+
+    async def _fetch_row(self, sql, *args):
+        value = await self._run("fetchval", sql, *args)
+        return json.loads(value) if value is not None else None
+
+    async def _insert(self, table, row):
+        cols = ", ".join(f'"{c}"' for c in _columns(row))
+        sql = (
+            f"insert into {table} ({cols}) "
+            f"select {cols} from jsonb_populate_record(null::{table}, $1::jsonb) "
+            f"returning to_jsonb({table}.*)"
+        )
+        return await self._fetch_row(sql, json.dumps(row, default=str))
+
+    async def get_user(self, telegram_id):
+        return await self._fetch_row(
+            "select to_jsonb(u) from users u where u.telegram_id = $1 limit 1",
+            int(telegram_id),
+        )
+
+    async def insert_user(self, row):
+        return await self._insert("users", row)
+
+    async def update_user(self, telegram_id, fields, returning=True):
+        assignments = ", ".join(f'"{c}" = r."{c}"' for c in _columns(fields))
+        sql = (
+            f"update users set {assignments} "
+            f"from jsonb_populate_record(null::users, $2::jsonb) r "
+            f"where users.telegram_id = $1"
+        )
+        if not returning:
+            await self._run("execute", sql, int(telegram_id), json.dumps(fields, default=str))
+            return None
+        return await self._fetch_row(
+            sql + " returning to_jsonb(users.*)",
+            int(telegram_id), json.dumps(fields, default=str),
+        )
+
+    async def touch_last_active(self, updates):
+        await self._run("execute", "select touch_last_active($1::jsonb)", json.dumps(updates))
+
+    @staticmethod
+    def _segment_where(segment, since=None, target_date=None):
+        if segment == "all":
+            return "blocked_at is null", []
+        if segment == "paid":
+            return "is_paid = true and blocked_at is null", []
+        if segment == "free":
+            return "is_paid = false and blocked_at is null", []
+        if segment == "admins":
+            return "role = 'admin' and blocked_at is null", []
+        if segment == "inactive":
+            return "last_active_at < {}::timestamptz and is_paid = true and blocked_at is null", [_as_datetime(since)]
+        if segment == "renewal":
+            return "paid_until <= {}::date and payment_method_id is not null", [_as_date(target_date)]
+        raise ValueError(f"Неизвестная выборка пользователей: {segment}")
+
+    async def get_users_page(self, segment, after_id, limit, columns, **params):
+        where, args = self._segment_where(segment, **params)
+        where = where.format(*(f"${i + 1}" for i in range(len(args))))
+        if after_id is not None:
+            args.append(_as_id(after_id))
+            where += f" and id > ${len(args)}"
+        args.append(int(limit))
+        cols = ", ".join(f'"{c}"' for c in _columns(columns))
+        sql = (
+            f"select to_jsonb(x) from (select {cols} from users where {where} "
+            f"order by id limit ${len(args)}) x"
+        )
+        return await self._fetch_rows(sql, *args)
+
+    async def count_users(self, segment, **params):
+        where, args = self._segment_where(segment, **params)
+        where = where.format(*(f"${i + 1}" for i in range(len(args))))
+        return await self._run("fetchval", f"select count(*) from users where {where}", *args)
+
+    async def mark_unreachable(self, telegram_ids):
+        await self._run(
+            "execute",
+            "update users set blocked_at = now() where telegram_id = any($1::bigint[])",
+            [int(t) for t in telegram_ids],
+        )
+
+    async def insert_broadcast_job(self, row):
+        return await self._insert("broadcast_jobs", row)
+
+    async def get_broadcast_job(self, job_id):
+        return await self._fetch_row(
+            "select to_jsonb(j) from broadcast_jobs j where j.id = $1", int(job_id)
+        )
+
+    async def update_broadcast_job(self, job_id, fields):
+        assignments = ", ".join(f'"{c}" = r."{c}"' for c in _columns(fields))
+        return await self._fetch_row(
+            f"update broadcast_jobs set {assignments} "
+            f"from jsonb_populate_record(null::broadcast_jobs, $2::jsonb) r "
+            f"where broadcast_jobs.id = $1 returning to_jsonb(broadcast_jobs.*)",
+            int(job_id), json.dumps(fields, default=str),
+        )
+
+    async def list_broadcast_jobs(self, limit):
+        return await self._fetch_rows(
+            "select to_jsonb(j) from broadcast_jobs j order by j.id desc limit $1", int(limit)
+        )
+
+    async def claim_broadcast_jobs(self, stale_before, now):
+        return await self._fetch_rows(
+            "update broadcast_jobs set heartbeat_at = $2::text::timestamptz "
+            "where status = 'running' and (heartbeat_at is null or heartbeat_at < $1::text::timestamptz) "
+            "returning to_jsonb(broadcast_jobs.*)",
+            stale_before, now,
+        )
+
+    async def insert_broadcast_recipients(self, rows):
+        await self._run(
+            "execute",
+            "insert into broadcast_recipients (job_id, telegram_id, status) "
+            "select job_id, telegram_id, status "
+            "from jsonb_populate_recordset(null::broadcast_recipients, $1::jsonb) "
+            "on conflict do nothing",
+            json.dumps(rows),
+        )
+
+    async def get_processed_recipients(self, job_id, telegram_ids):
+        rows = await self._run(
+            "fetch",
+            "select telegram_id, status from broadcast_recipients where job_id = $1 and telegram_id = any($2::bigint[])",
+            int(job_id), [int(t) for t in telegram_ids],
+        )
+        return {r["telegram_id"]: r["status"] for r in rows}
+
+    async def deactivate_expired(self, today):
+        rows = await self._run(
+            "fetch",
+            "update users set is_paid = false "
+            "where paid_until < $1::date and is_paid = true returning telegram_id",
+            _as_date(today),
+        )
+        return [r["telegram_id"] for r in rows]
+
+    async def insert_pool_workout(self, row):
+        await self._insert("workout_pool", row)
+
+    async def get_pool_candidates(self, segment_key, fresh_after, exclude_exercises, limit):
+        return await self._fetch_rows(
+            "select to_jsonb(p) from workout_pool p "
+            "where p.segment_key = $1 and p.used_at is null and p.created_at > $2::text::timestamptz "
+            "and not (p.exercises && $3::text[]) order by p.created_at limit $4",
+            segment_key, fresh_after, list(exclude_exercises), int(limit),
+        )
+
+    async def claim_pool_workout(self, pool_id, telegram_id, now):
+        return await self._fetch_row(
+            "update workout_pool set used_at = $3::text::timestamptz, used_by = $2 "
+            "where id = $1 and used_at is null returning to_jsonb(workout_pool.*)",
+            int(pool_id), int(telegram_id), now,
+        )
+
+    async def get_pool_available(self, fresh_after):
+        return await self._fetch_rows(
+            "select jsonb_build_object('segment_key', segment_key, 'muscle_group', muscle_group, 'created_at', created_at) "
+            "from workout_pool where used_at is null and created_at > $1::text::timestamptz",
+            fresh_after,
+        )
+
+    async def delete_pool_workouts(self, created_before):
+        status = await self._run(
+            "execute", "delete from workout_pool where created_at < $1::text::timestamptz", created_before
+        )
+        return int(status.split()[-1])
+
+    async def get_food_photo(self, file_unique_id):
+        return await self._fetch_row(
+            "select to_jsonb(f) from food_photo_cache f where f.file_unique_id = $1", file_unique_id
+        )
+
+    async def find_similar_food_photo(self, dhash, max_distance):
+        return await self._fetch_row(
+            "select to_jsonb(f) from find_similar_food_photo($1, $2) f", int(dhash), int(max_distance)
+        )
+
+    async def save_food_photo(self, row):
+        await self._run(
+            "execute",
+            "insert into food_photo_cache (file_unique_id, dhash, result, created_at) "
+            "select file_unique_id, dhash, result, created_at "
+            "from jsonb_populate_record(null::food_photo_cache, $1::jsonb) on conflict do nothing",
+            json.dumps(row, default=str),
+        )
+
+    async def insert_workout(self, row):
+        workout = await self._insert("workouts", row)
+        logging.debug(f"add_workout: {workout}")
+        return workout
+
+    async def has_workout_type(self, user_id, workout_type):
+        return await self._run(
+            "fetchval",
+            "select exists(select 1 from workouts where user_id = $1 and workout_type = $2)",
+            user_id, workout_type,
+        )
+
+    async def get_workouts(self, user_id, limit):
+        return await self._fetch_rows(
+            "select to_jsonb(w) from workouts w where w.user_id = $1 order by w.date desc limit $2",
+            user_id, int(limit),
+        )
+
+    async def get_workout_exercises(self, user_id, limit):
+        rows = await self._run(
+            "fetch",
+            "select exercises from workouts where user_id = $1 order by date desc limit $2",
+            user_id, int(limit),
+        )
+        return [r["exercises"] or [] for r in rows]
+
+    async def insert_meal(self, row):
+        return await self._insert("meals", row) is not None
+
+    async def get_meals(self, user_id, limit):
+        return await self._fetch_rows(
+            "select to_jsonb(m) from meals m where m.user_id = $1 order by m.date desc limit $2",
+            user_id, int(limit),
+        )
+
+    async def get_fsm(self, key):
+        return await self._fetch_row(
+            "select jsonb_build_object('state', state, 'data', data) from fsm_storage where key = $1", key
+        )
+
+    async def save_fsm(self, key, fields):
+        cols = _columns(fields)
+        names = ", ".join(f'"{c}"' for c in ["key"] + cols)
+        updates = ", ".join(f'"{c}" = excluded."{c}"' for c in cols)
+        await self._run(
+            "execute",
+            f"insert into fsm_storage ({names}) "
+            f"select {names} from jsonb_populate_record(null::fsm_storage, $1::jsonb) "
+            f"on conflict (key) do update set {updates}",
+            json.dumps({"key": key, **fields}, default=str),
+        )
+
+    async def listen(self, channel, callback, on_reconnect=None):
+        """Отдельное соединение вне пула под LISTEN; при обрыве переподключается и вызывает on_reconnect."""
+        self._listeners.append((channel, callback, on_reconnect))
+        await self._connect_listener()
+        return True
+
+    async def _connect_listener(self):
+        if self._listen_conn is not None and not self._listen_conn.is_closed():
+            conn = self._listen_conn
+        else:
+            conn = self._listen_conn = await asyncpg.connect(self.dsn)
+            conn.add_termination_listener(self._on_listener_lost)
+        for channel, callback, _ in self._listeners:
+            if channel not in self._listening:
+                await conn.add_listener(channel, lambda _conn, _pid, _channel, payload, cb=callback: cb(payload))
+                self._listening.add(channel)
+
+    def _on_listener_lost(self, conn):
+        if self._listen_conn is not conn or self._closing:
+            return
+        logging.warning("Соединение LISTEN с Postgres потеряно, переподключаемся")
+        self._listen_conn = None
+        self._listening.clear()
+        asyncio.ensure_future(self._reconnect_listener())
+
+    async def _reconnect_listener(self):
+        delay = 1
+        while not self._closing:
+            try:
+                await self._connect_listener()
+                break
+            except Exception as e:
+                logging.warning(f"Не удалось переподключить LISTEN: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+        # Пока соединения не было, уведомления терялись
+        for _, _, on_reconnect in self._listeners:
+            if on_reconnect is not None:
+                on_reconnect()
+
+    async def get_history_version(self, user_id):
+        return await self._run(
+            "fetchval",
+            "select (select count(*) || ':' || coalesce(max(id)::text, '') from workouts where user_id = $1) "
+            "|| '|' || (select count(*) || ':' || coalesce(max(id)::text, '') from meals where user_id = $1)",
+            user_id,
+        )
+
+    async def get_history_page(self, table, user_id, date_from, date_to, after, limit):
+        cols = ", ".join(f'"{c}"' for c in _columns(HISTORY_COLUMNS[table]))
+        args = [user_id, _as_date(date_from), _as_date(date_to)]
+        where = "user_id = $1 and ($2::date is null or date >= $2) and ($3::date is null or date <= $3)"
+        if after is not None:
+            args += [_as_date(after[0]), after[1]]
+            where += " and (date, id) > ($4, $5)"
+        args.append(int(limit))
+        return await self._fetch_rows(
+            f"select to_jsonb(x) from (select {cols} from {table} where {where} "
+            f"order by date, id limit ${len(args)}) x",
+            *args,
+        )
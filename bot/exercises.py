@@ -0,0 +1,30 @@
+import re
+
+# Строка упражнения в ответе модели: "1. Название упражнения"
+EXERCISE_LINE_RE = re.compile(r'\d+\.\s*([^\n]+)')
+
+
+def extract_exercise_names(details):
+    """Названия упражнений из текста тренировки в том виде, как их написала модель."""
+    exercises = []
+    for line in (details or "").split('\n'):
+        match = EXERCISE_LINE_RE.match(line)
+        if match:
+            exercises.append(match.group(1).strip())
+    return exercises
+
+
+def normalize_exercise(name):
+    """Ключ для сравнения упражнений: без регистра, markdown-звёздочек и лишних пробелов."""
+    name = name.lower().replace("ё", "е").strip(" *_.:")
+    return re.sub(r"\s+", " ", name)
+
+
+def exercise_keys(details):
+    """Уникальные нормализованные названия упражнений тренировки с сохранением порядка."""
+    keys = []
+    for name in extract_exercise_names(details):
+        key = normalize_exercise(name)
+        if key and key not in keys:
+            keys.append(key)
+    return keys
@@ -0,0 +1,122 @@
+import os
+import io
+import base64
+import asyncio
+import logging
+from .db import get_cached_food_photo, find_similar_food_photo, save_food_photo
+from .ai import analyze_food_photo_via_ai, FoodPhotoAnalysis, AIRefusal
+
+FOOD_CACHE_ENABLED = os.getenv("FOOD_CACHE_ENABLED", "1") == "1"
+# Максимальное расстояние Хэмминга между dHash (из 64 бит), при котором фото считаем тем же блюдом
+FOOD_CACHE_MAX_DISTANCE = int(os.getenv("FOOD_CACHE_MAX_DISTANCE", "4"))
+
+# Картинка для vision: при detail=low модель всё равно смотрит на 512×512, больше слать незачем
+FOOD_PHOTO_MAX_SIDE = int(os.getenv("FOOD_PHOTO_MAX_SIDE", "512"))
+FOOD_PHOTO_JPEG_QUALITY = int(os.getenv("FOOD_PHOTO_JPEG_QUALITY", "80"))
+FOOD_PHOTO_DETAIL = os.getenv("FOOD_PHOTO_DETAIL", "low")
+
+_stats = {"exact_hits": 0, "similar_hits": 0, "misses": 0, "errors": 0}
+
+
+def pick_photo_size(photos, min_side=FOOD_PHOTO_MAX_SIDE):
+    """Самый маленький из вариантов фото Telegram, который не меньше min_side по большей стороне."""
+    for size in sorted(photos, key=lambda p: max(p.width, p.height)):
+        if max(size.width, size.height) >= min_side:
+            return size
+    return photos[-1]
+
+
+def vision_data_url(image_bytes):
+    """Уменьшает фото до FOOD_PHOTO_MAX_SIDE и кодирует в data URL, чтобы OpenAI не ходил по ссылке с токеном бота."""
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+    if Image is not None:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            img.draft("RGB", (FOOD_PHOTO_MAX_SIDE, FOOD_PHOTO_MAX_SIDE))
+            img = img.convert("RGB")
+            img.thumbnail((FOOD_PHOTO_MAX_SIDE, FOOD_PHOTO_MAX_SIDE))
+            out = io.BytesIO()
+            img.save(out, "JPEG", quality=FOOD_PHOTO_JPEG_QUALITY, optimize=True)
+            image_bytes = out.getvalue()
+    return "data:image/jpeg;base64," + base64.b64encode(image_bytes).decode("ascii")
+
+
+def prepare_photo(image_bytes):
+    # Хеш и картинка для модели считаются за один заход в поток
+    return dhash(image_bytes), vision_data_url(image_bytes)
+
+
+def dhash(image_bytes, size=8):
+    """64-битный difference hash как знаковое число (колонка bigint). None, если Pillow не установлен."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        # draft() позволяет JPEG-декодеру сразу выдать уменьшенную картинку
+        img.draft("L", (size * 4, size * 4))
+        pixels = list(img.convert("L").resize((size + 1, size)).getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _from_cache(result):
+    # Записи, сохранённые до structured outputs, могут быть без части полей
+    try:
+        return FoodPhotoAnalysis.model_validate({field: result.get(field) for field in FoodPhotoAnalysis.model_fields})
+    except Exception as e:
+        logging.warning(f"Некорректная запись в кэше фото еды: {e}")
+        return None
+
+
+async def _cached(coro):
+    # Ошибки кэша не должны ломать анализ фото
+    try:
+        return await coro
+    except Exception as e:
+        _stats["errors"] += 1
+        logging.warning(f"Ошибка кэша фото еды: {e}")
+        return None
+
+
+async def analyze_food_photo(bot, photos):
+    """Анализ фото еды с кэшем. photos — message.photo. Возвращает (FoodPhotoAnalysis, None)
+    или (None, текст отказа модели). Повторы одного и того же фото в модель не отправляются.
+    """
+    photo = pick_photo_size(photos)
+    if FOOD_CACHE_ENABLED:
+        cached = await _cached(get_cached_food_photo(photo.file_unique_id))
+        meal = _from_cache(cached["result"]) if cached else None
+        if meal is not None:
+            _stats["exact_hits"] += 1
+            return meal, None
+    file = await bot.get_file(photo.file_id)
+    image = await bot.download_file(file.file_path)
+    image_hash, image_url = await asyncio.to_thread(prepare_photo, image.getvalue())
+    if FOOD_CACHE_ENABLED and image_hash is not None and FOOD_CACHE_MAX_DISTANCE >= 0:
+        similar = await _cached(find_similar_food_photo(image_hash, FOOD_CACHE_MAX_DISTANCE))
+        meal = _from_cache(similar["result"]) if similar else None
+        if meal is not None:
+            _stats["similar_hits"] += 1
+            # Запоминаем и этот file_unique_id, чтобы следующий повтор нашёлся точным совпадением
+            await _cached(save_food_photo(photo.file_unique_id, meal.model_dump(), image_hash))
+            return meal, None
+    _stats["misses"] += 1
+    try:
+        result = await analyze_food_photo_via_ai(image_url, detail=FOOD_PHOTO_DETAIL)
+    except AIRefusal as e:
+        return None, str(e)
+    if FOOD_CACHE_ENABLED and result.description.strip():
+        await _cached(save_food_photo(photo.file_unique_id, result.model_dump(), image_hash))
+    return result, None
+
+
+def food_cache_stats():
+    return dict(_stats)
@@ -0,0 +1,134 @@
+import os
+import copy
+import uuid
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from aiogram.fsm.storage.memory import MemoryStorage
+from .db import repo, DB_BACKEND
+
+# memory — MemoryStorage aiogram (состояния теряются при рестарте), db — таблица fsm_storage,
+# auto — db только с бэкендом asyncpg: без NOTIFY (PostgREST) кэш выключен и каждая проверка
+# состояния стала бы HTTP-запросом в Supabase, поэтому там остаётся MemoryStorage
+FSM_STORAGE = os.getenv("FSM_STORAGE", "auto")
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+FSM_NOTIFY_CHANNEL = "fsm_storage"
+
+
+class DatabaseStorage(BaseStorage):
+    """FSM в таблице fsm_storage с локальным LRU и записью насквозь.
+
+    Чтение берёт состояние из кэша процесса, запись сразу уходит в БД. Остальные процессы узнают
+    об изменении по NOTIFY (триггер на fsm_storage) и выбрасывают ключ из своего кэша.
+    Без NOTIFY (FSM_STORAGE=db с бэкендом PostgREST) кэш выключен и каждое чтение идёт в БД:
+    иначе процесс мог бы видеть устаревшее состояние, записанное другим процессом.
+    """
+
+    def __init__(self, maxsize=FSM_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.key_builder = DefaultKeyBuilder()
+        # Метка процесса в updated_by: свои уведомления не сбрасывают только что записанный кэш
+        self.origin = uuid.uuid4().hex[:12]
+        self._data = OrderedDict()  # key -> (state, data)
+        self._notified = False
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.invalidations = 0
+
+    async def start(self):
+        try:
+            self._notified = await repo.listen(FSM_NOTIFY_CHANNEL, self._on_notify, on_reconnect=self._data.clear)
+        except Exception as e:
+            logging.warning(f"Не удалось подписаться на {FSM_NOTIFY_CHANNEL}: {e}")
+            self._notified = False
+        if not self._notified:
+            self._data.clear()
+            logging.warning("FSM: уведомления недоступны, локальный кэш выключен, состояния читаются из БД")
+
+    def _on_notify(self, payload):
+        origin, _, key = payload.partition("|")
+        if origin != self.origin and self._data.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def _cached(self, key):
+        entry = self._data.get(key)
+        if entry is not None:
+            self._data.move_to_end(key)
+        return entry
+
+    def _remember(self, key, state, data):
+        if self.maxsize <= 0 or not self._notified:
+            return
+        self._data[key] = (state, data)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def _load(self, key):
+        entry = self._cached(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        row = await repo.get_fsm(key)
+        state, data = (row["state"], row["data"] or {}) if row else (None, {})
+        self._remember(key, state, data)
+        return state, data
+
+    async def _save(self, key, **fields):
+        self.writes += 1
+        await repo.save_fsm(key, {**fields, "updated_by": self.origin, "updated_at": datetime.utcnow().isoformat()})
+
+    def _update_cached(self, key, **fields):
+        # Вторую половину записи (state или data) знаем только из кэша; если её там нет — прочитаем из БД потом
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            state, data = entry
+            self._remember(key, fields.get("state", state), fields.get("data", data))
+
+    async def set_state(self, key, state=None):
+        key = self.key_builder.build(key)
+        state = state.state if isinstance(state, State) else state
+        await self._save(key, state=state)
+        self._update_cached(key, state=state)
+
+    async def get_state(self, key):
+        state, _ = await self._load(self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key, data):
+        key = self.key_builder.build(key)
+        if not isinstance(data, dict):
+            raise TypeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        data = copy.deepcopy(data)
+        await self._save(key, data=data)
+        self._update_cached(key, data=data)
+
+    async def get_data(self, key):
+        _, data = await self._load(self.key_builder.build(key))
+        # Хендлеры меняют полученный словарь на месте — кэш не должен меняться вместе с ним
+        return copy.deepcopy(data)
+
+    async def close(self):
+        logging.info(f"FSM storage stats: {self.stats()}")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "invalidations": self.invalidations,
+            "notify": self._notified,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+def create_storage():
+    if FSM_STORAGE == "memory" or (FSM_STORAGE == "auto" and DB_BACKEND != "asyncpg"):
+        return MemoryStorage()
+    return DatabaseStorage()
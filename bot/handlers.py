@@ -1,27 +1,34 @@
 # Здесь будут хендлеры для пользовательских команд и сообщений 
-import json
 import os
+import re
 from aiogram import types, F
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup, default_state
 from .db import (
     create_user, update_user_profile, get_user_by_telegram_id, add_workout, confirm_payment, add_meal, update_last_active,
-    get_user_workouts, get_user_meals, remove_payment_method_id
+    get_user_workouts, get_user_meals, remove_payment_method_id, get_history_version, history_export_cache
 )
-from .ai import ask_gpt, generate_workout_via_ai, analyze_food_photo_via_ai, generate_workout_via_ai_with_history
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, FSInputFile
-from aiogram.types import BufferedInputFile
-import io
-import openpyxl
-from openpyxl.styles import Font, Alignment, Border, Side
-import httpx
+from .ai import generate_workout_via_ai, regenerate_workout_via_ai
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.types import BufferedInputFile, FSInputFile
 from .payments import create_payment_link
-from datetime import datetime
-import random
+from .media import media, WELCOME_IMAGE, random_workout_image
+from .workout_pool import take_pooled_workout, workout_pool_report
+from .food_cache import analyze_food_photo
+from .intent_router import route_message, intent_router_report
+from .history_export import export_history_xlsx, export_history_file
+from .prompts import add_rejected_exercises
+from .update_queue import answer_callback
+from datetime import datetime, timedelta
+import time
 
 SUBSCRIPTION_AMOUNT = os.getenv("SUBSCRIPTION_AMOUNT", "800")
 MANAGER_NICK = os.getenv("MANAGER_NICK", "@your_manager")
+# Стриминг тренировки: сообщение ожидания правится не чаще раза в интервал и не раньше, чем наберётся N символов
+WORKOUT_STREAM_EDIT_INTERVAL = float(os.getenv("WORKOUT_STREAM_EDIT_INTERVAL", "1.5"))
+WORKOUT_STREAM_EDIT_CHARS = int(os.getenv("WORKOUT_STREAM_EDIT_CHARS", "40"))
 
 MAIN_MENU = ReplyKeyboardMarkup(
     keyboard=[
@@ -49,10 +56,8 @@ class ProfileStates(StatesGroup):
 class CaloriesStates(StatesGroup):
     waiting_for_photo = State()
 
-class PushStates(StatesGroup):
-    waiting_for_text = State()
-    waiting_for_audience = State()
-    waiting_for_confirm = State()
+class HistoryStates(StatesGroup):
+    waiting_for_period = State()
 
 WORKOUT_STATE = "workout_state"
 
@@ -66,35 +71,93 @@ def is_positive_int(text):
     except (ValueError, TypeError):
         return False
 
-async def require_payment(message: types.Message, user=None):
-    if user is None:
-        user = await get_user_by_telegram_id(message.from_user.id)
-    if not user or not user.get("is_paid"):
-        await message.answer(f"Эта функция доступна только после оплаты подписки (стоимость {SUBSCRIPTION_AMOUNT}₽). Используй /pay для получения доступа.")
-        return False
-    # Новая проверка даты окончания подписки
-    paid_until = user.get("paid_until")
+def is_subscription_expired(user):
+    paid_until = user.get("paid_until") if user else None
     if paid_until:
         try:
             paid_until_date = datetime.fromisoformat(paid_until)
-            if paid_until_date < datetime.utcnow():
-                await message.answer("Ваша подписка истекла. Оформите новую для доступа к функциям с помощью /pay")
-                return False
+            return paid_until_date < datetime.utcnow()
         except Exception:
             pass
+    return False
+
+def has_active_subscription(user):
+    return bool(user and user.get("is_paid")) and not is_subscription_expired(user)
+
+def is_admin_user(user):
+    return bool(user and user.get("role") == "admin")
+
+async def require_payment(message: types.Message, user):
+    # user приходит из UserContextMiddleware, повторно в Supabase не ходим
+    if not user or not user.get("is_paid"):
+        await message.answer(f"Эта функция доступна только после оплаты подписки (стоимость {SUBSCRIPTION_AMOUNT}₽). Используй /pay для получения доступа.")
+        return False
+    # Новая проверка даты окончания подписки
+    if is_subscription_expired(user):
+        await message.answer("Ваша подписка истекла. Оформите новую для доступа к функциям с помощью /pay")
+        return False
     return True
 
+def format_amount(value, empty="—"):
+    # 350.0 -> "350", 12.5 -> "12.5", None -> empty
+    if value is None:
+        return empty
+    return f"{value:g}" if isinstance(value, float) else str(value)
+
+def split_workout_text(workout_text):
+    """Делит ответ модели на подпись к картинке (заголовок + совет по питанию) и текст упражнений."""
+    lines = workout_text.strip().splitlines()
+    header_lines = []
+    body_lines = []
+    found_body = False
+    nutrition_advice = None
+    for line in lines:
+        if not found_body:
+            header_lines.append(line)
+            if line.strip().lower().startswith("план тренировки на сегодня"):
+                found_body = True
+        else:
+            # Ищем совет по питанию
+            if line.strip().lower().startswith("совет по питанию"):
+                nutrition_advice = line.strip()
+            else:
+                body_lines.append(line)
+    header = "\n".join(header_lines).strip()
+    if nutrition_advice:
+        header = f"{header}\n\n{nutrition_advice}"
+    body = "\n".join(body_lines).strip()
+    return header, body
+
+def stream_to_message(wait_msg):
+    """on_partial для генерации тренировки: показывает текст по мере генерации в сообщении ожидания.
+
+    Правки троттлятся, чтобы не упереться в лимиты Telegram на editMessageText.
+    """
+    state = {"edited_at": 0.0, "shown": 0}
+
+    async def on_partial(text):
+        now = time.monotonic()
+        if len(text) - state["shown"] < WORKOUT_STREAM_EDIT_CHARS or now - state["edited_at"] < WORKOUT_STREAM_EDIT_INTERVAL:
+            return
+        state["edited_at"] = now
+        state["shown"] = len(text)
+        try:
+            # Лимит сообщения Telegram — 4096 символов
+            await wait_msg.edit_text(text[-4000:] + " …")
+        except Exception as e:
+            print(f"Ошибка при обновлении wait_msg: {e}")
+
+    return on_partial
+
 # --- Хендлеры ---
 from aiogram import Router
 router = Router()
 
 @router.message(Command("start"))
-async def cmd_start(message: types.Message, state: FSMContext):
+async def cmd_start(message: types.Message, state: FSMContext, user=None, menu=MAIN_MENU):
     await mark_active(message)
     wait_msg = await message.answer("Обрабатываю, пожалуйста, подождите...")
     try:
-        user = await get_user_by_telegram_id(message.from_user.id)
-        menu = await get_main_menu(message.from_user.id)
         if not user or not user.get("is_paid"):
             user = await create_user(
                 telegram_id=message.from_user.id,
@@ -112,11 +175,10 @@ async def cmd_start(message: types.Message, state: FSMContext):
                 gender=None
             )
             # Отправляем приветственную картинку и текст
-            welcome_image_path = "bot/images/welcome.jpg"  # или png, если у тебя другой формат
             try:
-                photo = FSInputFile(welcome_image_path)
-                await message.answer_photo(
-                    photo,
+                await media.answer_photo(
+                    message,
+                    WELCOME_IMAGE,
                     caption=(
                         "Добро пожаловать в SUPERFIT — твой персональный помощник в мире фитнеса и здорового питания!\n\n"
                         "💪 Что я умею?\n\n"
@@ -268,10 +330,10 @@ async def process_gender(message: types.Message, state: FSMContext):
         print(f"Ошибка в анкете (gender): {e}")
 
 @router.callback_query(lambda c: c.data in ["profile_confirm", "profile_restart"])
-async def profile_confirm_callback(callback_query: types.CallbackQuery, state: FSMContext):
+async def profile_confirm_callback(callback_query: types.CallbackQuery, state: FSMContext, user=None, menu=MAIN_MENU):
     try:
         # Сразу отвечаем на callback, чтобы Telegram не ругался на долгие операции
-        await callback_query.answer()
+        await answer_callback(callback_query)
         current_state = await state.get_state()
         # Если состояние уже очищено, игнорируем повторный callback
         if not current_state or current_state != "profile_confirm_wait":
@@ -280,7 +342,7 @@ async def profile_confirm_callback(callback_query: types.CallbackQuery, state: F
         data = await state.get_data()
         print(f"DEBUG profile_confirm_callback FSMContext: {data}")
         if callback_query.data == "profile_confirm":
-            await update_user_profile(
+            updated_user = await update_user_profile(
                 telegram_id=callback_query.from_user.id,
                 goal=data.get("goal"),
                 level=data.get("level"),
@@ -292,7 +354,7 @@ async def profile_confirm_callback(callback_query: types.CallbackQuery, state: F
                 age=data.get("age"),
                 gender=data.get("gender"),
             )
-            user = await get_user_by_telegram_id(callback_query.from_user.id)
+            user = updated_user or user
             # Удаляем сообщение с кнопками, чтобы нельзя было кликнуть повторно
             try:
                 await callback_query.message.delete()
@@ -301,7 +363,7 @@ async def profile_confirm_callback(callback_query: types.CallbackQuery, state: F
             await state.clear()
             # UX: показываем сообщение об ожидании
             wait_msg = await callback_query.message.answer("Обрабатываю, пожалуйста, подождите...")
-            workout_text = await generate_workout_via_ai(user)
+            workout_text = await generate_workout_via_ai(user, on_partial=stream_to_message(wait_msg))
             if not workout_text or not workout_text.strip():
                 try:
                     await wait_msg.delete()
@@ -317,39 +379,10 @@ async def profile_confirm_callback(callback_query: types.CallbackQuery, state: F
             except Exception as e:
                 print(f"Ошибка при удалении wait_msg: {e}")
             # Парсим заголовок, упражнения и совет по питанию
-            lines = workout_text.strip().splitlines()
-            header_lines = []
-            body_lines = []
-            found_body = False
-            nutrition_advice = None
-            for line in lines:
-                if not found_body:
-                    header_lines.append(line)
-                    if line.strip().lower().startswith("план тренировки на сегодня"):
-                        found_body = True
-                else:
-                    # Ищем совет по питанию
-                    if line.strip().lower().startswith("совет по питанию"):
-                        nutrition_advice = line.strip()
-                    else:
-                        body_lines.append(line)
-            header = "\n".join(header_lines).strip()
-            if nutrition_advice:
-                header = f"{header}\n\n{nutrition_advice}"
-            body = "\n".join(body_lines).strip()
-            # Картинки для тренировок
-            workout_images = [
-                "bot/images/workouts/rndm_1.png",
-                "bot/images/workouts/rndm_2.png",
-                "bot/images/workouts/rndm_3.png",
-                "bot/images/workouts/rndm_4.png",
-                "bot/images/workouts/rndm_5.png"
-            ]
+            header, body = split_workout_text(workout_text)
             image_msg = None
             try:
-                chosen_image = random.choice(workout_images)
-                photo = FSInputFile(chosen_image)
-                image_msg = await callback_query.message.answer_photo(photo, caption=header)
+                image_msg = await media.answer_photo(callback_query.message, random_workout_image(), caption=header)
             except Exception as e:
                 print(f"Ошибка при отправке картинки тренировки: {e}")
             kb = InlineKeyboardMarkup(
@@ -366,12 +399,12 @@ async def profile_confirm_callback(callback_query: types.CallbackQuery, state: F
             )
             await state.update_data(
                 workout_text=workout_text,
-                workout_history=[{"role": "user", "content": "Запрос тренировки"}, {"role": "assistant", "content": workout_text}],
+                rejected_exercises=[],
                 is_busy=False,
                 workout_image_msg_id=image_msg.message_id if image_msg else None,
                 workout_text_msg_id=text_msg.message_id
             )
-            await callback_query.message.answer("Меню доступно ниже 👇", reply_markup=await get_main_menu(callback_query.from_user.id))
+            await callback_query.message.answer("Меню доступно ниже 👇", reply_markup=menu)
         else:
             # Полностью очищаем FSMContext перед повторным прохождением анкеты
             # Удаляем сообщения тренировки, если они есть
@@ -409,9 +442,8 @@ async def cmd_pay(message: types.Message):
         print(f"Ошибка в /pay: {e}")
 
 @router.message(Command("confirm_payment"))
-async def cmd_confirm_payment(message: types.Message):
-    user = await get_user_by_telegram_id(message.from_user.id)
-    if not user or user.get("role") != "admin":
+async def cmd_confirm_payment(message: types.Message, is_admin=False):
+    if not is_admin:
         await message.answer("Нет доступа. Только для админов.")
         return
     parts = message.text.strip().split()
@@ -429,10 +461,10 @@ async def cmd_confirm_payment(message: types.Message):
 async def process_pay_link(callback_query: types.CallbackQuery):
     pay_url = "https://yookassa.ru/pay/demo-link"
     await callback_query.message.answer(f"Для доступа ко всем функциям бота оплати подписку (стоимость {SUBSCRIPTION_AMOUNT}₽) по ссылке: {pay_url}\n\nПосле оплаты напиши администратору или дождись подтверждения.")
-    await callback_query.answer()
+    await answer_callback(callback_query)
 
 @router.message(F.text == "Получить новую тренировку")
-async def get_new_workout(message: types.Message, state: FSMContext):
+async def get_new_workout(message: types.Message, state: FSMContext, user=None):
     # Проверка на занятость
     data = await state.get_data()
     if data.get("is_busy"):
@@ -444,7 +476,6 @@ async def get_new_workout(message: types.Message, state: FSMContext):
     # UX: показываем сообщение об ожидании
     wait_msg = await message.answer("Обрабатываю, пожалуйста, подождите...")
     try:
-        user = await get_user_by_telegram_id(message.from_user.id)
         if not await require_payment(message, user):
             await state.update_data(is_busy=False)
             try:
@@ -452,7 +483,10 @@ async def get_new_workout(message: types.Message, state: FSMContext):
             except Exception as e:
                 print(f"Ошибка при удалении wait_msg: {e}")
             return
-        workout_text = await generate_workout_via_ai(user)
+        # Сначала готовая тренировка из пула сегмента, генерация — только при промахе
+        workout_text = await take_pooled_workout(user)
+        if not workout_text:
+            workout_text = await generate_workout_via_ai(user, on_partial=stream_to_message(wait_msg))
         if not workout_text or not workout_text.strip():
             try:
                 await wait_msg.delete()
@@ -465,39 +499,10 @@ async def get_new_workout(message: types.Message, state: FSMContext):
             await state.update_data(is_busy=False)
             return
         # Парсим заголовок, упражнения и совет по питанию
-        lines = workout_text.strip().splitlines()
-        header_lines = []
-        body_lines = []
-        found_body = False
-        nutrition_advice = None
-        for line in lines:
-            if not found_body:
-                header_lines.append(line)
-                if line.strip().lower().startswith("план тренировки на сегодня"):
-                    found_body = True
-            else:
-                # Ищем совет по питанию
-                if line.strip().lower().startswith("совет по питанию"):
-                    nutrition_advice = line.strip()
-                else:
-                    body_lines.append(line)
-        header = "\n".join(header_lines).strip()
-        if nutrition_advice:
-            header = f"{header}\n\n{nutrition_advice}"
-        body = "\n".join(body_lines).strip()
-        # Картинки для тренировок
-        workout_images = [
-            "bot/images/workouts/rndm_1.png",
-            "bot/images/workouts/rndm_2.png",
-            "bot/images/workouts/rndm_3.png",
-            "bot/images/workouts/rndm_4.png",
-            "bot/images/workouts/rndm_5.png"
-        ]
+        header, body = split_workout_text(workout_text)
         image_msg = None
         try:
-            chosen_image = random.choice(workout_images)
-            photo = FSInputFile(chosen_image)
-            image_msg = await message.answer_photo(photo, caption=header)
+            image_msg = await media.answer_photo(message, random_workout_image(), caption=header)
         except Exception as e:
             print(f"Ошибка при отправке картинки тренировки: {e}")
         # Кнопки
@@ -520,7 +525,7 @@ async def get_new_workout(message: types.Message, state: FSMContext):
         text_msg = await message.answer(body, reply_markup=kb)
         await state.update_data(
             workout_text=workout_text,
-            workout_history=[{"role": "user", "content": "Запрос тренировки"}, {"role": "assistant", "content": workout_text}],
+            rejected_exercises=[],
             is_busy=False,
             workout_image_msg_id=image_msg.message_id if image_msg else None,
             workout_text_msg_id=text_msg.message_id
@@ -535,9 +540,13 @@ async def get_new_workout(message: types.Message, state: FSMContext):
         await state.update_data(is_busy=False)
 
 @router.callback_query(lambda c: c.data == "workout_done")
-async def workout_done_callback(callback_query: types.CallbackQuery, state: FSMContext):
+async def workout_done_callback(callback_query: types.CallbackQuery, state: FSMContext, user=None):
     # Сразу отвечаем на callback, чтобы Telegram не ругался на долгие операции
-    await callback_query.answer()
+    await answer_callback(callback_query)
+    if not user:
+        # Middleware не смог загрузить пользователя — тренировку сохранить некуда, состояние оставляем для повтора
+        await callback_query.message.answer("Не удалось сохранить тренировку, попробуй нажать «Выполнил» ещё раз чуть позже.")
+        return
     data = await state.get_data()
     workout_text = data.get("workout_text")
     image_msg_id = data.get("workout_image_msg_id")
@@ -549,7 +558,6 @@ async def workout_done_callback(callback_query: types.CallbackQuery, state: FSMC
         )
         await state.clear()
         return
-    user = await get_user_by_telegram_id(callback_query.from_user.id)
     # Сохраняем только последнюю подтверждённую тренировку
     await add_workout(
         user_id=user["id"],
@@ -568,8 +576,8 @@ async def workout_done_callback(callback_query: types.CallbackQuery, state: FSMC
     await state.clear()
 
 @router.callback_query(lambda c: c.data == "workout_change")
-async def workout_change_callback(callback_query: types.CallbackQuery, state: FSMContext):
-    await callback_query.answer()
+async def workout_change_callback(callback_query: types.CallbackQuery, state: FSMContext, user=None):
+    await answer_callback(callback_query)
     data = await state.get_data()
     if data.get("is_busy"):
         await callback_query.message.answer("Генерация уже выполняется, подождите...")
@@ -578,46 +586,14 @@ async def workout_change_callback(callback_query: types.CallbackQuery, state: FS
     # UX: показываем сообщение об ожидании
     wait_msg = await callback_query.message.answer("Обрабатываю, пожалуйста, подождите...")
     try:
-        user = await get_user_by_telegram_id(callback_query.from_user.id)
-        workout_history = data.get("workout_history", [])
-        # Добавляем сообщение пользователя о недовольстве
-        workout_history.append({"role": "user", "content": "Не нравится, давай другую тренировку."})
-        # Формируем промпт для новой тренировки с историей
-        new_workout_text = await generate_workout_via_ai_with_history(user, workout_history)
+        # Текущая тренировка не понравилась: её упражнения добавляются к отклонённым (в пределах бюджета токенов)
+        rejected_exercises = add_rejected_exercises(data.get("rejected_exercises"), data.get("workout_text"))
+        new_workout_text = await regenerate_workout_via_ai(user, rejected_exercises, on_partial=stream_to_message(wait_msg))
         # Парсим заголовок, упражнения и совет по питанию
-        lines = new_workout_text.strip().splitlines()
-        header_lines = []
-        body_lines = []
-        found_body = False
-        nutrition_advice = None
-        for line in lines:
-            if not found_body:
-                header_lines.append(line)
-                if line.strip().lower().startswith("план тренировки на сегодня"):
-                    found_body = True
-            else:
-                # Ищем совет по питанию
-                if line.strip().lower().startswith("совет по питанию"):
-                    nutrition_advice = line.strip()
-                else:
-                    body_lines.append(line)
-        header = "\n".join(header_lines).strip()
-        if nutrition_advice:
-            header = f"{header}\n\n{nutrition_advice}"
-        body = "\n".join(body_lines).strip()
-        # Картинки для тренировок
-        workout_images = [
-            "bot/images/workouts/rndm_1.png",
-            "bot/images/workouts/rndm_2.png",
-            "bot/images/workouts/rndm_3.png",
-            "bot/images/workouts/rndm_4.png",
-            "bot/images/workouts/rndm_5.png"
-        ]
+        header, body = split_workout_text(new_workout_text)
         image_msg = None
         try:
-            chosen_image = random.choice(workout_images)
-            photo = FSInputFile(chosen_image)
-            image_msg = await callback_query.message.answer_photo(photo, caption=header)
+            image_msg = await media.answer_photo(callback_query.message, random_workout_image(), caption=header)
         except Exception as e:
             print(f"Ошибка при отправке картинки тренировки: {e}")
         # Кнопки
@@ -632,11 +608,9 @@ async def workout_change_callback(callback_query: types.CallbackQuery, state: FS
         except Exception as e:
             print(f"Ошибка при удалении wait_msg: {e}")
         text_msg = await callback_query.message.answer(body, reply_markup=kb)
-        # Обновляем историю
-        workout_history.append({"role": "assistant", "content": new_workout_text})
         await state.update_data(
             workout_text=new_workout_text,
-            workout_history=workout_history,
+            rejected_exercises=rejected_exercises,
             is_busy=False,
             workout_image_msg_id=image_msg.message_id if image_msg else None,
             workout_text_msg_id=text_msg.message_id
@@ -661,7 +635,7 @@ async def workout_change_callback(callback_query: types.CallbackQuery, state: FS
         await state.update_data(is_busy=False)
 
 @router.message(F.text == "Подсчет калорий")
-async def start_calories(message: types.Message, state: FSMContext):
+async def start_calories(message: types.Message, state: FSMContext, user=None):
     # Проверка на занятость
     data = await state.get_data()
     if data.get("is_busy"):
@@ -671,7 +645,6 @@ async def start_calories(message: types.Message, state: FSMContext):
     await state.clear()
     await mark_active(message)
     try:
-        user = await get_user_by_telegram_id(message.from_user.id)
         if not await require_payment(message, user):
             await state.update_data(is_busy=False)
             return
@@ -685,7 +658,7 @@ async def start_calories(message: types.Message, state: FSMContext):
         await state.update_data(is_busy=False)
 
 @router.message(CaloriesStates.waiting_for_photo, F.photo)
-async def process_calories_photo(message: types.Message, state: FSMContext):
+async def process_calories_photo(message: types.Message, state: FSMContext, user=None):
     # Проверка на занятость
     data = await state.get_data()
     if data.get("is_busy"):
@@ -696,63 +669,42 @@ async def process_calories_photo(message: types.Message, state: FSMContext):
     # UX: показываем сообщение об ожидании
     wait_msg = await message.answer("Анализирую фото, пожалуйста, подождите...")
     try:
-        user = await get_user_by_telegram_id(message.from_user.id)
-        photo = message.photo[-1]
-        file = await message.bot.get_file(photo.file_id)
-        file_path = file.file_path
-        TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-        file_url = f'https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{file_path}'
-        gpt_response = await analyze_food_photo_via_ai(file_url)
-        # Пытаемся найти JSON в ответе
-        json_start = gpt_response.find('{')
-        json_end = gpt_response.rfind('}')
-        if json_start != -1 and json_end != -1 and json_end > json_start:
+        # Повторно присланное фото берётся из кэша, без запроса к модели
+        meal, refusal = await analyze_food_photo(message.bot, message.photo)
+        if meal is None:
             try:
-                data = json.loads(gpt_response[json_start:json_end+1])
-                desc = data.get("description", "Фото еды")
-                if not desc or not desc.strip():
-                    try:
-                        await wait_msg.delete()
-                    except Exception as e:
-                        print(f"Ошибка при удалении wait_msg: {e}")
-                    await message.answer(
-                        "Не удалось сохранить приём пищи: описание отсутствует. Попробуйте ещё раз.",
-                        reply_markup=MAIN_MENU
-                    )
-                    await state.clear()
-                    await state.update_data(is_busy=False)
-                    return
-                await add_meal(
-                    user_id=user["id"],
-                    description=desc,
-                    calories=data.get("calories"),
-                    proteins=data.get("proteins"),
-                    fats=data.get("fats"),
-                    carbs=data.get("carbs")
-                )
-                try:
-                    await wait_msg.delete()
-                except Exception as e:
-                    print(f"Ошибка при удалении wait_msg: {e}")
-                await message.answer(
-                    f"Описание: {desc}\n"
-                    f"Калории: {data.get('calories', '')}\n"
-                    f"Б: {data.get('proteins', '—')} г, Ж: {data.get('fats', '—')} г, У: {data.get('carbs', '—')} г",
-                    reply_markup=MAIN_MENU
-                )
+                await wait_msg.delete()
             except Exception as e:
-                try:
-                    await wait_msg.delete()
-                except Exception as e2:
-                    print(f"Ошибка при удалении wait_msg: {e2}")
-                await message.answer("Ошибка при разборе ответа ИИ. Попробуйте позже.")
-                print(f"Ошибка парсинга JSON из Vision: {e}")
+                print(f"Ошибка при удалении wait_msg: {e}")
+            await message.answer(refusal, reply_markup=MAIN_MENU)
+        elif not meal.description.strip():
+            try:
+                await wait_msg.delete()
+            except Exception as e:
+                print(f"Ошибка при удалении wait_msg: {e}")
+            await message.answer(
+                "Не удалось сохранить приём пищи: описание отсутствует. Попробуйте ещё раз.",
+                reply_markup=MAIN_MENU
+            )
         else:
+            await add_meal(
+                user_id=user["id"],
+                description=meal.description,
+                calories=meal.calories,
+                proteins=meal.proteins,
+                fats=meal.fats,
+                carbs=meal.carbs
+            )
             try:
                 await wait_msg.delete()
             except Exception as e:
                 print(f"Ошибка при удалении wait_msg: {e}")
-            await message.answer(gpt_response, reply_markup=MAIN_MENU)
+            await message.answer(
+                f"Описание: {meal.description}\n"
+                f"Калории: {format_amount(meal.calories, '')}\n"
+                f"Б: {format_amount(meal.proteins)} г, Ж: {format_amount(meal.fats)} г, У: {format_amount(meal.carbs)} г",
+                reply_markup=MAIN_MENU
+            )
         await state.clear()
     except Exception as e:
         try:
@@ -765,22 +717,87 @@ async def process_calories_photo(message: types.Message, state: FSMContext):
         await state.update_data(is_busy=False)
 
 @router.message(CaloriesStates.waiting_for_photo)
-async def process_calories_not_photo(message: types.Message, state: FSMContext):
+async def process_calories_not_photo(message: types.Message, state: FSMContext, user=None, menu=MAIN_MENU):
     print(f"DEBUG: process_calories_not_photo called, message.text = '{message.text}'")
     if message.text in MENU_BUTTONS:
         await state.clear()
         if message.text == "История":
-            await show_history(message, state)
+            await show_history(message, state, user=user, menu=menu)
         elif message.text == "Получить новую тренировку":
-            await get_new_workout(message, state)
+            await get_new_workout(message, state, user=user)
         elif message.text == "Подсчет калорий":
-            await start_calories(message, state)
+            await start_calories(message, state, user=user)
         return
     await message.answer("Пожалуйста, отправь именно фото еды.")
 
+def history_keyboard():
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="Последние записи", callback_data="history:last")],
+            [
+                InlineKeyboardButton(text="30 дней", callback_data="history:30:xlsx"),
+                InlineKeyboardButton(text="90 дней", callback_data="history:90:xlsx"),
+                InlineKeyboardButton(text="Год", callback_data="history:365:xlsx"),
+            ],
+            [
+                InlineKeyboardButton(text="Вся история (Excel)", callback_data="history:all:xlsx"),
+                InlineKeyboardButton(text="Вся история (CSV)", callback_data="history:all:csv"),
+            ],
+            [InlineKeyboardButton(text="Свой период", callback_data="history:custom")],
+        ]
+    )
+
+def parse_history_period(text):
+    """(date_from, date_to) из «01.01.2024-31.03.2024» или None."""
+    parts = re.split(r"\s*[-—–]\s*", (text or "").strip())
+    if len(parts) != 2:
+        return None
+    try:
+        date_from, date_to = (datetime.strptime(part, "%d.%m.%Y").date() for part in parts)
+    except ValueError:
+        return None
+    if date_from > date_to:
+        return None
+    return date_from, date_to
+
 @router.message(F.text == "История")
-async def show_history(message: types.Message, state: FSMContext):
+async def show_history(message: types.Message, state: FSMContext, user=None, menu=MAIN_MENU):
     print("DEBUG: show_history called, state cleared")
+    await state.clear()
+    await mark_active(message)
+    if not await require_payment(message, user):
+        return
+    await message.answer("За какой период выгрузить историю?", reply_markup=history_keyboard())
+
+@router.callback_query(F.data.startswith("history:"))
+async def history_period_callback(callback_query: types.CallbackQuery, state: FSMContext, user=None, menu=MAIN_MENU):
+    await answer_callback(callback_query)
+    _, period, *rest = callback_query.data.split(":")
+    if period == "custom":
+        await state.set_state(HistoryStates.waiting_for_period)
+        await callback_query.message.answer("Введите период в формате ДД.ММ.ГГГГ-ДД.ММ.ГГГГ, например 01.01.2024-31.03.2024")
+        return
+    if period == "last":
+        await send_history(callback_query.message, state, user, menu)
+        return
+    date_from = None if period == "all" else datetime.utcnow().date() - timedelta(days=int(period))
+    await send_history(callback_query.message, state, user, menu, full=True, date_from=date_from, fmt=rest[0])
+
+@router.message(HistoryStates.waiting_for_period)
+async def history_custom_period(message: types.Message, state: FSMContext, user=None, menu=MAIN_MENU):
+    if message.text in MENU_BUTTONS:
+        await state.clear()
+        await message.answer("Выгрузка истории отменена.", reply_markup=menu)
+        return
+    period = parse_history_period(message.text)
+    if period is None:
+        await message.answer("Не получилось разобрать период. Пример: 01.01.2024-31.03.2024")
+        return
+    await state.clear()
+    await send_history(message, state, user, menu, full=True, date_from=period[0], date_to=period[1])
+
+async def send_history(message: types.Message, state: FSMContext, user, menu, full=False, date_from=None, date_to=None, fmt="xlsx"):
+    """Отправляет выгрузку: последние записи (full=False) или всю историю за период потоковой выгрузкой."""
     # Проверка на занятость
     data = await state.get_data()
     if data.get("is_busy"):
@@ -789,226 +806,81 @@ async def show_history(message: types.Message, state: FSMContext):
     await state.update_data(is_busy=True)
     # UX: показываем сообщение об ожидании
     wait_msg = await message.answer("Формирую историю, пожалуйста, подождите...")
-    # Системное сообщение сразу
-    await state.clear()
-    await mark_active(message)
-    menu = await get_main_menu(message.from_user.id)
+    path = None
     try:
-        user = await get_user_by_telegram_id(message.from_user.id)
         if not await require_payment(message, user):
-            await state.update_data(is_busy=False)
             try:
                 await wait_msg.delete()
             except Exception as e:
                 print(f"Ошибка при удалении wait_msg: {e}")
             return
-        print("DEBUG: show_history - user and payment ok")
-        workouts = await get_user_workouts(user["id"])
-        meals = await get_user_meals(user["id"])
-        print(f"DEBUG: show_history - workouts: {len(workouts)}, meals: {len(meals)}")
-        wb = openpyxl.Workbook()
-        ws1 = wb.active
-        ws1.title = "Тренировки"
-        ws1.append(["Дата", "Тип", "Описание", "Калории (если есть)"])
-        # Стили для заголовков
-        header_font = Font(bold=True)
-        align_left = Alignment(horizontal="left", vertical="top", wrap_text=True)
-        thin_border = Border(
-            left=Side(style='thin'), right=Side(style='thin'),
-            top=Side(style='thin'), bottom=Side(style='thin')
-        )
-        for cell in ws1[1]:
-            cell.font = header_font
-            cell.alignment = align_left
-            cell.border = thin_border
-        for w in workouts:
-            ws1.append([
-                w.get("date", ""),
-                w.get("workout_type", ""),
-                w.get("details", ""),
-                w.get("calories_burned", "")
-            ])
-        # Стили для данных
-        for row in ws1.iter_rows(min_row=2, max_row=ws1.max_row):
-            for cell in row:
-                cell.alignment = align_left
-                cell.border = thin_border
-        # Автоширина
-        for col in ws1.columns:
-            max_length = 0
-            col_letter = col[0].column_letter
-            for cell in col:
-                try:
-                    cell_len = len(str(cell.value)) if cell.value else 0
-                    if cell_len > max_length:
-                        max_length = cell_len
-                except:
-                    pass
-            ws1.column_dimensions[col_letter].width = max(12, min(max_length + 2, 50))
-        ws2 = wb.create_sheet(title="Питание")
-        ws2.append(["Дата", "Описание", "Калории", "Белки (г)", "Жиры (г)", "Углеводы (г)"])
-        for cell in ws2[1]:
-            cell.font = header_font
-            cell.alignment = align_left
-            cell.border = thin_border
-        for m in meals:
-            ws2.append([
-                m.get("date", ""),
-                m.get("description", ""),
-                m.get("calories", ""),
-                m.get("proteins", ""),
-                m.get("fats", ""),
-                m.get("carbs", "")
-            ])
-        for row in ws2.iter_rows(min_row=2, max_row=ws2.max_row):
-            for cell in row:
-                cell.alignment = align_left
-                cell.border = thin_border
-        for col in ws2.columns:
-            max_length = 0
-            col_letter = col[0].column_letter
-            for cell in col:
-                try:
-                    cell_len = len(str(cell.value)) if cell.value else 0
-                    if cell_len > max_length:
-                        max_length = cell_len
-                except:
-                    pass
-            ws2.column_dimensions[col_letter].width = max(12, min(max_length + 2, 50))
-        file_stream = io.BytesIO()
-        wb.save(file_stream)
-        file_stream.seek(0)
-        excel_file = BufferedInputFile(file_stream.read(), filename="history.xlsx")
-        print("DEBUG: show_history - Excel file ready, sending to user")
+        export_key = f"{date_from}:{date_to}:{fmt}" if full else "last"
+        caption = "Ваша история в формате CSV" if fmt == "csv" else "Ваша история в формате Excel"
+        # Версию берём до сборки: если история изменится во время сборки, файл просто не переиспользуется
+        version = await get_history_version(user["id"])
+        file_id = history_export_cache.get(user["id"], export_key, version)
+        if file_id:
+            try:
+                await wait_msg.delete()
+            except Exception as e:
+                print(f"Ошибка при удалении wait_msg: {e}")
+            try:
+                # История не менялась — отправляем уже загруженный в Telegram файл без сборки и выгрузки
+                await message.answer_document(file_id, caption=caption, reply_markup=menu)
+                return
+            except TelegramBadRequest as e:
+                print(f"Не удалось переотправить историю по file_id: {e}")
+                history_export_cache.invalidate(user["id"], export_key)
+                wait_msg = await message.answer("Формирую историю, пожалуйста, подождите...")
+        if full:
+            # Вся история страницами из БД прямо в файл на диске, без загрузки в память целиком
+            path = await export_history_file(user["id"], date_from, date_to, fmt)
+            suffix = f"_{date_from:%Y%m%d}-{(date_to or datetime.utcnow().date()):%Y%m%d}" if date_from else ""
+            document = FSInputFile(path, filename=f"history{suffix}.{fmt}")
+        else:
+            workouts = await get_user_workouts(user["id"])
+            meals = await get_user_meals(user["id"])
+            print(f"DEBUG: show_history - workouts: {len(workouts)}, meals: {len(meals)}")
+            # Книга собирается в пуле процессов, event loop в это время обслуживает других пользователей
+            content = await export_history_xlsx(workouts, meals)
+            document = BufferedInputFile(content, filename="history.xlsx")
+        print("DEBUG: show_history - file ready, sending to user")
         try:
             await wait_msg.delete()
         except Exception as e:
             print(f"Ошибка при удалении wait_msg: {e}")
-        await message.answer_document(
-            excel_file,
-            caption="Ваша история в формате Excel",
-            reply_markup=menu
-        )
+        sent = await message.answer_document(document, caption=caption, reply_markup=menu)
+        if sent.document:
+            history_export_cache.set(user["id"], export_key, version, sent.document.file_id)
     except Exception as e:
         try:
             await wait_msg.delete()
         except Exception as e2:
             print(f"Ошибка при удалении wait_msg: {e2}")
-        await message.answer("Произошла ошибка при формировании Excel-файла. Попробуйте позже.", reply_markup=menu)
-        print(f"Ошибка в show_history: {e}")
+        await message.answer("Произошла ошибка при формировании файла истории. Попробуйте позже.", reply_markup=menu)
+        print(f"Ошибка в send_history: {e}")
     finally:
+        if path is not None:
+            os.remove(path)
         await state.update_data(is_busy=False)
 
-@router.message(F.text == "Пуш-рассылка")
-async def push_start(message: types.Message, state: FSMContext):
-    if not await is_admin(message.from_user.id):
+async def is_admin(telegram_id):
+    user = await get_user_by_telegram_id(telegram_id)
+    return is_admin_user(user)
+
+@router.message(Command("workout_pool"))
+async def cmd_workout_pool(message: types.Message, is_admin=False):
+    if not is_admin:
         await message.answer("Нет доступа.")
         return
-    await message.answer("Введите текст пуш-уведомления:")
-    await state.set_state(PushStates.waiting_for_text)
-
-@router.message(PushStates.waiting_for_text)
-async def push_text(message: types.Message, state: FSMContext):
-    await state.update_data(push_text=message.text)
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="Всем пользователям", callback_data="push_audience_all")],
-            [InlineKeyboardButton(text="Только платным", callback_data="push_audience_paid")],
-            [InlineKeyboardButton(text="Только бесплатным", callback_data="push_audience_free")],
-        ]
-    )
-    await message.answer("Кому отправить уведомление?", reply_markup=kb)
-    await state.set_state(PushStates.waiting_for_audience)
-
-@router.callback_query(lambda c: c.data.startswith("push_audience_"))
-async def push_audience(callback_query: types.CallbackQuery, state: FSMContext):
-    audience = callback_query.data.replace("push_audience_", "")
-    await state.update_data(push_audience=audience)
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="Подтвердить", callback_data="push_confirm")],
-            [InlineKeyboardButton(text="Отмена", callback_data="push_cancel")],
-        ]
-    )
-    text = (await state.get_data()).get("push_text", "")
-    audience_str = {
-        "all": "всем пользователям",
-        "paid": "только платным",
-        "free": "только бесплатным"
-    }[audience]
-    await callback_query.message.answer(f"Текст: {text}\nКому: {audience_str}\n\nПодтвердить рассылку?", reply_markup=kb)
-    await state.set_state(PushStates.waiting_for_confirm)
-    await callback_query.answer()
-
-@router.callback_query(lambda c: c.data == "push_cancel")
-async def push_cancel(callback_query: types.CallbackQuery, state: FSMContext):
-    await state.clear()
-    await callback_query.message.answer("Рассылка отменена.")
-    await callback_query.answer()
+    await message.answer(await workout_pool_report())
 
-@router.callback_query(lambda c: c.data == "push_confirm")
-async def push_confirm(callback_query: types.CallbackQuery, state: FSMContext):
-    await callback_query.answer()
-    data = await state.get_data()
-    if data.get("is_busy"):
-        await callback_query.message.answer("Рассылка уже выполняется, подождите...")
+@router.message(Command("ai_stats"))
+async def cmd_ai_stats(message: types.Message, is_admin=False):
+    if not is_admin:
+        await message.answer("Нет доступа.")
         return
-    await state.update_data(is_busy=True)
-    text = data.get("push_text", "")
-    audience = data.get("push_audience", "all")
-    await callback_query.message.answer("Рассылка начата...")
-    await state.clear()
-    # Получаем пользователей
-    try:
-        if audience == "all":
-            users = await get_users_by_audience(None)
-        else:
-            users = await get_users_by_audience(audience)
-        count = 0
-        errors = 0
-        from aiogram import Bot
-        bot = callback_query.bot
-        for user in users:
-            try:
-                await bot.send_message(user["telegram_id"], text)
-                count += 1
-            except Exception as e:
-                errors += 1
-                print(f"Ошибка отправки {user.get('telegram_id')}: {e}")
-        await callback_query.message.answer(f"Рассылка завершена. Успешно: {count}, ошибок: {errors}")
-    except Exception as e:
-        await callback_query.message.answer("Произошла ошибка при рассылке.")
-        print(f"Ошибка в push_confirm: {e}")
-    finally:
-        await state.update_data(is_busy=False)
-    await callback_query.answer()
-
-@router.message(PushStates.waiting_for_audience)
-async def push_waiting_audience_message(message: types.Message, state: FSMContext):
-    await message.answer("Пожалуйста, выберите вариант с помощью кнопок ниже.")
-
-@router.message(PushStates.waiting_for_confirm)
-async def push_waiting_confirm_message(message: types.Message, state: FSMContext):
-    await message.answer("Пожалуйста, подтвердите или отмените рассылку с помощью кнопок ниже.")
-
-async def is_admin(telegram_id):
-    user = await get_user_by_telegram_id(telegram_id)
-    return user and user.get("role") == "admin"
-
-async def get_users_by_audience(audience):
-    url = f"{os.getenv('SUPABASE_URL')}/rest/v1/users"
-    headers = {
-        "apikey": os.getenv('SUPABASE_KEY'),
-        "Authorization": f"Bearer {os.getenv('SUPABASE_KEY')}",
-    }
-    params = {}
-    if audience == "paid":
-        params = {"is_paid": "eq.true"}
-    elif audience == "free":
-        params = {"is_paid": "eq.false"}
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(url, headers=headers, params=params)
-        return resp.json()
+    await message.answer(intent_router_report())
 
 @router.message(Command("reset"))
 async def cmd_reset(message: types.Message, state: FSMContext):
@@ -1053,8 +925,7 @@ async def cmd_help(message: types.Message):
     await message.answer(text, parse_mode="HTML") 
 
 @router.message(Command("cancel_autopay"))
-async def cmd_cancel_autopay(message: types.Message):
-    user = await get_user_by_telegram_id(message.from_user.id)
+async def cmd_cancel_autopay(message: types.Message, user=None):
     if not user or not user.get("payment_method_id"):
         await message.answer("У вас не подключено автосписание или вы не авторизованы.")
         return
@@ -1064,11 +935,10 @@ async def cmd_cancel_autopay(message: types.Message):
     )
 
 @router.message(F.text & ~F.text.in_(MENU_BUTTONS) & ~F.text.startswith("/"), default_state, flags={"order": 100})
-async def universal_ai_handler(message: types.Message, state: FSMContext):
+async def universal_ai_handler(message: types.Message, state: FSMContext, user=None, is_admin=False):
     # Защита: если не админ и текст 'Пуш-рассылка' — игнорировать
     if message.text == "Пуш-рассылка":
-        user = await get_user_by_telegram_id(message.from_user.id)
-        if not user or user.get("role") != "admin":
+        if not is_admin:
             await message.answer("Нет доступа.")
             return
     # UX: показываем сообщение об ожидании
@@ -1076,90 +946,67 @@ async def universal_ai_handler(message: types.Message, state: FSMContext):
     await mark_active(message)
     print("universal_ai_handler called")
     try:
-        user = await get_user_by_telegram_id(message.from_user.id)
         if not await require_payment(message, user):
             try:
                 await wait_msg.delete()
             except Exception as e:
                 print(f"Ошибка при удалении wait_msg: {e}")
             return
-        gpt_response = await ask_gpt("", message.text)
-        # Пытаемся найти JSON в ответе
-        json_start = gpt_response.find('{')
-        json_end = gpt_response.rfind('}')
-        saved = False
-        if json_start != -1 and json_end != -1 and json_end > json_start:
-            try:
-                data = json.loads(gpt_response[json_start:json_end+1])
-                if data.get("type") == "meal":
-                    desc = data.get("description", "")
-                    if not desc or not desc.strip():
-                        try:
-                            await wait_msg.delete()
-                        except Exception as e:
-                            print(f"Ошибка при удалении wait_msg: {e}")
-                        await message.answer(
-                            "Не удалось сохранить приём пищи: описание отсутствует. Попробуйте ещё раз.",
-                            reply_markup=MAIN_MENU
-                        )
-                        return
-                    await add_meal(
-                        user_id=user["id"],
-                        description=desc,
-                        calories=data.get("calories"),
-                        proteins=data.get("proteins"),
-                        fats=data.get("fats"),
-                        carbs=data.get("carbs")
-                    )
-                    try:
-                        await wait_msg.delete()
-                    except Exception as e:
-                        print(f"Ошибка при удалении wait_msg: {e}")
-                    await message.answer(
-                        f"Записал приём пищи: {desc} ({data.get('calories', '')} ккал)\n"
-                        f"Б: {data.get('proteins', '—')} г, Ж: {data.get('fats', '—')} г, У: {data.get('carbs', '—')} г"
-                    )
-                    saved = True
-                elif data.get("type") == "workout":
-                    workout_desc = data.get("description", "")
-                    if not workout_desc or not workout_desc.strip():
-                        try:
-                            await wait_msg.delete()
-                        except Exception as e:
-                            print(f"Ошибка при удалении wait_msg: {e}")
-                        await message.answer(
-                            "Не удалось сохранить тренировку: описание отсутствует. Попробуйте ещё раз.",
-                            reply_markup=MAIN_MENU
-                        )
-                        return
-                    await add_workout(user_id=user["id"], workout_type=data.get("workout_type", "custom"), details=workout_desc, calories_burned=data.get("calories_burned"))
-                    try:
-                        await wait_msg.delete()
-                    except Exception as e:
-                        print(f"Ошибка при удалении wait_msg: {e}")
-                    await message.answer("Записал тренировку: {}".format(workout_desc))
-                    saved = True
-            except Exception as e:
+        reply = await route_message(message.text)
+        if reply.type == "meal" and reply.meal:
+            meal = reply.meal
+            if not meal.description.strip():
                 try:
                     await wait_msg.delete()
-                except Exception as e2:
-                    print(f"Ошибка при удалении wait_msg: {e2}")
-                print(f"Ошибка парсинга JSON из ответа GPT: {e}")
-        # Отправляем сам ответ ИИ (без JSON)
-        if saved:
-            # Если был JSON, отправляем только текст до него (совет/комментарий)
-            if json_start > 0:
+                except Exception as e:
+                    print(f"Ошибка при удалении wait_msg: {e}")
+                await message.answer(
+                    "Не удалось сохранить приём пищи: описание отсутствует. Попробуйте ещё раз.",
+                    reply_markup=MAIN_MENU
+                )
+                return
+            await add_meal(
+                user_id=user["id"],
+                description=meal.description,
+                calories=meal.calories,
+                proteins=meal.proteins,
+                fats=meal.fats,
+                carbs=meal.carbs
+            )
+            try:
+                await wait_msg.delete()
+            except Exception as e:
+                print(f"Ошибка при удалении wait_msg: {e}")
+            await message.answer(
+                f"Записал приём пищи: {meal.description} ({format_amount(meal.calories, '')} ккал)\n"
+                f"Б: {format_amount(meal.proteins)} г, Ж: {format_amount(meal.fats)} г, У: {format_amount(meal.carbs)} г"
+            )
+        elif reply.type == "workout" and reply.workout:
+            workout = reply.workout
+            if not workout.description.strip():
                 try:
                     await wait_msg.delete()
                 except Exception as e:
                     print(f"Ошибка при удалении wait_msg: {e}")
-                await message.answer(gpt_response[:json_start].strip())
+                await message.answer(
+                    "Не удалось сохранить тренировку: описание отсутствует. Попробуйте ещё раз.",
+                    reply_markup=MAIN_MENU
+                )
+                return
+            await add_workout(user_id=user["id"], workout_type=workout.workout_type or "custom", details=workout.description, calories_burned=workout.calories_burned)
+            try:
+                await wait_msg.delete()
+            except Exception as e:
+                print(f"Ошибка при удалении wait_msg: {e}")
+            await message.answer("Записал тренировку: {}".format(workout.description))
         else:
             try:
                 await wait_msg.delete()
             except Exception as e:
                 print(f"Ошибка при удалении wait_msg: {e}")
-            await message.answer(gpt_response)
+        # Отправляем сам ответ ИИ (совет / комментарий)
+        if reply.reply.strip():
+            await message.answer(reply.reply.strip())
     except Exception as e:
         try:
             await wait_msg.delete()
@@ -1169,16 +1016,13 @@ async def universal_ai_handler(message: types.Message, state: FSMContext):
         print(f"Ошибка в universal_ai_handler: {e}")
 
 @router.message()
-async def any_message_handler(message: types.Message, state: FSMContext):
+async def any_message_handler(message: types.Message, state: FSMContext, user=None, is_admin=False, menu=MAIN_MENU):
     print(f"DEBUG: any_message_handler called, message.text = '{message.text}'")
     # Защита: если не админ и текст 'Пуш-рассылка' — игнорировать
     if message.text == "Пуш-рассылка":
-        user = await get_user_by_telegram_id(message.from_user.id)
-        if not user or user.get("role") != "admin":
+        if not is_admin:
             await message.answer("Нет доступа.")
             return
-    user = await get_user_by_telegram_id(message.from_user.id)
-    menu = await get_main_menu(message.from_user.id)
     if user and not user.get("is_paid"):
         pay_keyboard = InlineKeyboardMarkup(
             inline_keyboard=[
@@ -1198,16 +1042,18 @@ async def any_message_handler(message: types.Message, state: FSMContext):
 
 
 # Модифицируем MAIN_MENU для админа
+ADMIN_MAIN_MENU = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="Получить новую тренировку")],
+        [KeyboardButton(text="Подсчет калорий")],
+        [KeyboardButton(text="История")],
+        [ADMIN_MENU_BUTTON],
+    ],
+    resize_keyboard=True
+)
+
+def build_main_menu(is_admin):
+    return ADMIN_MAIN_MENU if is_admin else MAIN_MENU
+
 async def get_main_menu(telegram_id):
-    if await is_admin(telegram_id):
-        return ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="Получить новую тренировку")],
-                [KeyboardButton(text="Подсчет калорий")],
-                [KeyboardButton(text="История")],
-                [ADMIN_MENU_BUTTON],
-            ],
-            resize_keyboard=True
-        )
-    else:
-        return MAIN_MENU
\ No newline at end of file
+    return build_main_menu(await is_admin(telegram_id))
\ No newline at end of file
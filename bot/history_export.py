@@ -0,0 +1,330 @@
+import io
+import os
+import csv
+import time
+import queue
+import asyncio
+import logging
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Excel с историей собирается вне event loop: в пуле потоков (по умолчанию) или процессов.
+# process — сборка не конкурирует с ботом за GIL, но каждый воркер при spawn заново импортирует
+# пакет bot (секунды старта и десятки МБ памяти на процесс), поэтому включается явно.
+HISTORY_EXPORT_EXECUTOR = os.getenv("HISTORY_EXPORT_EXECUTOR", "thread")
+HISTORY_EXPORT_WORKERS = int(os.getenv("HISTORY_EXPORT_WORKERS", "2"))
+
+WORKOUT_COLUMNS = ["Дата", "Тип", "Описание", "Калории (если есть)"]
+MEAL_COLUMNS = ["Дата", "Описание", "Калории", "Белки (г)", "Жиры (г)", "Углеводы (г)"]
+MIN_COLUMN_WIDTH = 12
+MAX_COLUMN_WIDTH = 50
+
+# Выгрузка всей истории за период: строки идут из БД страницами и сразу пишутся в файл на диске,
+# в памяти одновременно не больше HISTORY_STREAM_QUEUE_PAGES страниц
+HISTORY_STREAM_QUEUE_PAGES = int(os.getenv("HISTORY_STREAM_QUEUE_PAGES", "4"))
+HISTORY_FORMATS = ("xlsx", "csv")
+# Ширины колонок заранее: данные при потоковой записи целиком не видны
+STREAM_COLUMN_WIDTHS = {
+    "workouts": [12, 14, 50, 14],
+    "meals": [12, 50, 12, 12, 12, 14],
+}
+SHEET_TITLES = {"workouts": "Тренировки", "meals": "Питание"}
+# CSV один на обе таблицы, раздел — в первой колонке; «;» и BOM, чтобы Excel открывал его без импорта
+CSV_COLUMNS = ["Раздел", "Дата", "Тип", "Описание", "Калории", "Белки (г)", "Жиры (г)", "Углеводы (г)"]
+CSV_SECTIONS = {"workouts": "Тренировка", "meals": "Питание"}
+_STREAM_END = None
+_STREAM_ABORT = "abort"
+
+_executor = None
+_stream_executor = None
+_stats = {"exports": 0, "errors": 0, "rows": 0, "bytes": 0, "build_ms": 0.0, "total_ms": 0.0, "max_total_ms": 0.0}
+
+
+def workout_rows(workouts):
+    return [
+        [w.get("date", ""), w.get("workout_type", ""), w.get("details", ""), w.get("calories_burned", "")]
+        for w in workouts
+    ]
+
+
+def meal_rows(meals):
+    return [
+        [m.get("date", ""), m.get("description", ""), m.get("calories", ""), m.get("proteins", ""), m.get("fats", ""), m.get("carbs", "")]
+        for m in meals
+    ]
+
+
+def column_widths(header, rows):
+    """Ширина колонок по самому длинному значению, считается по данным до записи в книгу."""
+    widths = []
+    for i, title in enumerate(header):
+        longest = max((len(str(row[i])) for row in rows if row[i] not in (None, "")), default=0)
+        widths.append(max(MIN_COLUMN_WIDTH, min(max(longest, len(title)) + 2, MAX_COLUMN_WIDTH)))
+    return widths
+
+
+def _setup_columns(ws, widths):
+    from openpyxl.utils import get_column_letter
+
+    # В write_only колонки задаются до первой строки. Выравнивание и рамка — стиль колонки;
+    # заполненным ячейкам Excel его не применяет, поэтому им всё равно назначается history_data.
+    align_left, thin_border = _history_formats()
+    for i, width in enumerate(widths, start=1):
+        column = ws.column_dimensions[get_column_letter(i)]
+        column.width = width
+        column.alignment = align_left
+        column.border = thin_border
+
+
+def _write_sheet(wb, title, header, rows, header_style, data_style):
+    from openpyxl.cell import WriteOnlyCell
+
+    ws = wb.create_sheet(title=title)
+    _setup_columns(ws, column_widths(header, rows))
+
+    def styled(value, style):
+        cell = WriteOnlyCell(ws, value=None if value == "" else value)
+        cell.style = style
+        return cell
+
+    ws.append([styled(value, header_style) for value in header])
+    for row in rows:
+        ws.append([styled(value, data_style) for value in row])
+
+
+def _history_formats():
+    from openpyxl.styles import Alignment, Border, Side
+
+    thin = Side(style="thin")
+    return (
+        Alignment(horizontal="left", vertical="top", wrap_text=True),
+        Border(left=thin, right=thin, top=thin, bottom=thin),
+    )
+
+
+def _history_styles(wb):
+    from openpyxl.styles import Font, NamedStyle
+
+    align_left, thin_border = _history_formats()
+    # Стили регистрируются в книге один раз, ячейкам назначается только имя стиля
+    header_style = NamedStyle(name="history_header", font=Font(bold=True), alignment=align_left, border=thin_border)
+    data_style = NamedStyle(name="history_data", alignment=align_left, border=thin_border)
+    wb.add_named_style(header_style)
+    wb.add_named_style(data_style)
+    return header_style.name, data_style.name
+
+
+def build_history_xlsx(workout_rows, meal_rows):
+    """Книга с листами «Тренировки» и «Питание». Выполняется в пуле, возвращает (байты xlsx, мс сборки)."""
+    from openpyxl import Workbook
+
+    started = time.perf_counter()
+    wb = Workbook(write_only=True)
+    header_style, data_style = _history_styles(wb)
+    _write_sheet(wb, "Тренировки", WORKOUT_COLUMNS, workout_rows, header_style, data_style)
+    _write_sheet(wb, "Питание", MEAL_COLUMNS, meal_rows, header_style, data_style)
+    out = io.BytesIO()
+    wb.save(out)
+    return out.getvalue(), (time.perf_counter() - started) * 1000
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        if HISTORY_EXPORT_EXECUTOR == "process":
+            # spawn: дочерний процесс не наследует event loop и соединения бота
+            _executor = ProcessPoolExecutor(
+                max_workers=HISTORY_EXPORT_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        else:
+            _executor = ThreadPoolExecutor(max_workers=HISTORY_EXPORT_WORKERS, thread_name_prefix="history-export")
+    return _executor
+
+
+async def export_history_xlsx(workouts, meals):
+    """Байты xlsx с историей; сборка идёт в пуле и не блокирует обработку других пользователей."""
+    started = time.perf_counter()
+    rows = (workout_rows(workouts), meal_rows(meals))
+    loop = asyncio.get_running_loop()
+    try:
+        content, build_ms = await loop.run_in_executor(_get_executor(), build_history_xlsx, *rows)
+    except Exception:
+        _stats["errors"] += 1
+        raise
+    total_ms = (time.perf_counter() - started) * 1000
+    _stats["exports"] += 1
+    _stats["rows"] += len(rows[0]) + len(rows[1])
+    _stats["bytes"] += len(content)
+    _stats["build_ms"] += build_ms
+    _stats["total_ms"] += total_ms
+    _stats["max_total_ms"] = max(_stats["max_total_ms"], total_ms)
+    # Разница между total и build — ожидание свободного воркера (и передача данных в процесс при HISTORY_EXPORT_EXECUTOR=process)
+    logging.info(
+        f"Экспорт истории: {len(rows[0])} тренировок, {len(rows[1])} приёмов пищи, {len(content)} байт, "
+        f"сборка {build_ms:.0f} мс, всего {total_ms:.0f} мс"
+    )
+    return content
+
+
+class _XlsxStream:
+    def __init__(self, path):
+        from openpyxl import Workbook
+        from openpyxl.cell import WriteOnlyCell
+
+        self.path = path
+        self.cell = WriteOnlyCell
+        self.wb = Workbook(write_only=True)
+        self.header_style, self.data_style = _history_styles(self.wb)
+        self.sheets = {}
+        # Листы создаются сразу: в write_only каждый пишется в свой временный файл, порядок строк между ними не важен
+        for table, header in (("workouts", WORKOUT_COLUMNS), ("meals", MEAL_COLUMNS)):
+            ws = self.wb.create_sheet(title=SHEET_TITLES[table])
+            _setup_columns(ws, STREAM_COLUMN_WIDTHS[table])
+            self.sheets[table] = ws
+            ws.append([self._styled(ws, value, self.header_style) for value in header])
+
+    def _styled(self, ws, value, style):
+        cell = self.cell(ws, value=None if value == "" else value)
+        cell.style = style
+        return cell
+
+    def write(self, table, rows):
+        ws = self.sheets[table]
+        for row in rows:
+            ws.append([self._styled(ws, value, self.data_style) for value in row])
+
+    def close(self):
+        self.wb.save(self.path)
+
+
+class _CsvStream:
+    def __init__(self, path):
+        self.file = open(path, "w", encoding="utf-8-sig", newline="")
+        self.writer = csv.writer(self.file, delimiter=";")
+        self.writer.writerow(CSV_COLUMNS)
+
+    def write(self, table, rows):
+        section = CSV_SECTIONS[table]
+        for row in rows:
+            if table == "workouts":
+                # Дата, тип, описание, калории; БЖУ у тренировок нет
+                self.writer.writerow([section, *row, "", "", ""])
+            else:
+                # Дата, описание, калории, Б, Ж, У; типа у приёма пищи нет
+                self.writer.writerow([section, row[0], "", *row[1:]])
+
+    def close(self):
+        self.file.close()
+
+
+def write_history_stream(fmt, path, feed):
+    """Пишет страницы из feed (queue.Queue с (table, rows), None в конце) в файл path. Выполняется в потоке."""
+    started = time.perf_counter()
+    stream = _XlsxStream(path) if fmt == "xlsx" else _CsvStream(path)
+    count = 0
+    try:
+        while True:
+            item = feed.get()
+            if item is _STREAM_END:
+                break
+            if item == _STREAM_ABORT:
+                return count, (time.perf_counter() - started) * 1000
+            table, rows = item
+            stream.write(table, workout_rows(rows) if table == "workouts" else meal_rows(rows))
+            count += len(rows)
+    finally:
+        stream.close()
+    return count, (time.perf_counter() - started) * 1000
+
+
+def _get_stream_executor():
+    global _stream_executor
+    if _stream_executor is None:
+        # Только потоки: писатель читает страницы из очереди в памяти процесса
+        _stream_executor = ThreadPoolExecutor(max_workers=HISTORY_EXPORT_WORKERS, thread_name_prefix="history-stream")
+    return _stream_executor
+
+
+async def _put(feed, item, writer):
+    # Очередь ограничена: если писатель отстаёт, чтение из БД ждёт его, а не копит страницы в памяти
+    while True:
+        try:
+            feed.put_nowait(item)
+            return
+        except queue.Full:
+            if writer.done():
+                writer.result()
+                raise RuntimeError("Запись истории завершилась раньше времени")
+            await asyncio.sleep(0.05)
+
+
+async def export_history_file(user_id, date_from=None, date_to=None, fmt="xlsx"):
+    """Путь к временному файлу со всей историей пользователя за период (даты включительно, None — без границы).
+
+    Файл удаляет вызывающий. Память не зависит от объёма истории: строки читаются страницами
+    и пишутся в файл по мере чтения.
+    """
+    # db импортируется здесь: этот модуль загружается и в процессах пула build_history_xlsx
+    from .db import iter_history_pages
+
+    if fmt not in HISTORY_FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+    started = time.perf_counter()
+    fd, path = tempfile.mkstemp(prefix="history_", suffix=f".{fmt}")
+    os.close(fd)
+    feed = queue.Queue(maxsize=HISTORY_STREAM_QUEUE_PAGES)
+    writer = asyncio.get_running_loop().run_in_executor(_get_stream_executor(), write_history_stream, fmt, path, feed)
+    try:
+        for table in ("workouts", "meals"):
+            async for rows in iter_history_pages(table, user_id, date_from, date_to):
+                await _put(feed, (table, rows), writer)
+        await _put(feed, _STREAM_END, writer)
+        count, build_ms = await writer
+    except BaseException:
+        _stats["errors"] += 1
+        if not writer.done():
+            # Освобождаем очередь, чтобы сигнал остановки поместился без ожидания
+            while not feed.empty():
+                try:
+                    feed.get_nowait()
+                except queue.Empty:
+                    break
+            feed.put_nowait(_STREAM_ABORT)
+        try:
+            await writer
+        except Exception as e:
+            logging.warning(f"Ошибка записи истории: {e}")
+        os.remove(path)
+        raise
+    total_ms = (time.perf_counter() - started) * 1000
+    size = os.path.getsize(path)
+    _stats["exports"] += 1
+    _stats["rows"] += count
+    _stats["bytes"] += size
+    _stats["build_ms"] += build_ms
+    _stats["total_ms"] += total_ms
+    _stats["max_total_ms"] = max(_stats["max_total_ms"], total_ms)
+    logging.info(
+        f"Выгрузка истории {fmt} за {date_from or '…'} — {date_to or '…'}: {count} строк, {size} байт, {total_ms:.0f} мс"
+    )
+    return path
+
+
+def history_export_stats():
+    stats = dict(_stats)
+    exports = stats["exports"]
+    stats["avg_build_ms"] = round(stats["build_ms"] / exports) if exports else 0
+    stats["avg_total_ms"] = round(stats["total_ms"] / exports) if exports else 0
+    return stats
+
+
+def close_history_export():
+    global _executor, _stream_executor
+    if _executor is not None or _stream_executor is not None:
+        logging.info(f"History export stats: {history_export_stats()}")
+    for executor in (_executor, _stream_executor):
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+    _executor = None
+    _stream_executor = None
@@ -0,0 +1,97 @@
+import os
+import time
+import logging
+from .ai import ask_gpt, AssistantReply, AIRefusal, OPENAI_CHAT_MODEL
+from .nutrition import parse_meal_text
+
+# Свободный текст пользователя обрабатывается по уровням:
+#   local    — простая запись о еде разбирается правилами и таблицей FOODS, без запроса к модели;
+#   cheap    — OPENAI_CHAT_MODEL;
+#   escalate — OPENAI_ESCALATION_MODEL, если дешёвая модель отказалась, ответила без нужных данных
+#              или сообщение слишком длинное для неё.
+INTENT_LOCAL_ENABLED = os.getenv("INTENT_LOCAL_ENABLED", "1") == "1"
+OPENAI_ESCALATION_MODEL = os.getenv("OPENAI_ESCALATION_MODEL", "gpt-4o")
+# Сообщения длиннее стольких символов сразу уходят в OPENAI_ESCALATION_MODEL
+INTENT_ESCALATE_CHARS = int(os.getenv("INTENT_ESCALATE_CHARS", "600"))
+
+TIERS = ("local", "cheap", "escalate")
+_stats = {tier: {"count": 0, "errors": 0, "total_ms": 0.0} for tier in TIERS}
+# Всего сообщений и сколько из них после дешёвой модели отправлено на эскалацию
+_stats["messages"] = 0
+_stats["escalated"] = 0
+
+
+def _record(tier, started, error=False):
+    _stats[tier]["count"] += 1
+    _stats[tier]["total_ms"] += (time.monotonic() - started) * 1000
+    if error:
+        _stats[tier]["errors"] += 1
+
+
+def _needs_escalation(reply):
+    # Дешёвая модель определила тип, но не заполнила данные для записи
+    if reply.type == "meal":
+        return reply.meal is None or reply.meal.calories is None or not reply.meal.description.strip()
+    if reply.type == "workout":
+        return reply.workout is None or not reply.workout.description.strip()
+    return not reply.reply.strip()
+
+
+async def _ask(tier, model, text):
+    started = time.monotonic()
+    try:
+        reply = await ask_gpt("", text, model=model)
+    except Exception:
+        _record(tier, started, error=True)
+        raise
+    _record(tier, started)
+    return reply
+
+
+async def route_message(text):
+    """AssistantReply для свободного сообщения: локальный разбор, дешёвая модель или эскалация."""
+    _stats["messages"] += 1
+    if INTENT_LOCAL_ENABLED:
+        started = time.monotonic()
+        meal = parse_meal_text(text)
+        if meal is not None:
+            _record("local", started)
+            return AssistantReply(type="meal", reply="", meal=meal, workout=None)
+    if len(text or "") <= INTENT_ESCALATE_CHARS and OPENAI_CHAT_MODEL != OPENAI_ESCALATION_MODEL:
+        try:
+            reply = await _ask("cheap", OPENAI_CHAT_MODEL, text)
+            if not _needs_escalation(reply):
+                return reply
+        except AIRefusal as e:
+            logging.info(f"Дешёвая модель отказалась отвечать, эскалация: {e}")
+        _stats["escalated"] += 1
+    return await _ask("escalate", OPENAI_ESCALATION_MODEL, text)
+
+
+def intent_router_stats():
+    # hit_rate — доля сообщений, дошедших до уровня
+    total = _stats["messages"]
+    stats = {"total": total, "escalated": _stats["escalated"]}
+    for tier in TIERS:
+        count = _stats[tier]["count"]
+        stats[tier] = {
+            "count": count,
+            "errors": _stats[tier]["errors"],
+            "hit_rate": round(count / total, 3) if total else 0.0,
+            "avg_ms": round(_stats[tier]["total_ms"] / count) if count else 0,
+        }
+    return stats
+
+
+def intent_router_report():
+    """Текст для админа: доля и средняя задержка каждого уровня."""
+    stats = intent_router_stats()
+    lines = [f"Свободные сообщения: {stats['total']}, эскалаций после дешёвой модели: {stats['escalated']}"]
+    names = {"local": "локально", "cheap": OPENAI_CHAT_MODEL, "escalate": OPENAI_ESCALATION_MODEL}
+    for tier in TIERS:
+        tier_stats = stats[tier]
+        lines.append(
+            f"{names[tier]}: {tier_stats['count']} ({tier_stats['hit_rate']:.0%}), "
+            f"в среднем {tier_stats['avg_ms']} мс, ошибок {tier_stats['errors']}"
+        )
+    return "\n".join(lines)
@@ -1,13 +1,18 @@
 import os
 import asyncio
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 from dotenv import load_dotenv
 from .handlers import *
 from .handlers import router
 from .scheduler import scheduler_start
 from .payments import register_yookassa_webhook
 from .broadcast import broadcast_router
+from .db import init_db, close_db
+from .ai import close_ai
+from .history_export import close_history_export
+from .prompts import warm_tokenizer
+from .middlewares import UserContextMiddleware
+from .fsm_storage import create_storage, DatabaseStorage
 
 load_dotenv()
 
@@ -15,21 +20,34 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 MODE = os.getenv("MODE", "polling")  # по умолчанию polling
 
 bot = Bot(token=TELEGRAM_TOKEN)
-storage = MemoryStorage()
+# Состояния FSM в БД (бэкенд asyncpg или FSM_STORAGE=db): переживают рестарт и общие для нескольких процессов за вебхуком
+storage = create_storage()
 dp = Dispatcher(storage=storage)
+dp.update.outer_middleware(UserContextMiddleware())
 dp.include_router(broadcast_router)
 dp.include_router(router)
 
 async def on_startup(dispatcher, bot, app=None):
     if app is not None:
         register_yookassa_webhook(app)
+    await init_db()
+    if isinstance(storage, DatabaseStorage):
+        await storage.start()
+    await warm_tokenizer()
     await scheduler_start()
 
+async def on_shutdown(dispatcher, bot):
+    await close_ai()
+    close_history_export()
+    await storage.close()
+    await close_db()
+
 async def main():
     if MODE == "web":
         from aiohttp import web
         app = web.Application()
         dp.startup.register(on_startup)
+        dp.shutdown.register(on_shutdown)
         runner = web.AppRunner(app)
         await runner.setup()
         site = web.TCPSite(runner, "0.0.0.0", 8080)
@@ -39,6 +57,7 @@ async def main():
             await asyncio.sleep(3600)
     else:
         dp.startup.register(on_startup)
+        dp.shutdown.register(on_shutdown)
         await dp.start_polling(bot)
 
 if __name__ == "__main__":
@@ -0,0 +1,97 @@
+import os
+import json
+import random
+import asyncio
+import logging
+from aiogram.types import FSInputFile
+from aiogram.exceptions import TelegramBadRequest
+
+# Где хранить file_id загруженных картинок (file_id привязан к боту, поэтому ключ — id бота)
+MEDIA_FILE_IDS_PATH = os.getenv("MEDIA_FILE_IDS_PATH", "bot/images/file_ids.json")
+
+WELCOME_IMAGE = "bot/images/welcome.jpg"
+WORKOUT_IMAGES = [
+    "bot/images/workouts/rndm_1.png",
+    "bot/images/workouts/rndm_2.png",
+    "bot/images/workouts/rndm_3.png",
+    "bot/images/workouts/rndm_4.png",
+    "bot/images/workouts/rndm_5.png",
+]
+
+
+class MediaRegistry:
+    """Загружает статичную картинку в Telegram один раз и дальше шлёт её по file_id."""
+
+    def __init__(self, path=MEDIA_FILE_IDS_PATH):
+        self.path = path
+        self._file_ids = None
+        self._locks = {}
+        # Метрики
+        self.uploads = 0
+        self.hits = 0
+
+    def _load(self):
+        if self._file_ids is None:
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    self._file_ids = json.load(f)
+            except FileNotFoundError:
+                self._file_ids = {}
+            except Exception as e:
+                logging.warning(f"Не удалось прочитать {self.path}: {e}")
+                self._file_ids = {}
+        return self._file_ids
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._file_ids, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            # Не смогли сохранить — просто загрузим картинку ещё раз после рестарта
+            logging.warning(f"Не удалось сохранить {self.path}: {e}")
+
+    def get(self, bot_id, path):
+        return self._load().get(str(bot_id), {}).get(path)
+
+    def set(self, bot_id, path, file_id):
+        self._load().setdefault(str(bot_id), {})[path] = file_id
+        self._save()
+
+    def forget(self, bot_id, path):
+        if self._load().get(str(bot_id), {}).pop(path, None) is not None:
+            self._save()
+
+    async def answer_photo(self, message, path, **kwargs):
+        """Как message.answer_photo, но файл с диска загружается только при первой отправке."""
+        bot_id = message.bot.id
+        file_id = self.get(bot_id, path)
+        if file_id is not None:
+            try:
+                self.hits += 1
+                return await message.answer_photo(file_id, **kwargs)
+            except TelegramBadRequest as e:
+                # file_id протух (например, сменили токен бота) — загрузим заново
+                logging.warning(f"file_id для {path} не принят Telegram: {e}")
+                self.forget(bot_id, path)
+        lock = self._locks.setdefault(path, asyncio.Lock())
+        async with lock:
+            file_id = self.get(bot_id, path)
+            if file_id is not None:
+                self.hits += 1
+                return await message.answer_photo(file_id, **kwargs)
+            sent = await message.answer_photo(FSInputFile(path), **kwargs)
+            self.uploads += 1
+            self.set(bot_id, path, sent.photo[-1].file_id)
+            return sent
+
+    def stats(self):
+        return {"uploads": self.uploads, "hits": self.hits, "cached": sum(len(v) for v in self._load().values())}
+
+
+media = MediaRegistry()
+
+
+def random_workout_image():
+    return random.choice(WORKOUT_IMAGES)
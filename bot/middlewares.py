@@ -0,0 +1,26 @@
+import logging
+from aiogram import BaseMiddleware
+from .db import get_user_by_telegram_id
+from .handlers import is_admin_user, has_active_subscription, build_main_menu
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """Загружает строку пользователя один раз на Update и передаёт её хендлерам.
+
+    Хендлеры получают в data: user, is_admin, has_subscription и menu.
+    """
+
+    async def __call__(self, handler, event, data):
+        from_user = data.get("event_from_user")
+        user = None
+        if from_user is not None:
+            try:
+                user = await get_user_by_telegram_id(from_user.id)
+            except Exception as e:
+                logging.warning(f"Не удалось загрузить пользователя {from_user.id}: {e}")
+        admin = is_admin_user(user)
+        data["user"] = user
+        data["is_admin"] = admin
+        data["has_subscription"] = has_active_subscription(user)
+        data["menu"] = build_main_menu(admin)
+        return await handler(event, data)
@@ -0,0 +1,111 @@
+import re
+from .ai import MealInfo
+
+# Локальный разбор простых записей о еде («съел 2 яйца», «выпил стакан кефира») без запроса к модели.
+# Значения на 100 г (для напитков — на 100 мл), вес штуки и обычной порции — в граммах.
+# Название продукта должно совпасть с регуляркой целиком, иначе сообщение уходит в модель.
+FOODS = [
+    # (регулярка названия, ккал, белки, жиры, углеводы, вес штуки, вес порции)
+    (r"яйц[оа]|яиц|яйко|яичк[оа]", 157, 12.7, 11.5, 0.7, 55, 110),
+    (r"банан(а|ов|ы)?", 96, 1.5, 0.5, 21, 120, 120),
+    (r"яблок(о|а)?|яблочк(о|а)", 47, 0.4, 0.4, 9.8, 160, 160),
+    (r"апельсин(а|ов|ы)?", 43, 0.9, 0.2, 8.1, 150, 150),
+    (r"огур(ец|ца|цов|цы)", 15, 0.8, 0.1, 2.8, 100, 100),
+    (r"помидор(а|ов|ы)?|томат(а|ов|ы)?", 20, 0.6, 0.2, 4.2, 120, 120),
+    (r"(гречнев(ой|ую|ая) )?каш(а|и|у)|гречк(а|и|у)|гречневой|гречи", 110, 4.2, 1.1, 21.3, None, 200),
+    (r"рис(а)?", 116, 2.2, 0.5, 24.9, None, 200),
+    (r"овсянк(а|и|у)|овсян(ой|ую|ая) каш(а|и|у)", 88, 3, 1.7, 15, None, 250),
+    (r"макарон(ы|ов)?|пасты|пасту|паста|спагетти", 112, 3.5, 0.4, 23, None, 200),
+    (r"картошк(а|и|у)|картофел(ь|я)|пюре", 82, 2, 0.4, 16.7, 100, 200),
+    (r"(курин(ое|ого) )?филе|курин(ая|ую|ой) грудк(а|у|и)|грудк(а|у|и)|куриц(а|ы|у|ей)", 137, 29.8, 1.8, 0.5, None, 150),
+    (r"говядин(а|ы|у)", 187, 18.9, 12.4, 0, None, 150),
+    (r"лосос(ь|я)|семг(а|и|у)", 208, 20, 13, 0, None, 150),
+    (r"творог(а)?|творожк(а|у)", 121, 17.2, 5, 1.8, None, 200),
+    (r"йогурт(а|ов)?", 66, 5, 1.5, 8.5, 125, 125),
+    (r"кефир(а|у)?", 40, 2.8, 1, 4, None, 250),
+    (r"молок(о|а)", 52, 2.8, 2.5, 4.7, None, 250),
+    (r"сыр(а|у)?", 356, 24, 29.5, 0, 20, 30),
+    (r"хлеб(а)?|хлебц(а|ов|ы)?", 242, 8.1, 1, 48.8, 30, 30),
+    (r"орех(ов|и|а)?|миндал(ь|я)", 650, 15, 60, 13, None, 30),
+    (r"кофе", 2, 0.2, 0, 0.3, None, 200),
+]
+FOODS = [(re.compile(pattern), *values) for pattern, *values in FOODS]
+
+MEAL_RE = re.compile(
+    r"^(я\s+)?(съел[аи]?|поел[аи]?|скушал[аи]?|выпил[аи]?|"
+    r"на\s+(завтрак|обед|ужин|перекус)(\s+(был[аио]?|съел[аи]?))?)\s*:?\s+(?P<items>.+)$"
+)
+# Запятая между цифрами — дробная часть количества («1,5 кг»), а не разделитель продуктов.
+# По «с» не делим: «рис с курицей» — одно блюдо, такие сообщения разбирает модель.
+ITEM_SPLIT_RE = re.compile(r"\s*(?:(?<!\d),|,(?!\d)|\+|\sи\s)\s*")
+ITEM_RE = re.compile(
+    r"^(?:(?P<qty>\d+(?:[.,]\d+)?)\s*|(?P<qty_word>одн[оау]|один|две|два|пар[ау]|три|четыре|пять|половин(?:а|у|ку|ка))\s+)?"
+    r"(?:(?P<unit>кг|г|гр|грамм(?:а|ов)?|мл|л|литр(?:а|ов)?|шт(?:ук[аи]?)?|стакан(?:а|ов)?|"
+    r"ложк(?:а|и|у)|ложек|кус(?:ок|ка|ков|очек|очка)|порци(?:я|ю|и))\.?\s+)?(?P<food>.+)$"
+)
+NUMBER_WORDS = {
+    "один": 1, "одна": 1, "одну": 1, "одно": 1, "два": 2, "две": 2, "пара": 2, "пару": 2,
+    "три": 3, "четыре": 4, "пять": 5, "половина": 0.5, "половину": 0.5, "половинка": 0.5, "половинку": 0.5,
+}
+# Граммы на единицу измерения; штуки, куски и порции считаются по весу продукта из FOODS
+UNIT_GRAMS = {"кг": 1000, "г": 1, "гр": 1, "грамм": 1, "мл": 1, "л": 1000, "литр": 1000, "стакан": 250, "ложк": 15, "ложек": 15}
+
+
+def _unit_grams(unit):
+    for prefix, grams in UNIT_GRAMS.items():
+        if unit == prefix or (len(prefix) > 2 and unit.startswith(prefix)):
+            return grams
+    return None
+
+
+def _item_grams(item):
+    """(вес в граммах, строка продукта из FOODS) или None, если позиция не распознана."""
+    match = ITEM_RE.match(item)
+    food_text = match.group("food").strip(" .!")
+    for food in FOODS:
+        if food[0].fullmatch(food_text):
+            break
+    else:
+        return None
+    _, _, _, _, _, piece, portion = food
+    unit = match.group("unit")
+    if match.group("qty"):
+        count = float(match.group("qty").replace(",", "."))
+    else:
+        count = NUMBER_WORDS.get(match.group("qty_word"), 1)
+    if unit is None or unit.startswith(("шт", "кус")):
+        grams = count * (piece or portion)
+    elif unit.startswith("порци"):
+        grams = count * portion
+    else:
+        grams = count * _unit_grams(unit)
+    if not 0 < grams <= 3000:
+        return None
+    return grams, food
+
+
+def parse_meal_text(text):
+    """MealInfo для простой записи о еде из продуктов таблицы FOODS или None, если разобрать не удалось."""
+    text = re.sub(r"\s+", " ", (text or "").lower().replace("ё", "е")).strip(" .!")
+    match = MEAL_RE.match(text)
+    if not match:
+        return None
+    items = [item for item in ITEM_SPLIT_RE.split(match.group("items")) if item]
+    if not items:
+        return None
+    totals = [0.0, 0.0, 0.0, 0.0]
+    for item in items:
+        parsed = _item_grams(item)
+        if parsed is None:
+            return None
+        grams, food = parsed
+        for i, per_100 in enumerate(food[1:5]):
+            totals[i] += per_100 * grams / 100
+    calories, proteins, fats, carbs = (round(value, 1) for value in totals)
+    return MealInfo(
+        description=", ".join(items),
+        calories=round(calories),
+        proteins=proteins,
+        fats=fats,
+        carbs=carbs,
+    )
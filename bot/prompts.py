@@ -0,0 +1,130 @@
+# Промпты для генерации тренировок.
+#
+# Статичные инструкции собираются один раз при импорте и всегда идут первым сообщением без изменений,
+# чтобы у OpenAI срабатывал prompt caching по префиксу. Всё, что зависит от пользователя и запроса,
+# уходит в короткое последнее сообщение (workout_request).
+
+import os
+import math
+import asyncio
+import logging
+from .exercises import exercise_keys
+
+# Бюджет токенов на список отклонённых упражнений при «Изменить тренировку»: старые вытесняются первыми
+REJECTED_EXERCISES_TOKEN_BUDGET = int(os.getenv("REJECTED_EXERCISES_TOKEN_BUDGET", "300"))
+# Служебные токены на каждое сообщение chat-формата
+MESSAGE_TOKEN_OVERHEAD = 4
+
+WORKOUT_SYSTEM_PROMPT = "\n".join([
+    "Ты - профессиональный фитнесс-тренер. Отвечай всегда только на русском языке.",
+    "В запросе указаны группа мышц на сегодня, число упражнений, профиль пользователя и упражнения из его последних тренировок.",
+    "Составь тренировку только для указанной группы мышц, не добавляй упражнения на другие группы.",
+    "Учитывай цель, уровень, ограничения, частоту тренировок, рост, вес, возраст, пол и место занятий.",
+    "Не используй ни одно упражнение из списка последних тренировок и из списка отклонённых, даже базовые. "
+    "Составь тренировку только из новых упражнений. "
+    "Сделай тренировку максимально разнообразной внутри выбранной группы мышц.",
+    "Сгенерируй ровно столько упражнений, сколько указано в запросе (последнее — кардио или заминка).",
+    "Для каждого упражнения обязательно указывай вес (даже если это собственный вес — пиши явно). "
+    "После плана тренировки выдай отдельным абзацем совет по питанию на сегодня с обязательным указанием БЖУ (белки, жиры, углеводы).",
+    "Форматируй ответ строго так:",
+    "План тренировки на сегодня: [группа мышц]",
+    "",
+    "Для каждого упражнения используй такой формат:",
+    "[Номер]. [Название упражнения]",
+    "[кол-во подходов × повторений — вес]",
+    "*Комментарий по технике или совет*",
+    "",
+    "Последнее упражнение всегда кардио или заминка, указывай его в том же формате.",
+    "Совет по питанию: ... (Б: ... г, Ж: ... г, У: ... г)",
+    "",
+    "Не добавляй лишних пояснений вне структуры плана.",
+])
+
+# Поля профиля в запросе; пустые не передаём
+PROFILE_FIELDS = (
+    ("goal", "цель"),
+    ("level", "уровень"),
+    ("health_issues", "ограничения"),
+    ("location", "место"),
+    ("workouts_per_week", "тренировок в неделю"),
+    ("height", "рост, см"),
+    ("weight", "вес, кг"),
+    ("age", "возраст"),
+    ("gender", "пол"),
+)
+
+
+_encoding = None
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            # Без tiktoken (или без доступа к файлу словаря) считаем приблизительно
+            logging.info(f"tiktoken недоступен, токены считаются по длине текста: {e}")
+            _encoding = False
+    return _encoding
+
+
+async def warm_tokenizer():
+    """Загружает словарь tiktoken в потоке при старте бота: первая загрузка может скачивать файл и длится секунды."""
+    await asyncio.to_thread(_get_encoding)
+
+
+def count_tokens(text):
+    """Число токенов текста для gpt-4o (o200k_base). Без tiktoken — оценка сверху: ~3 символа кириллицы на токен."""
+    # Словарь здесь не загружается, чтобы не блокировать event loop: пока warm_tokenizer не закончил — оценка
+    encoding = _encoding
+    if encoding:
+        return len(encoding.encode(text))
+    return math.ceil(len(text) / 3)
+
+
+def count_message_tokens(messages):
+    return sum(count_tokens(m["content"]) + MESSAGE_TOKEN_OVERHEAD for m in messages)
+
+
+def add_rejected_exercises(rejected, workout_text, budget=REJECTED_EXERCISES_TOKEN_BUDGET):
+    """Новый список отклонённых упражнений: названия из workout_text в начале, затем прежние.
+
+    В FSM хранятся только нормализованные названия, а не тексты тренировок; самые старые отбрасываются,
+    когда список перестаёт помещаться в budget токенов.
+    """
+    result = []
+    tokens = 0
+    for name in exercise_keys(workout_text) + list(rejected or ()):
+        if name in result:
+            continue
+        cost = count_tokens(name) + 1  # + разделитель
+        if tokens + cost > budget:
+            break
+        result.append(name)
+        tokens += cost
+    return result
+
+
+def workout_request(user, chosen_group, n, last_exercises=(), rejected_exercises=()):
+    lines = [f"Группа мышц: {chosen_group}", f"Упражнений: {n}"]
+    profile = "; ".join(
+        f"{title}: {user.get(key)}" for key, title in PROFILE_FIELDS if user.get(key) not in (None, "")
+    )
+    if profile:
+        lines.append(f"Профиль: {profile}")
+    if last_exercises:
+        lines.append("Последние тренировки: " + ", ".join(last_exercises))
+    rejected = [name for name in rejected_exercises if name not in last_exercises]
+    if rejected:
+        lines.append("Отклонённые: " + ", ".join(rejected))
+    return "\n".join(lines)
+
+
+def workout_messages(user, chosen_group, n, last_exercises=(), rejected_exercises=()):
+    """Статичный system-префикс и запрос с данными пользователя."""
+    return [
+        {"role": "system", "content": WORKOUT_SYSTEM_PROMPT},
+        {"role": "user", "content": workout_request(user, chosen_group, n, last_exercises, rejected_exercises)},
+    ]
@@ -1,34 +1,25 @@
 import os
-import httpx
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from aiogram import Bot
 from datetime import datetime, timedelta
-from .db import get_users_for_renewal, update_subscription_until, deactivate_expired_subscriptions
+from .db import iter_users, renewal_target_date, update_subscription_until, deactivate_expired_subscriptions
 from .payments import charge_subscription
+# Общий с рассылками движок: один token bucket на процесс, лимит Telegram не превышается суммарно
+from .broadcast_jobs import resume_broadcast_jobs, engine
+from .workout_pool import fill_workout_pool, WORKOUT_POOL_FILL_HOURS
 import logging
-import asyncio
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 bot = Bot(token=TELEGRAM_TOKEN)
 
 async def send_reminders():
-    async with httpx.AsyncClient() as client:
-        three_days_ago = (datetime.utcnow() - timedelta(days=3)).isoformat()
-        resp = await client.get(
-            f"{os.getenv('SUPABASE_URL')}/rest/v1/users",
-            headers={
-                "apikey": os.getenv('SUPABASE_KEY'),
-                "Authorization": f"Bearer {os.getenv('SUPABASE_KEY')}",
-            },
-            params={"last_active_at": f"lt.{three_days_ago}", "is_paid": "eq.true"}
-        )
-        users = resp.json()
-        for user in users:
-            try:
-                await bot.send_message(user["telegram_id"], "Давно не было активности! Не забывай про тренировки и питание. Я всегда на связи 💪")
-            except Exception as e:
-                logging.warning(f"Ошибка при отправке напоминания {user.get('telegram_id')}: {e}")
-            await asyncio.sleep(0.05)  # ~20 сообщений/сек, чтобы не словить flood limit
+    three_days_ago = (datetime.utcnow() - timedelta(days=3)).isoformat()
+
+    async def send(telegram_id):
+        await bot.send_message(telegram_id, "Давно не было активности! Не забывай про тренировки и питание. Я всегда на связи 💪")
+
+    recipients = (user["telegram_id"] async for user in iter_users("inactive", columns=("id", "telegram_id"), since=three_days_ago))
+    await engine.run(recipients, send)
 
 async def auto_charge_expired(bot: Bot):
     # users = await get_users_for_renewal(reminder_days=3)
@@ -50,11 +41,19 @@ async def auto_charge_expired(bot: Bot):
     return
 
 async def daily_deactivate_expired():
-    await deactivate_expired_subscriptions()
+    telegram_ids = await deactivate_expired_subscriptions()
+
+    async def send(telegram_id):
+        await bot.send_message(telegram_id, "Ваша подписка истекла. Оформите новую для доступа к функциям с помощью /pay")
+
+    async def recipients():
+        for telegram_id in telegram_ids:
+            yield telegram_id
+
+    await engine.run(recipients(), send)
 
 async def process_recurrent_payments():
-    users = await get_users_for_renewal(reminder_days=3)
-    for user in users:
+    async for user in iter_users("renewal", columns=("id", "telegram_id"), target_date=renewal_target_date(reminder_days=3)):
         telegram_id = user.get("telegram_id") if isinstance(user, dict) else user
         if not telegram_id or not str(telegram_id).isdigit():
             continue
@@ -75,4 +74,8 @@ async def scheduler_start():
     scheduler.add_job(send_reminders, "interval", days=2)
     scheduler.add_job(daily_deactivate_expired, 'interval', days=1)
     scheduler.add_job(process_recurrent_payments, 'interval', days=1)
+    # Подхватываем рассылки, прерванные рестартом, — сразу при старте и затем раз в минуту
+    scheduler.add_job(resume_broadcast_jobs, 'interval', minutes=1, args=[bot], next_run_time=datetime.now())
+    # Пул готовых тренировок наполняем ночью, когда генерация не конкурирует с живыми пользователями
+    scheduler.add_job(fill_workout_pool, 'cron', hour=WORKOUT_POOL_FILL_HOURS, minute=0)
     scheduler.start() 
\ No newline at end of file
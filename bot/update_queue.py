@@ -0,0 +1,221 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from aiogram.exceptions import TelegramBadRequest
+
+# Обработка апдейтов вебхука в фоне: POST /webhook только кладёт апдейт в очередь и сразу отвечает 200.
+# У каждого пользователя своя цепочка апдейтов, которые обрабатываются строго по порядку;
+# общий пул из WEBHOOK_WORKERS воркеров берёт цепочки по очереди, так что медленный апдейт
+# задерживает только следующие апдейты того же пользователя.
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "16"))
+# Сколько апдейтов может ждать обработки всего; при переполнении вебхук ждёт до WEBHOOK_ENQUEUE_TIMEOUT
+# и отвечает 503 — Telegram повторит доставку позже
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", "5"))
+# Сколько секунд дать воркерам дообработать очередь при остановке
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "10"))
+WEBHOOK_STATS_INTERVAL = float(os.getenv("WEBHOOK_STATS_INTERVAL", "300"))
+# Кнопки меню, запускающие долгую генерацию: повторное нажатие, пока первое ждёт в цепочке
+# или обрабатывается, отбрасывается при постановке. Для callback-кнопок то же делается по callback_data.
+BUSY_TEXTS = ("Получить новую тренировку", "Подсчет калорий")
+BUSY_REPLY = "Генерация уже выполняется, подождите..."
+
+
+def busy_key(update):
+    """Ключ действия для отбрасывания повторных нажатий или None, если апдейт повторять можно."""
+    if update.callback_query is not None:
+        return f"callback:{update.callback_query.data}"
+    message = update.message
+    if message is not None and message.text in BUSY_TEXTS:
+        return f"text:{message.text}"
+    return None
+
+
+async def answer_callback(callback_query, text=None):
+    """callback_query.answer(), который не роняет хендлер: запрос мог быть уже отвечен очередью или устареть."""
+    try:
+        await callback_query.answer(text)
+    except TelegramBadRequest as e:
+        logging.info(f"callback {callback_query.id} уже отвечен или устарел: {e}")
+
+
+def partition_key(update):
+    """telegram id автора апдейта; для апдейтов без автора — чат или update_id."""
+    try:
+        event = update.event
+    except Exception:
+        return update.update_id
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    return chat.id if chat is not None else update.update_id
+
+
+class UpdateQueue:
+    """Очередь апдейтов с упорядоченными цепочками по пользователю, общим пулом воркеров и метриками."""
+
+    def __init__(self, handler, bot=None, workers=WEBHOOK_WORKERS, max_pending=WEBHOOK_QUEUE_SIZE,
+                 enqueue_timeout=WEBHOOK_ENQUEUE_TIMEOUT):
+        self.handler = handler
+        # Через bot очередь сама отвечает на callback-запросы, которым предстоит ждать в цепочке:
+        # иначе к запуску хендлера истечёт срок ответа Telegram
+        self.bot = bot
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self.enqueue_timeout = enqueue_timeout
+        # Ключ -> deque[(время постановки, апдейт)]. Пока цепочка существует, её ключ либо стоит в _ready,
+        # либо его апдейт обрабатывает воркер, поэтому апдейты одного пользователя не идут параллельно.
+        self._chains = {}
+        self._busy = {}  # ключ -> busy_key апдейтов, которые ждут или обрабатываются
+        self._answers = set()
+        self._ready = None
+        self._slots = None
+        self._idle = None
+        self._tasks = []
+        self._stats_task = None
+        self._accepting = False
+        self.pending = 0
+        # Метрики
+        self.enqueued = 0
+        self.processed = 0
+        self.errors = 0
+        self.rejected = 0
+        self.duplicates = 0
+        self.max_depth = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.handle_total = 0.0
+
+    def start(self):
+        if self._tasks:
+            return
+        self._ready = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if WEBHOOK_STATS_INTERVAL > 0:
+            self._stats_task = asyncio.create_task(self._log_stats())
+        self._accepting = True
+
+    async def put(self, update):
+        """Ставит апдейт в цепочку его пользователя. False — очередь переполнена или остановлена (ответить 503)."""
+        if not self._accepting:
+            self.rejected += 1
+            return False
+        key = partition_key(update)
+        busy = busy_key(update)
+        if busy is not None and busy in self._busy.get(key, ()):
+            # Повторное нажатие: апдейт принят (Telegram не будет его повторять), но не обрабатывается
+            self.duplicates += 1
+            if update.callback_query is not None:
+                self._answer_early(update.callback_query, BUSY_REPLY)
+            return True
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            logging.warning(f"Очередь апдейтов переполнена, апдейт {update.update_id} отклонён")
+            return False
+        chain = self._chains.get(key)
+        if chain is None:
+            chain = self._chains[key] = deque()
+            self._ready.put_nowait(key)
+        elif update.callback_query is not None:
+            # Впереди апдейты того же пользователя — отвечаем сразу, хендлер потом ответить уже не сможет
+            self._answer_early(update.callback_query)
+        if busy is not None:
+            self._busy.setdefault(key, set()).add(busy)
+        chain.append((time.monotonic(), update, busy))
+        self.pending += 1
+        self._idle.clear()
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self.pending)
+        return True
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            chain = self._chains[key]
+            enqueued_at, update, busy = chain.popleft()
+            started = time.monotonic()
+            wait = started - enqueued_at
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            try:
+                await self.handler(update)
+            except Exception as e:
+                self.errors += 1
+                logging.exception(f"Ошибка обработки апдейта {update.update_id}: {e}")
+            finally:
+                self.processed += 1
+                self.handle_total += time.monotonic() - started
+                if busy is not None:
+                    self._busy[key].discard(busy)
+                    if not self._busy[key]:
+                        del self._busy[key]
+                # Следующий апдейт пользователя — в конец общей очереди, чтобы остальные не ждали его цепочку
+                if chain:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._chains[key]
+                self.pending -= 1
+                self._slots.release()
+                if self.pending == 0:
+                    self._idle.set()
+
+    def _answer_early(self, callback_query, text=None):
+        if self.bot is None:
+            return
+        task = asyncio.create_task(self._answer(callback_query, text))
+        self._answers.add(task)
+        task.add_done_callback(self._answers.discard)
+
+    async def _answer(self, callback_query, text):
+        try:
+            await self.bot.answer_callback_query(callback_query.id, text=text)
+        except Exception as e:
+            logging.info(f"Не удалось ответить на callback {callback_query.id}: {e}")
+
+    async def _log_stats(self):
+        while True:
+            await asyncio.sleep(WEBHOOK_STATS_INTERVAL)
+            logging.info(f"Update queue stats: {self.stats()}")
+
+    def depth(self):
+        return self.pending
+
+    async def stop(self, timeout=WEBHOOK_DRAIN_TIMEOUT):
+        """Перестаёт принимать апдейты, ждёт обработки уже принятых (не дольше timeout) и гасит воркеры."""
+        self._accepting = False
+        try:
+            if self._idle is not None:
+                await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Не дождались обработки {self.depth()} апдейтов при остановке")
+        tasks = self._tasks + ([self._stats_task] if self._stats_task else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        self._stats_task = None
+        logging.info(f"Update queue stats: {self.stats()}")
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "users": len(self._chains),
+            "depth": self.depth(),
+            "max_depth": self.max_depth,
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "duplicates": self.duplicates,
+            "avg_wait_ms": round(self.wait_total / self.processed * 1000, 1) if self.processed else 0.0,
+            "max_wait_ms": round(self.wait_max * 1000, 1),
+            "avg_handle_ms": round(self.handle_total / self.processed * 1000, 1) if self.processed else 0.0,
+        }
@@ -0,0 +1,182 @@
+import os
+import time
+import asyncio
+import logging
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from .db import (
+    iter_users, get_recent_exercises, add_pool_workout, take_pool_workout, get_pool_available, delete_pool_workouts
+)
+from .ai import MUSCLE_GROUPS, generate_segment_workout
+from .exercises import exercise_keys
+
+WORKOUT_POOL_ENABLED = os.getenv("WORKOUT_POOL_ENABLED", "1") == "1"
+# Сколько свободных тренировок держать на каждую пару сегмент × группа мышц
+WORKOUT_POOL_PER_GROUP = int(os.getenv("WORKOUT_POOL_PER_GROUP", "3"))
+# Пул наполняется только для самых массовых сегментов платных пользователей
+WORKOUT_POOL_MAX_SEGMENTS = int(os.getenv("WORKOUT_POOL_MAX_SEGMENTS", "20"))
+# Тренировки старше этого срока не выдаются и удаляются при следующем наполнении
+WORKOUT_POOL_MAX_AGE_DAYS = float(os.getenv("WORKOUT_POOL_MAX_AGE_DAYS", "7"))
+# Не больше стольких генераций за один запуск наполнения и одновременно
+WORKOUT_POOL_FILL_LIMIT = int(os.getenv("WORKOUT_POOL_FILL_LIMIT", "100"))
+WORKOUT_POOL_FILL_CONCURRENCY = int(os.getenv("WORKOUT_POOL_FILL_CONCURRENCY", "4"))
+# Часы (выражение hour для cron в APScheduler), в которые пул наполняется — вне пиковой нагрузки
+WORKOUT_POOL_FILL_HOURS = os.getenv("WORKOUT_POOL_FILL_HOURS", "2-5")
+
+SEGMENT_FIELDS = ("goal", "level", "location", "gender", "age_band")
+AGE_BANDS = ((17, "до 18"), (24, "18-24"), (34, "25-34"), (44, "35-44"), (54, "45-54"))
+# Значения health_issues, которые считаем «ограничений нет»
+NO_HEALTH_ISSUES = ("", "нет", "-", "no", "none")
+
+_stats = {"hits": 0, "misses": 0, "no_segment": 0, "served_age_sec": 0.0, "generated": 0, "fill_errors": 0}
+
+
+def age_band(age):
+    try:
+        age = int(age)
+    except (TypeError, ValueError):
+        return None
+    for upper, band in AGE_BANDS:
+        if age <= upper:
+            return band
+    return "55+"
+
+
+def segment_of(user):
+    """Грубые поля профиля, от которых зависит промпт, или None, если пул пользователю не подходит.
+
+    Пользователям с ограничениями по здоровью и с незаполненной анкетой тренировка всегда генерируется лично.
+    """
+    if not user:
+        return None
+    if str(user.get("health_issues") or "").strip().lower() not in NO_HEALTH_ISSUES:
+        return None
+    segment = {
+        "goal": user.get("goal"),
+        "level": user.get("level"),
+        "location": user.get("location"),
+        "gender": user.get("gender"),
+        "age_band": age_band(user.get("age")),
+    }
+    if not all(segment.values()):
+        return None
+    return {key: str(value).strip().lower() for key, value in segment.items()}
+
+
+def segment_key(segment):
+    return "|".join(segment[field] for field in SEGMENT_FIELDS)
+
+
+def segment_profile(segment):
+    # Профиль для промпта: возрастная группа вместо точного возраста, остальное «не указано»
+    return {
+        "goal": segment["goal"],
+        "level": segment["level"],
+        "location": segment["location"],
+        "gender": segment["gender"],
+        "age": segment["age_band"],
+        "health_issues": "нет",
+    }
+
+
+def _fresh_after():
+    return (datetime.utcnow() - timedelta(days=WORKOUT_POOL_MAX_AGE_DAYS)).isoformat()
+
+
+def _age_seconds(created_at):
+    created = datetime.fromisoformat(created_at)
+    if created.tzinfo is None:
+        created = created.replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - created).total_seconds()
+
+
+async def take_pooled_workout(user):
+    """Текст готовой тренировки из пула или None — тогда её нужно сгенерировать как обычно."""
+    if not WORKOUT_POOL_ENABLED:
+        return None
+    segment = segment_of(user)
+    if segment is None:
+        _stats["no_segment"] += 1
+        return None
+    try:
+        recent = await get_recent_exercises(user["id"])
+        row = await take_pool_workout(segment_key(segment), user.get("telegram_id"), _fresh_after(), recent)
+    except Exception as e:
+        logging.warning(f"Не удалось взять тренировку из пула: {e}")
+        row = None
+    if not row:
+        _stats["misses"] += 1
+        return None
+    _stats["hits"] += 1
+    _stats["served_age_sec"] += _age_seconds(row["created_at"])
+    return row["workout_text"]
+
+
+async def _generate(segment, muscle_group, semaphore):
+    async with semaphore:
+        try:
+            text = await generate_segment_workout(segment_profile(segment), muscle_group)
+            if text and text.strip():
+                await add_pool_workout(segment_key(segment), muscle_group, text, exercise_keys(text))
+                _stats["generated"] += 1
+        except Exception as e:
+            _stats["fill_errors"] += 1
+            logging.warning(f"Ошибка генерации тренировки для пула ({segment_key(segment)}, {muscle_group}): {e}")
+
+
+async def fill_workout_pool():
+    """Догенерирует тренировки для самых массовых сегментов платных пользователей и чистит устаревшие."""
+    if not WORKOUT_POOL_ENABLED:
+        return
+    started = time.monotonic()
+    removed = await delete_pool_workouts(_fresh_after())
+    counts = Counter()
+    segments = {}
+    columns = ("id", "goal", "level", "location", "gender", "age", "health_issues")
+    async for user in iter_users("paid", columns=columns):
+        segment = segment_of(user)
+        if segment is not None:
+            key = segment_key(segment)
+            counts[key] += 1
+            segments[key] = segment
+    available = Counter((row["segment_key"], row["muscle_group"]) for row in await get_pool_available(_fresh_after()))
+    tasks = []
+    semaphore = asyncio.Semaphore(WORKOUT_POOL_FILL_CONCURRENCY)
+    for key, _ in counts.most_common(WORKOUT_POOL_MAX_SEGMENTS):
+        for muscle_group in MUSCLE_GROUPS:
+            missing = WORKOUT_POOL_PER_GROUP - available[(key, muscle_group)]
+            for _ in range(max(0, missing)):
+                if len(tasks) < WORKOUT_POOL_FILL_LIMIT:
+                    tasks.append(_generate(segments[key], muscle_group, semaphore))
+    generated_before = _stats["generated"]
+    await asyncio.gather(*tasks)
+    logging.info(
+        f"Пул тренировок: удалено {removed}, сгенерировано {_stats['generated'] - generated_before} из {len(tasks)} "
+        f"за {time.monotonic() - started:.0f} сек; {workout_pool_stats()}"
+    )
+
+
+def workout_pool_stats():
+    served = _stats["hits"] + _stats["misses"]
+    return {
+        **_stats,
+        "served_age_sec": round(_stats["served_age_sec"]),
+        "hit_rate": round(_stats["hits"] / served, 3) if served else 0.0,
+        "avg_served_age_hours": round(_stats["served_age_sec"] / _stats["hits"] / 3600, 1) if _stats["hits"] else 0.0,
+    }
+
+
+async def workout_pool_report():
+    """Текст для админа: свободные тренировки по сегментам, возраст самой старой и счётчики выдачи."""
+    rows = await get_pool_available(_fresh_after())
+    by_segment = Counter(row["segment_key"] for row in rows)
+    oldest = max((_age_seconds(row["created_at"]) for row in rows), default=0)
+    stats = workout_pool_stats()
+    lines = [
+        f"Пул тренировок: {len(rows)} свободных в {len(by_segment)} сегментах, самая старая — {oldest / 3600:.1f} ч.",
+        f"Выдано из пула: {stats['hits']}, промахов: {stats['misses']}, не подходит под пул: {stats['no_segment']}, "
+        f"hit rate: {stats['hit_rate']:.0%}, средний возраст выданной: {stats['avg_served_age_hours']} ч.",
+    ]
+    for key, count in by_segment.most_common(10):
+        lines.append(f"{key}: {count}")
+    return "\n".join(lines)
@@ -0,0 +1,14 @@
+-- Пакетное обновление last_active_at одним вызовом (используется LastActiveBuffer в bot/db.py)
+create or replace function touch_last_active(updates jsonb)
+returns integer
+language sql
+as $$
+  with changed as (
+    update users u
+    set last_active_at = greatest(u.last_active_at, (x->>'last_active_at')::timestamptz)
+    from jsonb_array_elements(updates) x
+    where u.telegram_id = (x->>'telegram_id')::bigint
+    returning 1
+  )
+  select count(*)::integer from changed;
+$$;
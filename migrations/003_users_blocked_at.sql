@@ -0,0 +1,18 @@
+-- Пользователи, до которых не доходят сообщения (заблокировали бота, удалили аккаунт, чат не найден).
+-- Рассылки и напоминания их пропускают; отметка снимается, как только пользователь снова пишет боту.
+alter table users add column if not exists blocked_at timestamptz;
+
+create or replace function touch_last_active(updates jsonb)
+returns integer
+language sql
+as $$
+  with changed as (
+    update users u
+    set last_active_at = greatest(u.last_active_at, (x->>'last_active_at')::timestamptz),
+        blocked_at = null
+    from jsonb_array_elements(updates) x
+    where u.telegram_id = (x->>'telegram_id')::bigint
+    returning 1
+  )
+  select count(*)::integer from changed;
+$$;
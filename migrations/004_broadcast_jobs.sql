@@ -0,0 +1,29 @@
+-- Рассылки как задачи: переживают рестарт и продолжаются с последнего подтверждённого получателя
+create table if not exists broadcast_jobs (
+  id bigserial primary key,
+  text text not null,
+  audience text not null,
+  status text not null default 'running',  -- running / paused / cancelled / done / failed
+  cursor_id text,                          -- users.id последнего пользователя полностью обработанной страницы
+  total integer,
+  sent integer not null default 0,
+  failed integer not null default 0,
+  unreachable integer not null default 0,
+  created_by bigint,
+  progress_chat_id bigint,
+  progress_message_id bigint,
+  heartbeat_at timestamptz,                -- обновляет воркер, который ведёт рассылку
+  created_at timestamptz not null default now(),
+  updated_at timestamptz not null default now(),
+  finished_at timestamptz
+);
+
+create index if not exists broadcast_jobs_status_idx on broadcast_jobs (status, heartbeat_at);
+
+create table if not exists broadcast_recipients (
+  job_id bigint not null references broadcast_jobs (id) on delete cascade,
+  telegram_id bigint not null,
+  status text not null,                    -- sent / failed / blocked / deactivated / chat_not_found
+  processed_at timestamptz not null default now(),
+  primary key (job_id, telegram_id)
+);
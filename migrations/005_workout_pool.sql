@@ -0,0 +1,13 @@
+-- Пул заранее сгенерированных тренировок по сегментам профиля (bot/workout_pool.py)
+create table if not exists workout_pool (
+  id bigserial primary key,
+  segment_key text not null,               -- goal|level|location|gender|age_band
+  muscle_group text not null,
+  workout_text text not null,
+  exercises text[] not null default '{}',  -- нормализованные названия упражнений (bot/exercises.py)
+  created_at timestamptz not null default now(),
+  used_at timestamptz,                     -- тренировка выдаётся один раз
+  used_by bigint
+);
+
+create index if not exists workout_pool_available_idx on workout_pool (segment_key, created_at) where used_at is null;
@@ -0,0 +1,24 @@
+-- Кэш анализа фото еды (bot/food_cache.py): точное совпадение по file_unique_id Telegram,
+-- для пересжатых / пересланных копий — по близости перцептивного хеша (dHash, 64 бита)
+create table if not exists food_photo_cache (
+  file_unique_id text primary key,
+  dhash bigint,
+  result jsonb not null,                   -- {"description", "calories", "proteins", "fats", "carbs"}
+  created_at timestamptz not null default now()
+);
+
+create index if not exists food_photo_cache_created_idx on food_photo_cache (created_at);
+
+-- Ближайшее по расстоянию Хэмминга фото не дальше max_distance бит (bit_count есть с Postgres 14)
+create or replace function find_similar_food_photo(target bigint, max_distance integer)
+returns setof food_photo_cache
+language sql
+stable
+as $$
+  select *
+  from food_photo_cache
+  where dhash is not null
+    and bit_count((dhash # target)::bit(64)) <= max_distance
+  order by bit_count((dhash # target)::bit(64)), created_at desc
+  limit 1;
+$$;
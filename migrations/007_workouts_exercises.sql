@@ -0,0 +1,20 @@
+-- Нормализованные названия упражнений тренировки, считаются один раз в add_workout (bot/exercises.py)
+alter table workouts add column if not exists exercises text[];
+
+create index if not exists workouts_user_date_idx on workouts (user_id, date desc);
+
+-- Заполняем для старых тренировок той же нормализацией, что и exercise_keys()
+update workouts w
+set exercises = coalesce((
+  select array_agg(k order by ord)
+  from (
+    select min(ord) as ord, k
+    from (
+      select m.ord, regexp_replace(btrim(replace(lower(m.match[1]), 'ё', 'е'), ' *_.:'), '\s+', ' ', 'g') as k
+      from regexp_matches(coalesce(w.details, ''), '^\d+\.[ \t]*([^\n]+)', 'gn') with ordinality as m(match, ord)
+    ) names
+    where k <> ''
+    group by k
+  ) uniq
+), '{}')
+where w.exercises is null;
@@ -0,0 +1,3 @@
+-- Выгрузка всей истории за период идёт страницами по (date, id) — keyset без offset
+create index if not exists workouts_user_date_id_idx on workouts (user_id, date, id);
+create index if not exists meals_user_date_id_idx on meals (user_id, date, id);
@@ -0,0 +1,31 @@
+-- Состояния FSM aiogram (bot/fsm_storage.py): переживают рестарт и общие для всех процессов бота
+create table if not exists fsm_storage (
+  key text primary key,                    -- DefaultKeyBuilder: fsm:<bot_id>:<chat_id>:<user_id>
+  state text,
+  data jsonb not null default '{}',
+  updated_by text,                         -- процесс, сделавший последнюю запись
+  updated_at timestamptz not null default now()
+);
+
+create index if not exists fsm_storage_updated_idx on fsm_storage (updated_at);
+
+-- Остальные процессы сбрасывают запись в своём локальном кэше по уведомлению «процесс|ключ»
+create or replace function notify_fsm_storage()
+returns trigger
+language plpgsql
+as $$
+begin
+  if tg_op = 'DELETE' then
+    -- Удаляют вручную или чисткой: сбросить должны все процессы
+    perform pg_notify('fsm_storage', '|' || old.key);
+    return old;
+  end if;
+  perform pg_notify('fsm_storage', coalesce(new.updated_by, '') || '|' || new.key);
+  return new;
+end;
+$$;
+
+drop trigger if exists fsm_storage_notify on fsm_storage;
+create trigger fsm_storage_notify
+after insert or update or delete on fsm_storage
+for each row execute function notify_fsm_storage();
@@ -0,0 +1,34 @@
+from bot.nutrition import parse_meal_text
+
+
+def test_decimal_comma_quantity():
+    meal = parse_meal_text("я съела 1,5 кг говядины")
+    assert meal is not None
+    assert meal.calories == 2805
+    assert meal.description == "1,5 кг говядины"
+
+
+def test_decimal_point_quantity():
+    assert parse_meal_text("съел 1.5 кг говядины").calories == 2805
+
+
+def test_comma_still_separates_items():
+    meal = parse_meal_text("съел 2 яйца, банан")
+    assert meal.description == "2 яйца, банан"
+    assert meal.calories == 288
+    assert parse_meal_text("съел 200 г творога,2 яйца").calories == 415
+
+
+def test_simple_meals():
+    assert parse_meal_text("съел 2 яйца").calories == 173
+    assert parse_meal_text("Съела 200 г творога и банан").calories == 357
+
+
+def test_dish_with_s_goes_to_model():
+    assert parse_meal_text("съел рис с курицей") is None
+    assert parse_meal_text("на обед гречка с курицей") is None
+
+
+def test_unknown_food_goes_to_model():
+    assert parse_meal_text("съел 1,5 кг чего-то странного") is None
+    assert parse_meal_text("привет") is None
@@ -1,16 +1,25 @@
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 import os
 import sys
 import logging
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "bot"))
 
-from bot.main import bot, dp 
+from bot.main import bot, dp, storage
+from bot.fsm_storage import DatabaseStorage
 from aiogram import types
 from bot.payments import yookassa_webhook_fastapi 
 from bot.scheduler import scheduler_start
+from bot.db import init_db, close_db
+from bot.ai import close_ai
+from bot.history_export import close_history_export
+from bot.prompts import warm_tokenizer
+from bot.update_queue import UpdateQueue
 
 app = FastAPI()
+# Апдейты обрабатываются воркерами в фоне, вебхук не ждёт ответа модели
+update_queue = UpdateQueue(lambda update: dp.feed_update(bot, update), bot=bot)
 
 @app.post("/yookassa/webhook")
 async def yookassa_webhook_entrypoint(request: Request):
@@ -20,14 +29,29 @@ async def yookassa_webhook_entrypoint(request: Request):
 async def process_webhook(request: Request):
     data = await request.json()
     update = types.Update.model_validate(data)
-    await dp.feed_update(bot, update)
+    if not await update_queue.put(update):
+        # Очередь переполнена — Telegram повторит доставку
+        return JSONResponse({"ok": False}, status_code=503)
     return {"ok": True}
 
 @app.on_event("startup")
 async def on_startup():
+    await init_db()
+    if isinstance(storage, DatabaseStorage):
+        await storage.start()
+    await warm_tokenizer()
+    update_queue.start()
     logging.info("Запуск планировщика задач...")
     await scheduler_start()
     logging.info("Планировщик задач успешно запущен.")
 
+@app.on_event("shutdown")
+async def on_shutdown():
+    await update_queue.stop()
+    await close_ai()
+    close_history_export()
+    await storage.close()
+    await close_db()
+
 # Для локального запуска через uvicorn:
 # uvicorn webhook_server:app --host 0.0.0.0 --port 8080 
\ No newline at end of file